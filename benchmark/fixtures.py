@@ -0,0 +1,88 @@
+import math
+import os
+import struct
+import wave
+from typing import Optional, TypedDict
+
+from PIL import Image, ImageDraw
+
+
+class Fixtures(TypedDict):
+    font_path: str
+    bgm_file_path: str
+    bgv_file_path: str
+    man_image_dir: str
+    woman_image_dir: str
+    open_jtalk_dict_dir_path: str
+
+
+def find_font_path() -> str:
+    # アプリと同様にシステムのフォントから選ぶ
+    from matplotlib import font_manager
+
+    system_fonts = sorted(font_manager.findSystemFonts(fontpaths=None))
+    # 日本語のフォントは .ttc で提供されることが多いため優先する
+    fonts = [
+        path for path in system_fonts if path.lower().endswith(".ttc")
+    ] or system_fonts
+    if not fonts:
+        raise Exception("フォントが見つかりません。--font で指定してください")
+    return fonts[0]
+
+
+def write_tone(path: str, seconds: float, frequency: float) -> None:
+    sampling_rate = 22050
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sampling_rate)
+        wav.writeframes(
+            b"".join(
+                struct.pack(
+                    "<h",
+                    int(2000 * math.sin(2 * math.pi * frequency * i / sampling_rate)),
+                )
+                for i in range(int(seconds * sampling_rate))
+            )
+        )
+
+
+def write_person_images(directory: str, color: tuple[int, int, int]) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for i in range(3):
+        image = Image.new("RGBA", (600, 900), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((180, 40 + 10 * i, 420, 280 + 10 * i), fill=color + (255,))
+        draw.rectangle((150, 300, 450, 880), fill=color + (255,))
+        image.save(os.path.join(directory, f"{i}.png"))
+
+
+def write_background_video(path: str) -> None:
+    from moviepy.editor import ColorClip
+
+    ColorClip(size=(540, 960), color=(30, 120, 200), duration=2).write_videofile(
+        path, fps=30, codec="libx264", audio=False, logger=None
+    )
+
+
+def prepare_fixtures(fixture_dir: str, font_path: Optional[str] = None) -> Fixtures:
+    # 入力素材はすべてローカルで決定的に生成し、一度作ったものは使い回す
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures: Fixtures = {
+        "font_path": font_path or find_font_path(),
+        "bgm_file_path": os.path.join(fixture_dir, "bgm.wav"),
+        "bgv_file_path": os.path.join(fixture_dir, "bgv.mp4"),
+        "man_image_dir": os.path.join(fixture_dir, "man"),
+        "woman_image_dir": os.path.join(fixture_dir, "woman"),
+        "open_jtalk_dict_dir_path": os.path.join(fixture_dir, "open_jtalk_dic"),
+    }
+    if not os.path.exists(fixtures["bgm_file_path"]):
+        write_tone(fixtures["bgm_file_path"], seconds=10, frequency=440)
+    if not os.path.exists(fixtures["bgv_file_path"]):
+        write_background_video(fixtures["bgv_file_path"])
+    if not os.path.exists(fixtures["man_image_dir"]):
+        write_person_images(fixtures["man_image_dir"], (60, 90, 160))
+    if not os.path.exists(fixtures["woman_image_dir"]):
+        write_person_images(fixtures["woman_image_dir"], (200, 90, 120))
+    os.makedirs(fixtures["open_jtalk_dict_dir_path"], exist_ok=True)
+    return fixtures
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+repository_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(repository_dir)
+sys.path.append(os.path.join(repository_dir, "src"))
+
+from benchmark.fixtures import Fixtures, prepare_fixtures  # noqa: E402
+from benchmark.stubs import (  # noqa: E402
+    StubImageServer,
+    StubOpenAI,
+    attach_stub_openai,
+    install_stub_voicevox_core,
+    loadable_shared_library_path,
+)
+
+# 動画生成モジュールが moviepy の設定を書き換えるため、素材の生成より先に読み込む
+# (素材の生成で利用する moviepy は prepare_fixtures の呼び出し時に読み込まれる)
+from command import bulletin_cmd, trivia_cmd  # noqa: E402
+from util import ProgressReporter, progress_reporting  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+SCENARIOS = ["bulletin", "trivia"]
+
+logger = logging.getLogger("benchmark")
+
+
+def measure(fn: Callable[[], Any]) -> Tuple[Any, Dict[str, float]]:
+    # 子プロセス (ffmpeg, ImageMagick) のCPU時間も含めて計測する
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+    self_usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (
+        (self_usage_end.ru_utime - self_usage.ru_utime)
+        + (self_usage_end.ru_stime - self_usage.ru_stime)
+        + (children_usage_end.ru_utime - children_usage.ru_utime)
+        + (children_usage_end.ru_stime - children_usage.ru_stime)
+    )
+    return result, {"wall": wall, "cpu": cpu}
+
+
+def run_scenario(
+    scenario: str,
+    fixtures: Fixtures,
+    image_server: StubImageServer,
+    output_dir: str,
+    num_contents: int,
+    latency: float,
+    use_async: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    random.seed(0)
+    stub_openai = StubOpenAI(
+        image_server=image_server, num_contents=num_contents, latency=latency
+    )
+    if scenario == "bulletin":
+        generators = bulletin_cmd(
+            themes=["ベンチマーク"],
+            openai_api_key="sk-benchmark",
+            output_dir=output_dir,
+            onnxruntime_lib_path=loadable_shared_library_path(),
+            open_jtalk_dict_dir_path=fixtures["open_jtalk_dict_dir_path"],
+            man_image_dir=fixtures["man_image_dir"],
+            woman_image_dir=fixtures["woman_image_dir"],
+            bgm_file_path=fixtures["bgm_file_path"],
+            bgv_file_path=fixtures["bgv_file_path"],
+            font_path=fixtures["font_path"],
+            logger=logger,
+        )
+    else:
+        generators = trivia_cmd(
+            themes=["ベンチマーク"],
+            speaker_id=3,
+            num_trivia=num_contents,
+            openai_api_key="sk-benchmark",
+            output_dir=output_dir,
+            onnxruntime_lib_path=loadable_shared_library_path(),
+            open_jtalk_dict_dir_path=fixtures["open_jtalk_dict_dir_path"],
+            bgm_file_path=fixtures["bgm_file_path"],
+            font_path=fixtures["font_path"],
+            logger=logger,
+        )
+    manuscript_generator, audio_generator, thumbnail_generator, movie_generator = (
+        generators
+    )
+    for generator in generators:
+        attach_stub_openai(generator, stub_openai)
+
+    # 書き出したフレーム数からレンダリングのFPSを求める
+    frames = [0]
+
+    def on_progress(stage: Any, unit: str, done: int, total: int) -> None:
+        if unit == "frame":
+            frames[0] = done
+
+    metrics: Dict[str, Dict[str, float]] = {}
+    with progress_reporting(ProgressReporter(on_progress=on_progress)):
+        if use_async:
+            # 非同期版の生成処理をイベントループ上で計測する
+            manuscript, metrics["manuscript"] = measure(
+                lambda: asyncio.run(manuscript_generator.agenerate())
+            )
+            audio, metrics["audio"] = measure(
+                lambda: asyncio.run(audio_generator.agenerate(manuscript))
+            )
+            _, metrics["thumbnail"] = measure(
+                lambda: asyncio.run(thumbnail_generator.agenerate(manuscript))
+            )
+            _, metrics["movie"] = measure(
+                lambda: asyncio.run(movie_generator.agenerate(manuscript, audio))
+            )
+        else:
+            manuscript, metrics["manuscript"] = measure(manuscript_generator.generate)
+            audio, metrics["audio"] = measure(
+                lambda: audio_generator.generate(manuscript)
+            )
+            _, metrics["thumbnail"] = measure(
+                lambda: thumbnail_generator.generate(manuscript)
+            )
+            _, metrics["movie"] = measure(
+                lambda: movie_generator.generate(manuscript, audio)
+            )
+    metrics["movie"]["fps"] = (
+        frames[0] / metrics["movie"]["wall"] if metrics["movie"]["wall"] > 0 else 0
+    )
+    return metrics
+
+
+def median_metrics(
+    runs: List[Dict[str, Dict[str, float]]],
+) -> Dict[str, Dict[str, float]]:
+    return {
+        stage: {
+            key: statistics.median(run[stage][key] for run in runs)
+            for key in runs[0][stage]
+        }
+        for stage in runs[0]
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, Dict[str, float]]],
+    baseline: Dict[str, Dict[str, Dict[str, float]]],
+    tolerance: float,
+    noise_floor: float,
+) -> List[str]:
+    # 時間は増加、FPSは低下を退行とみなす。短すぎる処理は誤差が大きいため noise_floor 秒以下の差は無視する
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, values in stages.items():
+            base = baseline.get(scenario, {}).get(stage)
+            if base is None:
+                continue
+            for key in ["wall", "cpu"]:
+                if (
+                    key in base
+                    and values[key] > base[key] * (1 + tolerance)
+                    and values[key] - base[key] > noise_floor
+                ):
+                    regressions.append(
+                        f"{scenario}.{stage}.{key}: {base[key]:.3f}s -> {values[key]:.3f}s"
+                    )
+            if "fps" in base and values["fps"] < base["fps"] * (1 - tolerance):
+                regressions.append(
+                    f"{scenario}.{stage}.fps: {base['fps']:.1f} -> {values['fps']:.1f}"
+                )
+    return regressions
+
+
+def print_table(
+    results: Dict[str, Dict[str, Dict[str, float]]],
+    baseline: Dict[str, Dict[str, Dict[str, float]]],
+) -> None:
+    print(
+        f"{'scenario':<10}{'stage':<12}{'wall[s]':>10}{'cpu[s]':>10}{'fps':>8}{'vs base':>10}"
+    )
+    for scenario, stages in results.items():
+        for stage, values in stages.items():
+            base = baseline.get(scenario, {}).get(stage)
+            ratio = (
+                f"{values['wall'] / base['wall']:.2f}x"
+                if base and base.get("wall")
+                else "-"
+            )
+            fps = f"{values['fps']:.1f}" if "fps" in values else "-"
+            print(
+                f"{scenario:<10}{stage:<12}{values['wall']:>10.3f}{values['cpu']:>10.3f}{fps:>8}{ratio:>10}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="OpenAIとVOICEVOXをローカルのスタブに置き換えて生成処理全体を計測する"
+    )
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("--repeat", type=int, default=3, help="各シナリオの試行回数")
+    parser.add_argument("--num-contents", type=int, default=12, help="原稿の文章数")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="スタブのOpenAI APIに付与する擬似的な応答遅延 [s]",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="生成器の非同期版 (agenerate) を計測する",
+    )
+    parser.add_argument("--font", help="字幕とサムネイルに使うフォントファイル")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="退行とみなす悪化率"
+    )
+    parser.add_argument("--noise-floor", type=float, default=0.05)
+    parser.add_argument(
+        "--work-dir", default=os.path.join(tempfile.gettempdir(), "shoorter-benchmark")
+    )
+    parser.add_argument("--output", help="計測結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    install_stub_voicevox_core()
+    fixtures = prepare_fixtures(
+        os.path.join(args.work_dir, "fixtures"), font_path=args.font
+    )
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    with StubImageServer() as image_server:
+        for scenario in args.scenario or SCENARIOS:
+            runs = [
+                run_scenario(
+                    scenario=scenario,
+                    fixtures=fixtures,
+                    image_server=image_server,
+                    output_dir=os.path.join(args.work_dir, scenario, str(i)),
+                    num_contents=args.num_contents,
+                    latency=args.latency,
+                    use_async=args.use_async,
+                )
+                for i in range(args.repeat)
+            ]
+            results[scenario] = median_metrics(runs)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    baseline: Dict[str, Dict[str, Dict[str, float]]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_table(results, baseline)
+
+    if args.update_baseline or not baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({**baseline, **results}, file, indent=2)
+        print(f"ベースラインを更新しました: {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.tolerance, args.noise_floor)
+    if regressions:
+        print("性能の退行を検出しました:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise SystemExit(1)
+    print("ベースラインからの退行はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import asyncio
+import hashlib
+import io
+import math
+import struct
+import sys
+import threading
+import time
+import types
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Type
+
+from PIL import Image, ImageDraw
+from pydantic import BaseModel
+
+SENTENCES = [
+    "猫は一日の大半を寝て過ごすと言われている",
+    "実はペンギンの膝は羽毛の中に隠れている",
+    "この話、最初に聞いたときは信じられなかったわ",
+    "それって本当なの？ソースを出してほしい",
+    "昔から言われているけど、最近の研究で裏付けられたらしい",
+    "ワイも同じ経験あるで",
+    "富士山の山頂は実は私有地である",
+    "ハチミツは適切に保存すれば何千年も腐らない",
+    "バナナはベリーの一種に分類される",
+    "タコには心臓が三つある",
+]
+
+
+def deterministic_index(*values: Any) -> int:
+    return int(hashlib.sha256(repr(values).encode("utf-8")).hexdigest()[:8], 16)
+
+
+class StubChatCompletions:
+    def __init__(self, num_contents: int, latency: float) -> None:
+        self.num_contents = num_contents
+        self.latency = latency
+
+    def parse(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return self.respond(model, messages, response_format)
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> "StubCompletionStream":
+        return StubCompletionStream(
+            self, self.respond(model, messages, response_format)
+        )
+
+    def respond(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        response_format: Type[BaseModel],
+    ) -> SimpleNamespace:
+        # 入力メッセージのみから決定的に応答を組み立てる
+        seed = deterministic_index(model, messages)
+        # 原稿とその一部 (トリビアのみ・タイトルなどのみ) は、余分な項目を無視して解釈される
+        if (
+            "contents" in response_format.__fields__
+            or "title" in response_format.__fields__
+        ):
+            data: Dict[str, Any] = {
+                "title": "ベンチマーク用の動画",
+                "overview": "ベンチマーク用に生成された原稿です。",
+                "keywords": ["猫", "雑学", "動物", "科学", "歴史"],
+                "contents": [
+                    {
+                        "speaker_id": f"id{(seed + i) % 6 + 1}",
+                        "text": SENTENCES[(seed + i) % len(SENTENCES)],
+                        "links": [],
+                    }
+                    for i in range(self.num_contents)
+                ],
+            }
+        else:
+            data = {"keywords": ["猫", "公園", "夕焼け"]}
+        parsed = response_format.parse_obj(data)
+        prompt_tokens = sum(len(message["content"]) for message in messages)
+        completion_tokens = len(parsed.json())
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(parsed=parsed, refusal=None))
+            ],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+            model=model,
+        )
+
+
+def partial_events(completion: SimpleNamespace) -> List[SimpleNamespace]:
+    # 文章を1つずつ書き足した途中経過を、SDK の content.delta イベントと同じ形で返す
+    data = completion.choices[0].message.parsed.dict()
+    contents = data.pop("contents", None)
+    if contents is None:
+        return [SimpleNamespace(type="content.delta", parsed=data)]
+    return [
+        SimpleNamespace(
+            type="content.delta", parsed={**data, "contents": contents[: i + 1]}
+        )
+        for i in range(len(contents))
+    ]
+
+
+class StubCompletionStream:
+    # 応答遅延を途中経過のイベントに分けて、逐次受け取る場合の待ち時間を模倣する
+    def __init__(
+        self, completions: StubChatCompletions, completion: SimpleNamespace
+    ) -> None:
+        self.latency = completions.latency
+        self.completion = completion
+        self.events = partial_events(completion)
+
+    def __enter__(self) -> "StubCompletionStream":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def arrivals(self) -> List[float]:
+        # サーバーは受け取り側の処理を待たずに生成を続けるため、各イベントの到着時刻は開始時点から決まる
+        started = time.perf_counter()
+        return [
+            started + self.latency * (i + 1) / len(self.events)
+            for i in range(len(self.events))
+        ]
+
+    def __iter__(self) -> Any:
+        for event, arrival in zip(self.events, self.arrivals()):
+            time.sleep(max(0.0, arrival - time.perf_counter()))
+            yield event
+
+    def get_final_completion(self) -> SimpleNamespace:
+        return self.completion
+
+
+class StubAsyncCompletionStream(StubCompletionStream):
+    async def __aenter__(self) -> "StubAsyncCompletionStream":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    async def __aiter__(self) -> Any:  # type: ignore[override]
+        for event, arrival in zip(self.events, self.arrivals()):
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            yield event
+
+    async def get_final_completion(self) -> SimpleNamespace:  # type: ignore[override]
+        return self.completion
+
+
+class StubImages:
+    def __init__(self, image_server: "StubImageServer", latency: float) -> None:
+        self.image_server = image_server
+        self.latency = latency
+
+    def generate(
+        self, model: str, prompt: str, size: str, **kwargs: Any
+    ) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return self.respond(model, prompt, size)
+
+    def respond(self, model: str, prompt: str, size: str) -> SimpleNamespace:
+        digest = hashlib.sha256(f"{model}:{prompt}:{size}".encode("utf-8")).hexdigest()
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(url=f"{self.image_server.url}/{digest[:16]}/{size}.png")
+            ]
+        )
+
+
+class StubOpenAI:
+    # OpenAI クライアントのうち、本アプリが利用する API のみを模倣する
+    def __init__(
+        self, image_server: "StubImageServer", num_contents: int, latency: float = 0.0
+    ) -> None:
+        completions = StubChatCompletions(num_contents=num_contents, latency=latency)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = StubImages(image_server=image_server, latency=latency)
+
+
+class StubAsyncChatCompletions:
+    def __init__(self, completions: StubChatCompletions) -> None:
+        self.completions = completions
+
+    async def parse(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> SimpleNamespace:
+        await asyncio.sleep(self.completions.latency)
+        return self.completions.respond(model, messages, response_format)
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> StubAsyncCompletionStream:
+        return StubAsyncCompletionStream(
+            self.completions,
+            self.completions.respond(model, messages, response_format),
+        )
+
+
+class StubAsyncImages:
+    def __init__(self, images: StubImages) -> None:
+        self.images = images
+
+    async def generate(
+        self, model: str, prompt: str, size: str, **kwargs: Any
+    ) -> SimpleNamespace:
+        await asyncio.sleep(self.images.latency)
+        return self.images.respond(model, prompt, size)
+
+
+class StubAsyncOpenAI:
+    # AsyncOpenAI クライアントの模倣であり、応答遅延の間もイベントループを止めない
+    def __init__(self, client: StubOpenAI) -> None:
+        completions = StubAsyncChatCompletions(client.beta.chat.completions)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = StubAsyncImages(client.images)
+
+
+def render_png(seed: int, width: int, height: int) -> bytes:
+    image = Image.new("RGB", (width, height), (seed % 256, (seed >> 8) % 256, 200))
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        x = (seed >> i) % width
+        draw.ellipse(
+            (x, height // 4, x + width // 4, height // 4 + height // 4),
+            fill=((seed * (i + 1)) % 256, 120, (seed >> 4) % 256),
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StubImageServer:
+    # 画像のダウンロード処理をネットワークなしで実行するためのローカルHTTPサーバー
+    def __init__(self) -> None:
+        cache: Dict[str, bytes] = {}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                with lock:
+                    if self.path not in cache:
+                        size = self.path.rsplit("/", 1)[-1].removesuffix(".png")
+                        width, height = (int(v) for v in size.split("x"))
+                        cache[self.path] = render_png(
+                            deterministic_index(self.path), width, height
+                        )
+                    body = cache[self.path]
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "StubImageServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubVoicevoxCore:
+    # VOICEVOX の代わりに、文字数に比例した長さの決定的な音声を返す
+    sampling_rate = 24000
+    seconds_per_character = 0.12
+
+    def __init__(self, open_jtalk_dict_dir: Any = None, **kwargs: Any) -> None:
+        self.loaded_models: set[int] = set()
+
+    def load_model(self, speaker_id: int) -> None:
+        self.loaded_models.add(speaker_id)
+
+    def is_model_loaded(self, speaker_id: int) -> bool:
+        return speaker_id in self.loaded_models
+
+    def audio_query(self, text: str, speaker_id: int) -> Dict[str, Any]:
+        return {"text": text, "speaker_id": speaker_id}
+
+    def synthesis(self, audio_query: Dict[str, Any], speaker_id: int) -> bytes:
+        num_frames = int(
+            len(audio_query["text"]) * self.seconds_per_character * self.sampling_rate
+        )
+        frequency = 200 + 20 * (speaker_id % 10)
+        frames = b"".join(
+            struct.pack(
+                "<h",
+                int(3000 * math.sin(2 * math.pi * frequency * i / self.sampling_rate)),
+            )
+            for i in range(num_frames)
+        )
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sampling_rate)
+            wav.writeframes(frames)
+        return buffer.getvalue()
+
+
+def install_stub_voicevox_core() -> None:
+    module = types.ModuleType("voicevox_core")
+    module.VoicevoxCore = StubVoicevoxCore  # type: ignore
+    sys.modules["voicevox_core"] = module
+
+
+def loadable_shared_library_path() -> str:
+    # VoiceVoxAudioGenerator は onnxruntime を CDLL で読み込むため、代わりに読み込み済みの共有ライブラリを渡す
+    import _ctypes
+
+    return str(_ctypes.__file__)
+
+
+def attach_stub_openai(generator: Any, client: Optional[StubOpenAI]) -> None:
+    if client is None:
+        return
+    async_client = StubAsyncOpenAI(client)
+    if hasattr(generator, "openai_client"):
+        generator.openai_client = client
+    if hasattr(generator, "async_openai_client"):
+        generator.async_openai_client = async_client
+    if hasattr(generator, "image_generator"):
+        generator.image_generator.openai_client = client
+        generator.image_generator.async_openai_client = async_client
@@ -0,0 +1,259 @@
+import argparse
+import logging
+import os
+import re
+from logging import getLogger
+from typing import Optional
+
+import ulid
+
+from src.command import batch_cmd, manuscripts_cmd
+from src.command.batch import load_job_specs
+from src.server import render_worker_cmd, serve_cmd
+from src.util import ResourceBudget, parse_size
+from src.worker import JobQueue, run_worker_pool
+
+logger = getLogger(__name__)
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def add_budget_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cpu-budget", type=int, help="同時に使用するCPU数の上限 (ガバナーを有効化)"
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        help="同時に使用するメモリの上限。例: 8G (ガバナーを有効化)",
+    )
+    parser.add_argument(
+        "--subprocess-budget",
+        type=int,
+        help="同時に起動する ffmpeg などの子プロセス数の上限 (ガバナーを有効化)",
+    )
+
+
+def build_budget(args: argparse.Namespace) -> Optional[ResourceBudget]:
+    # 予算がひとつも指定されていない場合はガバナーを利用しない。未指定の予算はホストの性能から決める
+    budget: ResourceBudget = {
+        "cpu": args.cpu_budget,
+        "memory_bytes": args.memory_budget,
+        "subprocesses": args.subprocess_budget,
+    }
+    if all(value is None for value in budget.values()):
+        return None
+    return budget
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Shoorter のコマンドライン実行")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = subparsers.add_parser(
+        "batch", help="ジョブファイルに記載された複数のテーマの動画をまとめて生成する"
+    )
+    batch_parser.add_argument("jobs_file", help="ジョブ一覧を記載したJSONファイル")
+    batch_parser.add_argument("--output-dir", required=True, help="出力先ディレクトリ")
+    batch_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="並列に実行するワーカープロセス数",
+    )
+    batch_parser.add_argument(
+        "--no-cache", action="store_true", help="前回の生成結果を再利用しない"
+    )
+    add_budget_arguments(batch_parser)
+
+    manuscripts_parser = subparsers.add_parser(
+        "manuscripts", help="複数のテーマの原稿のみを並行してまとめて生成する"
+    )
+    manuscripts_parser.add_argument("themes", nargs="+", help="原稿のテーマ")
+    manuscripts_parser.add_argument(
+        "--type", choices=["trivia", "bulletin"], default="trivia", help="動画の種類"
+    )
+    manuscripts_parser.add_argument(
+        "--output-dir", required=True, help="出力先ディレクトリ"
+    )
+    manuscripts_parser.add_argument(
+        "--concurrency", type=int, default=4, help="同時に生成する原稿の数"
+    )
+    manuscripts_parser.add_argument(
+        "--num-trivia", type=int, default=10, help="雑学紹介動画のトリビアの数"
+    )
+    manuscripts_parser.add_argument(
+        "--trivia-shards",
+        type=int,
+        default=1,
+        help="トリビアを分割して並行に生成するリクエスト数",
+    )
+
+    submit_parser = subparsers.add_parser(
+        "submit", help="ジョブファイルに記載されたジョブをキューに投入する"
+    )
+    submit_parser.add_argument("jobs_file", help="ジョブ一覧を記載したJSONファイル")
+    submit_parser.add_argument("--db", required=True, help="キューのSQLiteファイル")
+    submit_parser.add_argument("--output-dir", required=True, help="出力先ディレクトリ")
+    submit_parser.add_argument("--tenant", default="default", help="テナント名")
+    submit_parser.add_argument(
+        "--priority", type=int, default=0, help="優先度 (大きいほど優先)"
+    )
+    submit_parser.add_argument(
+        "--max-attempts", type=int, default=3, help="失敗時を含めた最大試行回数"
+    )
+
+    worker_parser = subparsers.add_parser(
+        "worker", help="キューからジョブを取り出して処理し続ける"
+    )
+    worker_parser.add_argument("--db", required=True, help="キューのSQLiteファイル")
+    worker_parser.add_argument(
+        "--workers", type=int, default=1, help="起動するワーカープロセス数"
+    )
+    worker_parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=120.0,
+        help="ハートビートが途絶えたジョブをキューに戻すまでの秒数",
+    )
+    add_budget_arguments(worker_parser)
+
+    status_parser = subparsers.add_parser("status", help="キュー内のジョブを一覧する")
+    status_parser.add_argument("--db", required=True, help="キューのSQLiteファイル")
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="HTTP API でジョブを受け付けて生成するサーバーを起動する"
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1", help="待ち受けるホスト")
+    serve_parser.add_argument("--port", type=int, default=8000, help="待ち受けるポート")
+    serve_parser.add_argument("--output-dir", required=True, help="出力先ディレクトリ")
+    serve_parser.add_argument(
+        "--workers", type=int, default=1, help="同時に生成するジョブ数"
+    )
+    serve_parser.add_argument(
+        "--max-queued", type=int, default=100, help="待機できるジョブ数の上限"
+    )
+    serve_parser.add_argument(
+        "--input-dir",
+        default=".",
+        help="ジョブで指定するフォント・BGM・画像などのファイルを置くディレクトリ。ジョブのパスはこの中に限る",
+    )
+    serve_parser.add_argument(
+        "--job-retention",
+        type=float,
+        default=3600.0,
+        help="終了したジョブの状態を保持する秒数",
+    )
+    serve_parser.add_argument(
+        "--no-cache", action="store_true", help="前回の生成結果を再利用しない"
+    )
+    add_budget_arguments(serve_parser)
+
+    render_worker_parser = subparsers.add_parser(
+        "render-worker", help="動画の区間の書き出しを HTTP で受け付けるノードを起動する"
+    )
+    render_worker_parser.add_argument(
+        "--host", default="127.0.0.1", help="待ち受けるホスト"
+    )
+    render_worker_parser.add_argument(
+        "--port", type=int, default=8100, help="待ち受けるポート"
+    )
+    render_worker_parser.add_argument(
+        "--cache-dir", required=True, help="受信した素材を保存するディレクトリ"
+    )
+    render_worker_parser.add_argument(
+        "--slots", type=int, default=1, help="同時に書き出す区間の数"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "batch":
+        results = batch_cmd(
+            jobs_file_path=args.jobs_file,
+            output_dir=args.output_dir,
+            num_workers=args.workers,
+            logger=logger,
+            use_cache=not args.no_cache,
+            budget=build_budget(args),
+        )
+        if any(result["status"] == "failed" for result in results):
+            raise SystemExit(1)
+    elif args.command == "manuscripts":
+        openai_api_key = os.environ.get("OPENAI_API_KEY")
+        if not openai_api_key:
+            raise SystemExit("環境変数OPENAI_API_KEYを指定してください")
+        manuscript_results = manuscripts_cmd(
+            type=args.type,
+            themes=args.themes,
+            output_dir=args.output_dir,
+            openai_api_key=openai_api_key,
+            logger=logger,
+            num_trivia=args.num_trivia,
+            num_trivia_shards=args.trivia_shards,
+            max_concurrency=args.concurrency,
+        )
+        if any(result["manuscript"] is None for result in manuscript_results):
+            raise SystemExit(1)
+    elif args.command == "submit":
+        queue = JobQueue(args.db)
+        for spec in load_job_specs(args.jobs_file):
+            # 再試行時に同じディレクトリのキャッシュを利用できるよう、出力先はジョブごとに固定する
+            job_id = str(ulid.new())
+            name = re.sub(r"[^0-9A-Za-z_.-]+", "_", spec.name or spec.type)
+            queue.submit(
+                spec=spec.dict(),
+                output_dir=os.path.abspath(
+                    os.path.join(args.output_dir, f"{job_id}_{name}")
+                ),
+                job_id=job_id,
+                tenant=args.tenant,
+                priority=args.priority,
+                max_attempts=args.max_attempts,
+            )
+            print(job_id)
+    elif args.command == "worker":
+        run_worker_pool(
+            db_path=args.db,
+            num_workers=args.workers,
+            logger=logger,
+            lease_seconds=args.lease_seconds,
+            budget=build_budget(args),
+        )
+    elif args.command == "serve":
+        serve_cmd(
+            host=args.host,
+            port=args.port,
+            output_dir=args.output_dir,
+            num_workers=args.workers,
+            logger=logger,
+            max_queued=args.max_queued,
+            use_cache=not args.no_cache,
+            budget=build_budget(args),
+            retention=args.job_retention,
+            input_dir=args.input_dir,
+        )
+    elif args.command == "render-worker":
+        render_worker_cmd(
+            host=args.host,
+            port=args.port,
+            cache_dir=args.cache_dir,
+            slots=args.slots,
+            logger=logger,
+        )
+    elif args.command == "status":
+        queue = JobQueue(args.db)
+        for job in queue.jobs():
+            stages = ", ".join(
+                f"{stage['stage']}:{stage['status']}"
+                for stage in queue.stages(job["id"])
+            )
+            print(
+                f"{job['id']} {job['tenant']} p={job['priority']} {job['status']} "
+                f"attempts={job['attempts']}/{job['max_attempts']} [{stages}]"
+                + (f" error={job['error']}" if job["error"] else "")
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import logging
 import os
 import sys
+import threading
+import time
 from logging import getLogger
 
 import flet as ft
@@ -18,6 +20,13 @@ from src.module.movie_generator import (
 from src.module.thumbnail_generator import (
     IThumbnailGenerator,
 )
+from src.pipeline import (
+    Stage,
+    StageGraphExecutor,
+    StageHistory,
+    build_artifact_cache,
+    build_stages,
+)
 from src.util.flet import file_picker_row
 from src.util.license import (
     FFMPEG_LICENSE,
@@ -26,6 +35,8 @@ from src.util.license import (
     SELF_SOURCE_CODE,
     VOICEVOX_LICENSE,
 )
+from src.util.llm_cache import attach_llm_cache, get_llm_cache
+from src.util.progress import ProgressReporter
 
 logger = getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -63,6 +74,10 @@ SPEAKER_MAP = {
     "聖騎士 紅桜": 51,
 }
 
+NUM_TRIVIA = 10
+# 分割して生成する場合のリクエスト数
+NUM_TRIVIA_SHARDS = 3
+
 
 def main(page: ft.Page) -> None:
     page.title = "Shoorter"
@@ -93,12 +108,18 @@ def app(page: ft.Page) -> ft.Stack:
         page, is_directory=True, label="出力先ディレクトリ:"
     )
 
+    use_cache_checkbox = ft.Checkbox(
+        label="前回の生成結果を再利用する (入力が変わったステップから再開します)",
+        value=True,
+    )
+
     common_setting_column = ft.Column(
         [
             ft.Text("共通設定", size=24, weight="bold"),
             openai_apikey_input,
             font_path_select,
             output_dir_row,
+            use_cache_checkbox,
         ],
         spacing=10,
         scroll="adaptive",
@@ -109,6 +130,7 @@ def app(page: ft.Page) -> ft.Stack:
         openai_api_key_input=openai_apikey_input,
         font_path_select=font_path_select,
         output_dir_item=output_dir_item,
+        use_cache_checkbox=use_cache_checkbox,
     )
 
     trivia_setting_column = trivia_setting(
@@ -116,6 +138,7 @@ def app(page: ft.Page) -> ft.Stack:
         openai_api_key_input=openai_apikey_input,
         font_path_select=font_path_select,
         output_dir_item=output_dir_item,
+        use_cache_checkbox=use_cache_checkbox,
     )
 
     log_output_column = log_output(page)
@@ -186,6 +209,7 @@ def bulletin_setting(
     openai_api_key_input: ft.TextField,
     output_dir_item: ft.Text,
     font_path_select: ft.Dropdown,
+    use_cache_checkbox: ft.Checkbox,
 ) -> ft.Column:
     # フォームの構成
     theme_input = ft.TextField(
@@ -256,23 +280,31 @@ def bulletin_setting(
                 font_path=FONT_MAP[font_path_select.value],
                 logger=logger,
             )
-            pipeline(
-                page=page,
-                progress_bar=progress_bar,
-                progress_bar_label=progress_bar_label,
-                action_button=action_button,
-                error_message=error_message,
-                manuscript_genetrator=manuscript_genetrator,
-                audio_generator=audio_generator,
-                thumbnail_generator=thumbnail_generator,
-                movie_generator=movie_generator,
-            )
+            # 生成には数分かかるため、イベントハンドラをブロックしないよう別スレッドで実行する
+            threading.Thread(
+                target=pipeline,
+                kwargs={
+                    "page": page,
+                    "progress_bar": progress_bar,
+                    "progress_bar_label": progress_bar_label,
+                    "action_button": action_button,
+                    "cancel_button": cancel_button,
+                    "error_message": error_message,
+                    "manuscript_genetrator": manuscript_genetrator,
+                    "audio_generator": audio_generator,
+                    "thumbnail_generator": thumbnail_generator,
+                    "movie_generator": movie_generator,
+                    "use_cache": bool(use_cache_checkbox.value),
+                },
+                daemon=True,
+            ).start()
         except Exception as e:
             error_message.value = f"エラーが発生しました: {str(e)}"
             page.snack_bar.open = True
             page.update()
 
     action_button = ft.ElevatedButton(text="動画生成", on_click=generate_video)
+    cancel_button = ft.ElevatedButton(text="キャンセル", visible=False)
 
     return ft.Column(
         [
@@ -280,6 +312,7 @@ def bulletin_setting(
                 [
                     ft.Text("掲示板風動画生成", size=24, weight="bold"),
                     action_button,
+                    cancel_button,
                 ],
                 alignment="spaceBetween",
             ),
@@ -307,6 +340,7 @@ def trivia_setting(
     openai_api_key_input: ft.TextField,
     output_dir_item: ft.Text,
     font_path_select: ft.Dropdown,
+    use_cache_checkbox: ft.Checkbox,
 ) -> ft.Column:
     # フォームの構成
     theme_input = ft.TextField(
@@ -326,6 +360,11 @@ def trivia_setting(
         width=400,
     )
 
+    shard_checkbox = ft.Checkbox(
+        label="トリビアを分割して並行に生成する (原稿の生成が速くなります)",
+        value=False,
+    )
+
     error_message = ft.Text("", color="red")
     page.snack_bar = ft.SnackBar(
         content=error_message,
@@ -359,7 +398,8 @@ def trivia_setting(
             ) = trivia_cmd(
                 themes=[theme_input.value],
                 speaker_id=SPEAKER_MAP[speaker_select.value],
-                num_trivia=10,
+                num_trivia=NUM_TRIVIA,
+                num_shards=NUM_TRIVIA_SHARDS if shard_checkbox.value else 1,
                 openai_api_key=openai_api_key_input.value,
                 output_dir=output_dir_item.value,
                 onnxruntime_lib_path=onnxruntime_lib_path,
@@ -368,23 +408,31 @@ def trivia_setting(
                 font_path=FONT_MAP[font_path_select.value],
                 logger=logger,
             )
-            pipeline(
-                page=page,
-                progress_bar=progress_bar,
-                progress_bar_label=progress_bar_label,
-                action_button=action_button,
-                error_message=error_message,
-                manuscript_genetrator=manuscript_genetrator,
-                audio_generator=audio_generator,
-                thumbnail_generator=thumbnail_generator,
-                movie_generator=movie_generator,
-            )
+            # 生成には数分かかるため、イベントハンドラをブロックしないよう別スレッドで実行する
+            threading.Thread(
+                target=pipeline,
+                kwargs={
+                    "page": page,
+                    "progress_bar": progress_bar,
+                    "progress_bar_label": progress_bar_label,
+                    "action_button": action_button,
+                    "cancel_button": cancel_button,
+                    "error_message": error_message,
+                    "manuscript_genetrator": manuscript_genetrator,
+                    "audio_generator": audio_generator,
+                    "thumbnail_generator": thumbnail_generator,
+                    "movie_generator": movie_generator,
+                    "use_cache": bool(use_cache_checkbox.value),
+                },
+                daemon=True,
+            ).start()
         except Exception as e:
             error_message.value = f"エラーが発生しました: {str(e)}"
             page.snack_bar.open = True
             page.update()
 
     action_button = ft.ElevatedButton(text="動画生成", on_click=generate_video)
+    cancel_button = ft.ElevatedButton(text="キャンセル", visible=False)
 
     return ft.Column(
         [
@@ -392,6 +440,7 @@ def trivia_setting(
                 [
                     ft.Text("雑学紹介動画生成", size=24, weight="bold"),
                     action_button,
+                    cancel_button,
                 ],
                 alignment="spaceBetween",
             ),
@@ -405,6 +454,7 @@ def trivia_setting(
             ),
             theme_input,
             speaker_select,
+            shard_checkbox,
             bgm_image_dir_row,
         ],
         spacing=10,
@@ -482,87 +532,172 @@ def license_dialog(
     return button
 
 
+PROGRESS_UNIT_LABELS = {"clip": "クリップ", "image": "画像", "frame": "フレーム"}
+
+
+def format_remaining(seconds: float | None) -> str:
+    if seconds is None:
+        return ""
+    if seconds < 1:
+        return " (まもなく完了)"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f" (残り約{minutes}分{seconds}秒)" if minutes else f" (残り約{seconds}秒)"
+
+
 def pipeline(
     page: ft.Page,
     progress_bar: ft.ProgressBar,
     progress_bar_label: ft.Text,
     action_button: ft.ElevatedButton,
+    cancel_button: ft.ElevatedButton,
     error_message: ft.Text,
     manuscript_genetrator: IManuscriptGenerator,
     audio_generator: IAudioGenerator,
     thumbnail_generator: IThumbnailGenerator,
     movie_generator: IMovieGenerator,
+    use_cache: bool,
 ) -> None:
+    progress_lock = threading.Lock()
+    running_stages: list[Stage] = []
+    completed_stages: list[Stage] = []
+    stage_progress: dict[str, tuple[str, int, int]] = {}
+    last_updated_at = [0.0]
+    # ステージの失敗時にも実行中の他のステージは中断されるため、ユーザーによるキャンセルは別に記録する
+    cancelled_by_user = threading.Event()
+    finished = threading.Event()
+    executor: list[StageGraphExecutor] = []
+
+    def update_progress() -> None:
+        # 過去の所要時間から予測した残り時間を表示する
+        estimate = executor[0].estimate() if executor else None
+        with progress_lock:
+            labels = []
+            fraction = float(len(completed_stages))
+            for stage in running_stages:
+                stage_estimate = (
+                    estimate["stages"].get(stage.name) if estimate is not None else None
+                )
+                remaining = format_remaining(
+                    stage_estimate["remaining"] if stage_estimate is not None else None
+                )
+                if stage.name in stage_progress:
+                    unit, done, total = stage_progress[stage.name]
+                    labels.append(
+                        f"{stage.label}中... {done}/{total}{PROGRESS_UNIT_LABELS.get(unit, unit)}{remaining}"
+                    )
+                    fraction += done / total if total > 0 else 0
+                else:
+                    labels.append(f"{stage.label}中...{remaining}")
+            if estimate is not None and estimate["remaining"] is not None:
+                labels.append(f"全体{format_remaining(estimate['remaining'])}")
+            if not cancelled_by_user.is_set():
+                progress_bar_label.value = " / ".join(labels)
+            progress_bar.value = fraction / len(stages)
+            last_updated_at[0] = time.monotonic()
+        page.update()
+
+    def on_stage_start(stage: Stage) -> None:
+        with progress_lock:
+            running_stages.append(stage)
+        update_progress()
+
+    def on_stage_end(stage: Stage) -> None:
+        with progress_lock:
+            running_stages.remove(stage)
+            completed_stages.append(stage)
+            stage_progress.pop(stage.name, None)
+        update_progress()
+
+    def on_progress(stage_name: str | None, unit: str, done: int, total: int) -> None:
+        if stage_name is None:
+            return
+        with progress_lock:
+            stage_progress[stage_name] = (unit, done, total)
+            # フレーム単位の通知で画面更新が詰まらないよう間引く
+            if done < total and time.monotonic() - last_updated_at[0] < 0.2:
+                return
+        update_progress()
+
+    def on_cancel(e: ft.ControlEvent) -> None:
+        cancelled_by_user.set()
+        progress.cancel()
+        cancel_button.disabled = True
+        progress_bar_label.value = "キャンセル中..."
+        page.update()
+
+    def refresh_periodically() -> None:
+        # 進捗の通知がないステージでも残り時間の表示を更新する
+        while not finished.wait(1.0):
+            update_progress()
+
+    progress = ProgressReporter(on_progress=on_progress)
+
     try:
         progress_bar.visible = True
         progress_bar.value = 0
         progress_bar_label.visible = True
         action_button.visible = False
+        cancel_button.on_click = on_cancel
+        cancel_button.disabled = False
+        cancel_button.visible = True
         page.update()
 
-        logger.info("Step1: 原稿生成")
-        try:
-            progress_bar_label.value = "原稿生成中..."
-            page.update()
-
-            manuscript = manuscript_genetrator.generate()
-
-            progress_bar.value = 0.25
-            page.update()
-        except Exception as e:
-            logger.error(f"原稿生成中にエラーが発生しました。 {e}")
-            raise Exception(f"原稿生成中にエラーが発生しました。 {e}")
-
-        logger.info("Step2: 音声合成")
-        try:
-            progress_bar_label.value = "音声合成中..."
-            page.update()
-
-            audio = audio_generator.generate(manuscript)
-
-            progress_bar.value = 0.5
-            page.update()
-        except Exception as e:
-            logger.error(f"音声合成中にエラーが発生しました。 {e}")
-            raise Exception(f"音声合成中にエラーが発生しました。 {e}")
-
-        logger.info("Step3: サムネイル生成")
-        try:
-            progress_bar_label.value = "サムネイル生成中..."
-            page.update()
-
-            thumbnail_generator.generate(manuscript)
-
-            progress_bar.value = 0.75
-            page.update()
-        except Exception as e:
-            logger.error(f"サムネイル生成中にエラーが発生しました。 {e}")
-            raise Exception(f"サムネイル生成中にエラーが発生しました。 {e}")
-
-        logger.info("Step4: 動画生成")
+        if use_cache:
+            # 同じテーマで作り直す場合は GPT の応答も再利用する
+            llm_cache = get_llm_cache()
+            for generator in [
+                manuscript_genetrator,
+                audio_generator,
+                thumbnail_generator,
+                movie_generator,
+            ]:
+                attach_llm_cache(generator, llm_cache)
+
+        stages = build_stages(
+            manuscript_generator=manuscript_genetrator,
+            audio_generator=audio_generator,
+            thumbnail_generator=thumbnail_generator,
+            movie_generator=movie_generator,
+        )
+
+        # 原稿にのみ依存する音声合成とサムネイル生成は並行して実行する
+        executor.append(
+            StageGraphExecutor(
+                stages=stages,
+                logger=logger,
+                on_stage_start=on_stage_start,
+                on_stage_end=on_stage_end,
+                cache=build_artifact_cache(movie_generator.output_dir, logger)
+                if use_cache
+                else None,
+                trace_path=os.path.join(movie_generator.output_dir, "trace.json"),
+                progress=progress,
+                history=StageHistory(),
+            )
+        )
+        threading.Thread(target=refresh_periodically, daemon=True).start()
         try:
-            progress_bar_label.value = "動画生成中..."
-            page.update()
-
-            movie_generator.generate(manuscript, audio)
-
-            progress_bar.value = 1
-            page.update()
-        except Exception as e:
-            logger.error(f"動画生成中にエラーが発生しました。 {e}")
-            raise Exception(f"動画生成中にエラーが発生しました。 {e}")
+            executor[0].run()
+        finally:
+            finished.set()
 
         logger.info("すべてのステップを正常に終了しました")
         progress_bar.visible = False
         progress_bar_label.visible = False
         action_button.visible = True
+        cancel_button.visible = False
         page.update()
 
     except Exception as e:
         progress_bar.visible = False
         progress_bar_label.visible = False
         action_button.visible = True
-        error_message.value = f"エラーが発生しました。 {str(e)}"
+        cancel_button.visible = False
+        if cancelled_by_user.is_set():
+            logger.info("動画生成をキャンセルしました")
+            error_message.value = "動画生成をキャンセルしました。"
+        else:
+            error_message.value = f"エラーが発生しました。 {str(e)}"
         page.snack_bar.open = True
         page.update()
 
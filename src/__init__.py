@@ -1,3 +1,6 @@
 from . import command as command
 from . import module as module
+from . import pipeline as pipeline
+from . import server as server
 from . import util as util
+from . import worker as worker
@@ -1,2 +1,13 @@
+from .batch import batch_cmd as batch_cmd
 from .bulletin import bulletin_cmd as bulletin_cmd
-from .trivia import trivia_cmd as trivia_cmd
\ No newline at end of file
+from .job import JOB_RESOURCES as JOB_RESOURCES
+from .job import JobSpec as JobSpec
+from .job import build_generators as build_generators
+from .job import build_job_executor as build_job_executor
+from .job import run_job as run_job
+from .job import run_job_async as run_job_async
+from .manuscripts import manuscripts_cmd as manuscripts_cmd
+from .trivia import trivia_cmd as trivia_cmd
+from .warmup import warm_up as warm_up
+from .warmup import warm_up_for_spec as warm_up_for_spec
+from .warmup import warm_up_with_defaults as warm_up_with_defaults
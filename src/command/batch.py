@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, TypedDict
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from util import ResourceBudget, ResourceGovernor  # noqa: E402
+
+from .job import JobSpec, run_job  # noqa: E402
+from .warmup import warm_up_for_spec  # noqa: E402
+
+
+class BatchJobResult(TypedDict):
+    name: str
+    output_dir: str
+    status: str
+    elapsed: float
+    error: str | None
+
+
+def load_job_specs(jobs_file_path: str) -> List[JobSpec]:
+    # {"defaults": {...}, "jobs": [{...}, ...]} もしくはジョブの配列を受け付ける
+    with open(jobs_file_path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    if isinstance(data, list):
+        data = {"defaults": {}, "jobs": data}
+    defaults = data.get("defaults", {})
+    return [JobSpec.parse_obj({**defaults, **job}) for job in data["jobs"]]
+
+
+def job_output_dir_name(index: int, spec: JobSpec) -> str:
+    name = spec.name or spec.type
+    return f"{index:04d}_{re.sub(r'[^0-9A-Za-z_.-]+', '_', name)}"
+
+
+def warm_up_batch_worker(
+    spec_data: Optional[Dict[str, Any]], budget: Optional[ResourceBudget]
+) -> None:
+    # ワーカープロセスの起動時に一度だけ実行され、以降のジョブは初期化済みの状態で始まる
+    if spec_data is None:
+        return
+    warm_up_for_spec(
+        JobSpec.parse_obj(spec_data),
+        logging.getLogger(f"batch.worker.{os.getpid()}"),
+        governor=ResourceGovernor(**budget) if budget is not None else None,
+    )
+
+
+def run_batch_job(
+    spec_data: Dict[str, Any],
+    output_dir: str,
+    use_cache: bool,
+    budget: Optional[ResourceBudget] = None,
+) -> BatchJobResult:
+    # ワーカープロセス内で実行されるため、ロガーはジョブごとに用意する
+    spec = JobSpec.parse_obj(spec_data)
+    name = os.path.basename(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    logger = logging.getLogger(f"batch.{name}")
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(output_dir, "job.log"), encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+
+    start = time.perf_counter()
+    try:
+        run_job(
+            spec=spec,
+            output_dir=output_dir,
+            logger=logger,
+            use_cache=use_cache,
+            governor=ResourceGovernor(**budget, logger=logger)
+            if budget is not None
+            else None,
+        )
+        return {
+            "name": name,
+            "output_dir": output_dir,
+            "status": "succeeded",
+            "elapsed": time.perf_counter() - start,
+            "error": None,
+        }
+    except Exception as e:
+        logger.error(f"ジョブが失敗しました: {e}")
+        return {
+            "name": name,
+            "output_dir": output_dir,
+            "status": "failed",
+            "elapsed": time.perf_counter() - start,
+            "error": str(e),
+        }
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def batch_cmd(
+    jobs_file_path: str,
+    output_dir: str,
+    num_workers: int,
+    logger: logging.Logger,
+    use_cache: bool = True,
+    budget: Optional[ResourceBudget] = None,
+) -> List[BatchJobResult]:
+    specs = load_job_specs(jobs_file_path)
+    logger.info(f"{len(specs)}件のジョブを{num_workers}プロセスで実行します")
+    # 未指定の予算をホストの性能から補い、ワーカープロセスごとに等分する。各プロセスの予算は固定となる
+    worker_budget = (
+        ResourceGovernor(**budget).split(num_workers) if budget is not None else None
+    )
+
+    start = time.perf_counter()
+    results: List[BatchJobResult] = []
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=warm_up_batch_worker,
+        initargs=(specs[0].dict() if specs else None, worker_budget),
+    ) as pool:
+        futures = [
+            pool.submit(
+                run_batch_job,
+                spec.dict(),
+                os.path.join(output_dir, job_output_dir_name(index, spec)),
+                use_cache,
+                worker_budget,
+            )
+            for index, spec in enumerate(specs)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "succeeded":
+                logger.info(
+                    f"[{len(results)}/{len(specs)}] {result['name']}: 完了 ({result['elapsed']:.1f}s)"
+                )
+            else:
+                logger.error(
+                    f"[{len(results)}/{len(specs)}] {result['name']}: 失敗 {result['error']}"
+                )
+    elapsed = time.perf_counter() - start
+
+    print_summary(results, elapsed, num_workers)
+    return results
+
+
+def print_summary(
+    results: List[BatchJobResult], elapsed: float, num_workers: int
+) -> None:
+    succeeded = [r for r in results if r["status"] == "succeeded"]
+    failed = [r for r in results if r["status"] == "failed"]
+    job_times = [r["elapsed"] for r in succeeded]
+
+    print("==== バッチ実行結果 ====")
+    print(f"ワーカー数      : {num_workers}")
+    print(
+        f"ジョブ数        : {len(results)} (成功 {len(succeeded)} / 失敗 {len(failed)})"
+    )
+    print(f"総経過時間      : {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"スループット    : {len(succeeded) / elapsed * 3600:.1f} 本/時")
+    if job_times:
+        print(f"ジョブ時間 平均 : {statistics.mean(job_times):.1f}s")
+        print(f"ジョブ時間 中央 : {statistics.median(job_times):.1f}s")
+        print(f"ジョブ時間 最大 : {max(job_times):.1f}s")
+    for result in failed:
+        print(f"失敗: {result['name']}: {result['error']}")
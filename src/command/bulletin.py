@@ -13,6 +13,8 @@ from module.manuscript_generator import (  # noqa: E402
     PseudoBulletinBoardManuscriptGenerator,
 )
 from module.movie_generator import (  # noqa: E402
+    INTRO_DURATION,
+    SHORTS_MAX_DURATION,
     IMovieGenerator,
     IrasutoyaShortMovieGenerator,
 )
@@ -53,6 +55,8 @@ def bulletin_cmd(
         output_dir=output_dir,
         onnxruntime_lib_path=onnxruntime_lib_path,
         open_jtalk_dict_dir_path=open_jtalk_dict_dir_path,
+        # 冒頭の概要を除いた時間に収まらない文章は、動画で紹介されないため合成しない
+        duration_budget=SHORTS_MAX_DURATION - INTRO_DURATION,
     )
 
     thumbnail_generator = DalleThumbnailGenerator(
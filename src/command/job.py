@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import os
+import sys
+from typing import Any, Callable, Dict, List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from module.audio_generator import IAudioGenerator  # noqa: E402
+from module.manuscript_generator import (  # noqa: E402
+    DeduplicatingManuscriptGenerator,
+    IManuscriptGenerator,
+    ManuscriptIndex,
+)
+from module.movie_generator import (  # noqa: E402
+    IMovieGenerator,
+    LocalSegmentRenderer,
+    RemoteSegmentRenderer,
+)
+from module.thumbnail_generator import IThumbnailGenerator  # noqa: E402
+from pipeline import (  # noqa: E402
+    DEFAULT_HISTORY_PATH,
+    Stage,
+    StageGraphExecutor,
+    StageHistory,
+    build_artifact_cache,
+    build_stages,
+)
+from util import (  # noqa: E402
+    Cassette,
+    CassetteMode,
+    ProgressReporter,
+    ResourceDemand,
+    ResourceGovernor,
+    attach_cassette,
+    attach_llm_cache,
+    default_onnxruntime_lib_path,
+    get_llm_cache,
+)
+
+from .bulletin import bulletin_cmd  # noqa: E402
+from .trivia import trivia_cmd  # noqa: E402
+
+# ジョブの受け入れ時に確保する予算。ステージの実行中はステージごとの予算を別に確保する
+JOB_RESOURCES: ResourceDemand = {
+    "cpu": 0,
+    "memory_bytes": 512 * 1024**2,
+    "subprocesses": 0,
+}
+
+
+class JobSpec(BaseModel):
+    type: Literal["bulletin", "trivia"] = Field(description="生成する動画の種類")
+    theme: str = Field(description="動画のテーマ")
+    name: Optional[str] = Field(
+        None, description="出力ディレクトリ名に利用するジョブ名"
+    )
+    openai_api_key: Optional[str] = Field(
+        None,
+        description="OpenAIのAPIキー。未指定の場合は環境変数OPENAI_API_KEYを利用する",
+    )
+    font_path: str = Field(description="フォントファイルのパス")
+    bgm_file_path: str = Field(description="BGMファイルのパス")
+    onnxruntime_lib_path: str = Field(
+        default_factory=default_onnxruntime_lib_path,
+        description="ONNX Runtimeのライブラリのパス",
+    )
+    open_jtalk_dict_dir_path: str = Field(
+        "assets/open_jtalk_dic_utf_8-1.11", description="Open JTalkの辞書ディレクトリ"
+    )
+    # 掲示板風動画の設定
+    man_image_dir: Optional[str] = Field(None, description="男性画像ディレクトリ")
+    woman_image_dir: Optional[str] = Field(None, description="女性画像ディレクトリ")
+    bgv_file_path: Optional[str] = Field(None, description="背景動画ファイルのパス")
+    # 雑学紹介動画の設定
+    speaker_id: Optional[int] = Field(None, description="VOICEVOXの話者ID")
+    num_trivia: int = Field(10, description="生成するトリビアの数")
+    trivia_shards: int = Field(
+        1,
+        description="トリビアを分割して並行に生成するリクエスト数。2以上の場合は重複を除いて1つの原稿にまとめる",
+    )
+    # 外部 API の記録・再生の設定
+    cassette_dir: Optional[str] = Field(
+        None,
+        description="OpenAIとVOICEVOXの応答を記録・再生するディレクトリ",
+    )
+    cassette_mode: CassetteMode = Field(
+        "auto",
+        description="auto: 記録があれば再生し、なければ記録する / record: 常に記録し直す / replay: 記録のみを利用する",
+    )
+    # GPT の応答のキャッシュの設定
+    use_llm_cache: bool = Field(
+        True,
+        description="同じリクエストに対する GPT の応答を ~/.shoorter/llm_cache.sqlite3 から再利用する",
+    )
+    # 原稿の重複検出の設定
+    deduplicate_manuscript: bool = Field(
+        False,
+        description="過去に生成した原稿とほぼ同じ内容の原稿を、音声合成の前に生成し直す",
+    )
+    manuscript_similarity_threshold: float = Field(
+        0.5, description="重複とみなす原稿の類似度 (0から1)"
+    )
+    stream_manuscript: bool = Field(
+        False,
+        description="原稿を逐次受け取り、完成した文章から生成の完了を待たずに音声合成を始める",
+    )
+    # 計測の設定
+    resource_report: bool = Field(
+        False,
+        description="ステップごとのメモリ・CPU時間・ディスクI/O・子プロセス数を計測し、resource_report.json に書き出す",
+    )
+    profile_stages: List[str] = Field(
+        [],
+        description="Pythonのスタックを採取するステージ名 (manuscript, audio, thumbnail, movie)",
+    )
+    # 中間ファイルの設定
+    scratch_dir: Optional[str] = Field(
+        None,
+        description="中間ファイルを置くディレクトリ。/dev/shm などの tmpfs を指定できる。未指定の場合は環境変数SHOORTER_SCRATCH_DIRまたは一時ディレクトリを利用する",
+    )
+    # 動画の書き出しの設定
+    render_workers: List[str] = Field(
+        [],
+        description="動画の区間を書き出すノードのURL (cli.py render-worker)。指定した場合はノードに分担させる",
+    )
+    render_processes: int = Field(
+        0,
+        description="動画の区間を書き出すローカルのプロセス数。2以上の場合のみ区間に分けて書き出す",
+    )
+
+
+def build_generators(
+    spec: JobSpec, output_dir: str, logger: logging.Logger
+) -> tuple[
+    IManuscriptGenerator,
+    IAudioGenerator,
+    IThumbnailGenerator,
+    IMovieGenerator,
+]:
+    openai_api_key = spec.openai_api_key or os.environ.get("OPENAI_API_KEY")
+    if not openai_api_key and spec.cassette_dir and spec.cassette_mode == "replay":
+        # 記録のみを利用する場合は API を呼び出さないため、APIキーは不要
+        openai_api_key = "sk-replay"
+    if not openai_api_key:
+        raise ValueError("OpenAIのAPIキーが指定されていません。")
+
+    if spec.type == "bulletin":
+        if not all([spec.man_image_dir, spec.woman_image_dir, spec.bgv_file_path]):
+            raise ValueError(
+                "掲示板風動画生成には男性画像ディレクトリ、女性画像ディレクトリ、背景動画ファイルが必要です。"
+            )
+        return bulletin_cmd(
+            themes=[spec.theme],
+            openai_api_key=openai_api_key,
+            output_dir=output_dir,
+            onnxruntime_lib_path=spec.onnxruntime_lib_path,
+            open_jtalk_dict_dir_path=spec.open_jtalk_dict_dir_path,
+            man_image_dir=str(spec.man_image_dir),
+            woman_image_dir=str(spec.woman_image_dir),
+            bgm_file_path=spec.bgm_file_path,
+            bgv_file_path=str(spec.bgv_file_path),
+            font_path=spec.font_path,
+            logger=logger,
+        )
+
+    if spec.speaker_id is None:
+        raise ValueError("雑学紹介動画生成には話者IDが必要です。")
+    return trivia_cmd(
+        themes=[spec.theme],
+        speaker_id=spec.speaker_id,
+        num_trivia=spec.num_trivia,
+        num_shards=spec.trivia_shards,
+        openai_api_key=openai_api_key,
+        output_dir=output_dir,
+        onnxruntime_lib_path=spec.onnxruntime_lib_path,
+        open_jtalk_dict_dir_path=spec.open_jtalk_dict_dir_path,
+        bgm_file_path=spec.bgm_file_path,
+        font_path=spec.font_path,
+        logger=logger,
+    )
+
+
+def build_job_executor(
+    spec: JobSpec,
+    output_dir: str,
+    logger: logging.Logger,
+    use_cache: bool = True,
+    on_stage_start: Optional[Callable[[Stage], None]] = None,
+    on_stage_end: Optional[Callable[[Stage], None]] = None,
+    progress: Optional[ProgressReporter] = None,
+    governor: Optional[ResourceGovernor] = None,
+    history_path: Optional[str] = DEFAULT_HISTORY_PATH,
+    job_id: Optional[str] = None,
+) -> StageGraphExecutor:
+    (
+        manuscript_generator,
+        audio_generator,
+        thumbnail_generator,
+        movie_generator,
+    ) = build_generators(spec, output_dir, logger)
+    generators = [
+        manuscript_generator,
+        audio_generator,
+        thumbnail_generator,
+        movie_generator,
+    ]
+    if spec.use_llm_cache:
+        # カセットはキャッシュを包むため、キャッシュから返した応答も含めてすべての呼び出しを記録する
+        # これにより、再生時にキャッシュの有無で応答の並びが変わらない
+        llm_cache = get_llm_cache()
+        for generator in generators:
+            attach_llm_cache(generator, llm_cache)
+    if spec.cassette_dir:
+        cassette = Cassette(spec.cassette_dir, spec.cassette_mode)
+        for generator in generators:
+            attach_cassette(generator, cassette)
+    if spec.deduplicate_manuscript:
+        manuscript_generator = DeduplicatingManuscriptGenerator(
+            generator=manuscript_generator,
+            index=ManuscriptIndex(threshold=spec.manuscript_similarity_threshold),
+            logger=logger,
+            job_id=job_id,
+            on_discard=audio_generator.restart_prepare,
+        )
+    if spec.render_workers:
+        movie_generator.segment_renderer = RemoteSegmentRenderer(
+            urls=spec.render_workers, logger=logger
+        )
+    elif spec.render_processes > 1:
+        movie_generator.segment_renderer = LocalSegmentRenderer(
+            processes=spec.render_processes, logger=logger
+        )
+    return StageGraphExecutor(
+        stages=build_stages(
+            manuscript_generator=manuscript_generator,
+            audio_generator=audio_generator,
+            thumbnail_generator=thumbnail_generator,
+            movie_generator=movie_generator,
+            stream_manuscript=spec.stream_manuscript,
+        ),
+        logger=logger,
+        on_stage_start=on_stage_start,
+        on_stage_end=on_stage_end,
+        cache=build_artifact_cache(output_dir, logger) if use_cache else None,
+        trace_path=os.path.join(output_dir, "trace.json"),
+        progress=progress,
+        # 計測はプロセスを一定間隔で走査するため、指定した場合のみ行う
+        resource_report_path=os.path.join(output_dir, "resource_report.json")
+        if spec.resource_report
+        else None,
+        governor=governor,
+        history=StageHistory(history_path) if history_path is not None else None,
+        profile_stages=spec.profile_stages,
+        profile_dir=output_dir,
+        scratch_dir=spec.scratch_dir or os.environ.get("SHOORTER_SCRATCH_DIR"),
+        usage_path=os.path.join(output_dir, "openai_usage.prom"),
+    )
+
+
+def run_job(
+    spec: JobSpec,
+    output_dir: str,
+    logger: logging.Logger,
+    use_cache: bool = True,
+    on_stage_start: Optional[Callable[[Stage], None]] = None,
+    on_stage_end: Optional[Callable[[Stage], None]] = None,
+    progress: Optional[ProgressReporter] = None,
+    governor: Optional[ResourceGovernor] = None,
+    history_path: Optional[str] = DEFAULT_HISTORY_PATH,
+    job_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    return build_job_executor(
+        spec=spec,
+        output_dir=output_dir,
+        logger=logger,
+        use_cache=use_cache,
+        on_stage_start=on_stage_start,
+        on_stage_end=on_stage_end,
+        progress=progress,
+        governor=governor,
+        history_path=history_path,
+        job_id=job_id,
+    ).run()
+
+
+async def run_job_async(
+    spec: JobSpec,
+    output_dir: str,
+    logger: logging.Logger,
+    use_cache: bool = True,
+    on_stage_start: Optional[Callable[[Stage], None]] = None,
+    on_stage_end: Optional[Callable[[Stage], None]] = None,
+    progress: Optional[ProgressReporter] = None,
+    governor: Optional[ResourceGovernor] = None,
+    history_path: Optional[str] = DEFAULT_HISTORY_PATH,
+    job_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    # 1つのイベントループで複数のジョブを並行して実行する場合に利用する
+    # 生成器の初期化では VOICEVOX の読み込みなどを行うため、スレッドで実行する
+    executor = await asyncio.to_thread(
+        build_job_executor,
+        spec=spec,
+        output_dir=output_dir,
+        logger=logger,
+        use_cache=use_cache,
+        on_stage_start=on_stage_start,
+        on_stage_end=on_stage_end,
+        progress=progress,
+        governor=governor,
+        history_path=history_path,
+        job_id=job_id,
+    )
+    return await executor.arun()
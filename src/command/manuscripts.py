@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import re
+import sys
+import time
+from typing import List, Literal
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from module.manuscript_generator import (  # noqa: E402
+    DEFAULT_MAX_CONCURRENCY,
+    IManuscriptGenerator,
+    PseudoBulletinBoardManuscriptGenerator,
+    ThemeManuscript,
+    TriviaManuscriptGenerator,
+    generate_manuscripts,
+)
+from util import UsageRecorder, usage_recording  # noqa: E402
+
+
+def manuscript_file_name(index: int, theme: str) -> str:
+    return f"{index:04d}_{re.sub(r'[^0-9A-Za-z_.-]+', '_', theme)}.json"
+
+
+def manuscripts_cmd(
+    type: Literal["bulletin", "trivia"],
+    themes: List[str],
+    output_dir: str,
+    openai_api_key: str,
+    logger: logging.Logger,
+    num_trivia: int = 10,
+    num_trivia_shards: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> List[ThemeManuscript]:
+    # テーマごとに1本ずつ原稿を並行して生成し、完成した順に output_dir に書き出す
+    def factory(theme: str) -> IManuscriptGenerator:
+        if type == "trivia":
+            return TriviaManuscriptGenerator(
+                themes=[theme],
+                num_trivia=num_trivia,
+                num_shards=num_trivia_shards,
+                openai_apikey=openai_api_key,
+                logger=logger,
+            )
+        return PseudoBulletinBoardManuscriptGenerator(
+            themes=[theme], openai_apikey=openai_api_key, logger=logger
+        )
+
+    themes = list(dict.fromkeys(themes))
+    os.makedirs(output_dir, exist_ok=True)
+    indices = {theme: index for index, theme in enumerate(themes)}
+    usage = UsageRecorder()
+    start = time.perf_counter()
+    results: List[ThemeManuscript] = []
+    with usage_recording(usage):
+        for result in generate_manuscripts(
+            themes, factory, logger, max_concurrency=max_concurrency
+        ):
+            results.append(result)
+            manuscript = result["manuscript"]
+            if manuscript is None:
+                logger.error(
+                    f"[{len(results)}/{len(themes)}] {result['theme']}: 失敗 {result['error']}"
+                )
+                continue
+            path = os.path.join(
+                output_dir,
+                manuscript_file_name(indices[result["theme"]], result["theme"]),
+            )
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(manuscript.dict(), file, ensure_ascii=False, indent=2)
+            logger.info(
+                f"[{len(results)}/{len(themes)}] {result['theme']}: {manuscript.title} ({result['elapsed']:.1f}s)"
+            )
+    summary = usage.summary()
+    logger.info(
+        f"{len(themes)}件の原稿生成が完了しました "
+        f"(成功 {sum(1 for r in results if r['manuscript'] is not None)} / "
+        f"{time.perf_counter() - start:.1f}s / 推定費用 ${summary['cost']:.4f})"
+    )
+    usage.export(os.path.join(output_dir, "openai_usage.prom"))
+    return results
@@ -13,6 +13,8 @@ from module.manuscript_generator import (  # noqa: E402
     TriviaManuscriptGenerator,
 )
 from module.movie_generator import (  # noqa: E402
+    INTRO_DURATION,
+    SHORTS_MAX_DURATION,
     DalleShortMovieGenerator,
     IMovieGenerator,
 )
@@ -33,6 +35,7 @@ def trivia_cmd(
     bgm_file_path: str,
     font_path: str,
     logger: Logger,
+    num_shards: int = 1,
 ) -> tuple[
     IManuscriptGenerator,
     IAudioGenerator,
@@ -47,6 +50,7 @@ def trivia_cmd(
         num_trivia=num_trivia,
         openai_apikey=openai_api_key,
         logger=logger,
+        num_shards=num_shards,
     )
     audio_generator = VoiceVoxAudioGenerator(
         logger=logger,
@@ -54,6 +58,8 @@ def trivia_cmd(
         output_dir=output_dir,
         onnxruntime_lib_path=onnxruntime_lib_path,
         open_jtalk_dict_dir_path=open_jtalk_dict_dir_path,
+        # 冒頭のサムネイルを除いた時間に収まらない文章は、動画で紹介されないため合成しない
+        duration_budget=SHORTS_MAX_DURATION - INTRO_DURATION,
     )
 
     thumbnail_generator = DalleThumbnailGenerator(
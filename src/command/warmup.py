@@ -0,0 +1,87 @@
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from module.audio_generator import get_voicevox_core, load_voicevox_model  # noqa: E402
+from module.audio_generator.voicevox_audio_generator import (  # noqa: E402
+    speaker_attributes,
+)
+from pipeline import AUDIO_STAGE_RESOURCES  # noqa: E402
+from util import (  # noqa: E402
+    ResourceGovernor,
+    default_onnxruntime_lib_path,
+    tokenize,
+)
+
+from .job import JobSpec  # noqa: E402
+
+
+def voicevox_cpu_num_threads(governor: Optional[ResourceGovernor]) -> int:
+    # VOICEVOX はスレッド数ごとに使い回すため、ジョブの音声合成ステージに割り当てられるCPU数で初期化する
+    if governor is None:
+        return 0
+    return governor.grant_for(AUDIO_STAGE_RESOURCES).get("cpu", 0)
+
+
+def warm_up(
+    onnxruntime_lib_path: str,
+    open_jtalk_dict_dir_path: str,
+    logger: logging.Logger,
+    speaker_ids: Optional[List[int]] = None,
+    governor: Optional[ResourceGovernor] = None,
+) -> None:
+    # ジョブを受け付ける前に VOICEVOX と fugashi を初期化し、以降のジョブではプロセス内のものを使い回す
+    # moviepy はモジュールの読み込み時に初期化済みである
+    start = time.perf_counter()
+    tokenize("事前読み込み")
+    if not os.path.exists(onnxruntime_lib_path) or not os.path.exists(
+        open_jtalk_dict_dir_path
+    ):
+        logger.warning(
+            "VOICEVOXの依存ファイルが見つからないため、音声合成の事前読み込みを省略します"
+        )
+        return
+    try:
+        vv_core = get_voicevox_core(
+            onnxruntime_lib_path,
+            open_jtalk_dict_dir_path,
+            cpu_num_threads=voicevox_cpu_num_threads(governor),
+        )
+        for speaker_id in speaker_ids or [
+            attribute["value"] for attribute in speaker_attributes
+        ]:
+            load_voicevox_model(vv_core, speaker_id)
+    except Exception as e:
+        # 事前読み込みに失敗してもジョブの実行時に改めて初期化する
+        logger.warning(f"音声合成の事前読み込みに失敗しました: {e}")
+        return
+    logger.info(f"事前読み込みが完了しました ({time.perf_counter() - start:.1f}s)")
+
+
+def warm_up_for_spec(
+    spec: JobSpec,
+    logger: logging.Logger,
+    governor: Optional[ResourceGovernor] = None,
+) -> None:
+    warm_up(
+        onnxruntime_lib_path=spec.onnxruntime_lib_path,
+        open_jtalk_dict_dir_path=spec.open_jtalk_dict_dir_path,
+        logger=logger,
+        speaker_ids=[spec.speaker_id] if spec.speaker_id is not None else None,
+        governor=governor,
+    )
+
+
+def warm_up_with_defaults(
+    logger: logging.Logger, governor: Optional[ResourceGovernor] = None
+) -> None:
+    warm_up(
+        onnxruntime_lib_path=default_onnxruntime_lib_path(),
+        open_jtalk_dict_dir_path=JobSpec.__fields__["open_jtalk_dict_dir_path"].default,
+        logger=logger,
+        governor=governor,
+    )
@@ -1,5 +1,10 @@
 from .audio_generator import Audio as Audio
+from .audio_generator import Detail as Detail
 from .audio_generator import IAudioGenerator as IAudioGenerator
+from .duration_planner import DurationPlanner as DurationPlanner
+from .duration_planner import duration_planner as duration_planner
 from .voicevox_audio_generator import (
     VoiceVoxAudioGenerator as VoiceVoxAudioGenerator,
 )
+from .voicevox_audio_generator import get_voicevox_core as get_voicevox_core
+from .voicevox_audio_generator import load_voicevox_model as load_voicevox_model
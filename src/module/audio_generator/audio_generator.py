@@ -1,11 +1,12 @@
 import abc
+import asyncio
 import logging
 import os
-from typing import List, Literal
+from typing import Any, Dict, List, Literal
 
 from pydantic import BaseModel, Field
 
-from ..manuscript_generator import Manuscript
+from ..manuscript_generator import Content, Manuscript
 
 
 class Detail(BaseModel):
@@ -30,3 +31,23 @@ class IAudioGenerator(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def generate(self, manuscript: Manuscript) -> Audio:
         pass
+
+    async def agenerate(self, manuscript: Manuscript) -> Audio:
+        # 音声合成は CPU の処理が大半のため、スレッドで実行してイベントループを止めない
+        return await asyncio.to_thread(self.generate, manuscript)
+
+    def prepare(self, content: Content) -> None:
+        # 原稿の生成中に完成した文章を受け取る。先に合成を始められる生成器はこれを上書きし、
+        # generate では受け取った文章の合成結果を利用する
+        pass
+
+    async def aprepare(self, content: Content) -> None:
+        await asyncio.to_thread(self.prepare, content)
+
+    def restart_prepare(self) -> None:
+        # 別の原稿の文章を prepare で受け取り始める前に呼び出す。途中までの原稿は動画にならない
+        pass
+
+    def parameters(self) -> Dict[str, Any]:
+        # 生成結果に影響するパラメータであり、成果物のキャッシュキーに利用する
+        return {"generator": type(self).__name__}
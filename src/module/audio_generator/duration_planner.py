@@ -0,0 +1,73 @@
+import os
+import re
+import sys
+import threading
+from typing import Dict, List, Tuple
+
+from ..manuscript_generator import Content
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import count_morae  # noqa: E402
+
+# VOICEVOX の既定の話速 (speedScale 1.0) での 1モーラあたりの発話時間 [s]
+DEFAULT_MORA_DURATION = 0.13
+# 句読点や感嘆符で挟まる無音 [s]
+PAUSE_DURATION = 0.3
+# 文章の前後の無音 (prePhonemeLength + postPhonemeLength) [s]
+EDGE_DURATION = 0.2
+# 話者ごとの話速を実測値から求めるのに必要なモーラ数
+MIN_OBSERVED_MORAE = 30
+
+PAUSE_PATTERN = re.compile(r"[、。，．,.！？!?…]+")
+
+
+class DurationPlanner:
+    def __init__(self) -> None:
+        # 音声合成の前に文章の読み上げ時間を見積もり、動画の長さの上限に収まる文章のみを選ぶ
+        # 話速は合成した音声の長さから話者ごとに補正する
+        self.observed: Dict[int, Tuple[float, int]] = {}
+        self.lock = threading.Lock()
+
+    def mora_duration(self, speaker_id: int) -> float:
+        with self.lock:
+            duration, morae = self.observed.get(speaker_id, (0.0, 0))
+        if morae < MIN_OBSERVED_MORAE:
+            return DEFAULT_MORA_DURATION
+        return duration / morae
+
+    def __silence(self, text: str) -> float:
+        return EDGE_DURATION + PAUSE_DURATION * len(
+            PAUSE_PATTERN.findall(text.rstrip("、。，．,.！？!?… "))
+        )
+
+    def estimate(self, text: str, speaker_id: int) -> float:
+        return count_morae(text) * self.mora_duration(speaker_id) + self.__silence(text)
+
+    def observe(self, text: str, speaker_id: int, duration: float) -> None:
+        # 無音を除いた長さをモーラ数で割ったものを話速とする
+        morae = count_morae(text)
+        if morae == 0:
+            return
+        speech = max(0.0, duration - self.__silence(text))
+        with self.lock:
+            total, total_morae = self.observed.get(speaker_id, (0.0, 0))
+            self.observed[speaker_id] = (total + speech, total_morae + morae)
+
+    def plan(
+        self, contents: List[Content], speaker_ids: List[int], budget: float
+    ) -> Tuple[int, float]:
+        # 先頭から順に、見積もった合計が budget 未満に収まる文章の数と、その合計を返す
+        # 動画の生成と同じく、収まらない文章が現れた時点で以降の文章は紹介しない
+        total = 0.0
+        for idx, (content, speaker_id) in enumerate(zip(contents, speaker_ids)):
+            duration = self.estimate(content.text, speaker_id)
+            if total + duration >= budget:
+                return idx, total
+            total += duration
+        return len(contents), total
+
+
+# 話速の実測値はジョブをまたいで使い回す
+duration_planner = DurationPlanner()
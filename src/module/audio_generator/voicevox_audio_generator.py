@@ -1,12 +1,30 @@
 import io
 import logging
 import os
+import sys
+import threading
 import wave
 from ctypes import CDLL
 from pathlib import Path
-from typing import List, Literal, TypedDict
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, TypedDict
 
-from .audio_generator import Audio, Detail, IAudioGenerator, Manuscript
+from .audio_generator import Audio, Content, Detail, IAudioGenerator, Manuscript
+from .duration_planner import duration_planner
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import (  # noqa: E402
+    Cassette,
+    JobCancelledError,
+    check_cancelled,
+    granted_cpu,
+    publish,
+    report_progress,
+    scratch_path,
+    span,
+    to_jsonable,
+)
 
 
 class SpeakerAttribute(TypedDict):
@@ -26,6 +44,127 @@ speaker_attributes: List[SpeakerAttribute] = [
 ]
 
 
+class SharedVoicevoxCore:
+    def __init__(self, core: Any) -> None:
+        # プロセス内の複数のジョブのスレッドで共有する VOICEVOX。同時に推論するとCPUの割り当てを超えるため、
+        # モデルの読み込みと推論を直列化する
+        self.core = core
+        self.lock = threading.Lock()
+
+    def is_model_loaded(self, speaker_id: int) -> bool:
+        return self.core.is_model_loaded(speaker_id)
+
+    def load_model(self, speaker_id: int) -> None:
+        with self.lock:
+            self.core.load_model(speaker_id)
+
+    def audio_query(self, text: str, speaker_id: int) -> Any:
+        with self.lock:
+            return self.core.audio_query(text, speaker_id=speaker_id)
+
+    def synthesis(self, audio_query: Any, speaker_id: int) -> bytes:
+        with self.lock:
+            return self.core.synthesis(audio_query, speaker_id)
+
+
+# onnxruntime の読み込みと辞書の初期化は数秒かかるため、プロセス内で使い回す
+voicevox_cores: Dict[Tuple[str, str, int], SharedVoicevoxCore] = {}
+voicevox_core_lock = threading.Lock()
+
+
+def get_voicevox_core(
+    onnxruntime_lib_path: str,
+    open_jtalk_dict_dir_path: str,
+    cpu_num_threads: Optional[int] = None,
+) -> SharedVoicevoxCore:
+    # cpu_num_threads が 0 の場合は VOICEVOX が物理コア数から決める。
+    # 未指定の場合は実行中のステージに割り当てられたCPU数とし、スレッド数ごとに使い回す
+    if cpu_num_threads is None:
+        cpu_num_threads = granted_cpu() or 0
+    key = (
+        str(Path(onnxruntime_lib_path).resolve()),
+        str(Path(open_jtalk_dict_dir_path).resolve()),
+        cpu_num_threads,
+    )
+    with voicevox_core_lock:
+        if key not in voicevox_cores:
+            CDLL(str(Path(onnxruntime_lib_path).resolve(strict=True)))
+
+            from voicevox_core import VoicevoxCore  # type: ignore  # noqa: E402
+
+            voicevox_cores[key] = SharedVoicevoxCore(
+                VoicevoxCore(
+                    cpu_num_threads=cpu_num_threads,
+                    open_jtalk_dict_dir=Path(open_jtalk_dict_dir_path),
+                )
+            )
+        return voicevox_cores[key]
+
+
+def wav_duration(wav_file_path: str) -> float:
+    with wave.open(wav_file_path, "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def load_voicevox_model(vv_core: Any, speaker_id: int) -> None:
+    # 複数のジョブが同時に同じ話者のモデルを読み込まないようにする
+    with voicevox_core_lock:
+        if not vv_core.is_model_loaded(speaker_id):
+            vv_core.load_model(speaker_id)
+
+
+def restore_audio_query(audio_query: Any) -> Any:
+    # 記録から再生した音声クエリは dict のため、VOICEVOX に渡す前に元の型に戻す
+    if not isinstance(audio_query, dict):
+        return audio_query
+    import voicevox_core  # type: ignore  # noqa: E402
+
+    if not hasattr(voicevox_core, "AudioQuery"):
+        return audio_query
+    return voicevox_core.AudioQuery(**audio_query)
+
+
+class CassetteVoicevoxCore:
+    def __init__(self, factory: Callable[[], Any], cassette: Cassette) -> None:
+        # VOICEVOX の音声クエリと音声合成を記録・再生する。記録のみで足りる間は VOICEVOX を初期化しない
+        self.factory = factory
+        self.cassette = cassette
+        self.core: Optional[Any] = None
+
+    def __core(self, speaker_id: int) -> Any:
+        # 記録がなく実際に合成する場合のみ初期化し、話者のモデルを読み込む
+        if self.core is None:
+            self.core = self.factory()
+        load_voicevox_model(self.core, speaker_id)
+        return self.core
+
+    def is_model_loaded(self, speaker_id: int) -> bool:
+        return True
+
+    def load_model(self, speaker_id: int) -> None:
+        pass
+
+    def audio_query(self, text: str, speaker_id: int) -> Any:
+        return self.cassette.play(
+            "voicevox.audio_query",
+            {"text": text, "speaker_id": speaker_id},
+            lambda: self.__core(speaker_id).audio_query(text, speaker_id=speaker_id),
+            lambda audio_query: (to_jsonable(audio_query), None),
+            lambda response, body: response,
+        )
+
+    def synthesis(self, audio_query: Any, speaker_id: int) -> bytes:
+        return self.cassette.play(
+            "voicevox.synthesis",
+            {"audio_query": audio_query, "speaker_id": speaker_id},
+            lambda: self.__core(speaker_id).synthesis(
+                restore_audio_query(audio_query), speaker_id
+            ),
+            lambda wav: ({}, wav),
+            lambda response, body: body,
+        )
+
+
 class VoiceVoxAudioGenerator(IAudioGenerator):
     def __init__(
         self,
@@ -34,99 +173,217 @@ class VoiceVoxAudioGenerator(IAudioGenerator):
         onnxruntime_lib_path: str,
         open_jtalk_dict_dir_path: str,
         content_speaker_id: int | None = None,
+        duration_budget: float | None = None,
     ):
         super().__init__(logger, output_dir)
         self.content_speaker_id = content_speaker_id
+        # 指定した場合は、読み上げ時間の見積もりがこの秒数に収まる先頭の文章のみ合成する
+        self.duration_budget = duration_budget
         self.onnxruntime_lib_path = onnxruntime_lib_path
         self.open_jtalk_dict_dir_path = open_jtalk_dict_dir_path
+        # cassette を指定した場合は音声合成の結果を記録・再生する
+        self.cassette: Optional[Cassette] = None
+        # prepare で原稿の生成中に合成した音声。(文章, 話者ID) ごとに作業ディレクトリ内のパスを持つ
+        self.prepared: Dict[Tuple[str, int], List[str]] = {}
+        self.prepared_speakers: Dict[str, SpeakerAttribute] = {}
+        self.prepared_duration = 0.0
+        self.prepared_exhausted = False
 
-    def generate(self, manuscript: Manuscript) -> Audio:
-        CDLL(
-            str(
-                Path(
-                    self.onnxruntime_lib_path,
-                ).resolve(strict=True)
+    def parameters(self) -> Dict[str, Any]:
+        return {
+            **super().parameters(),
+            "content_speaker_id": self.content_speaker_id,
+            "duration_budget": self.duration_budget,
+            "speaker_attributes": speaker_attributes,
+            "open_jtalk_dict": os.path.basename(
+                os.path.normpath(self.open_jtalk_dict_dir_path)
+            ),
+        }
+
+    def __voicevox_core(self) -> Any:
+        with span("voicevox.initialize", category="voicevox"):
+            return get_voicevox_core(
+                self.onnxruntime_lib_path, self.open_jtalk_dict_dir_path
             )
-        )
 
-        from voicevox_core import VoicevoxCore  # type: ignore  # noqa: E402
+    def __core(self) -> Any:
+        if self.cassette is not None:
+            return CassetteVoicevoxCore(self.__voicevox_core, self.cassette)
+        return self.__voicevox_core()
 
-        vv_core = VoicevoxCore(open_jtalk_dict_dir=Path(self.open_jtalk_dict_dir_path))
+    def __speaker_attribute(
+        self, assignments: Dict[str, SpeakerAttribute], user_id: str
+    ) -> SpeakerAttribute:
+        # 原稿内で最初に登場した順に話者を割り当てる。逐次受け取った文章にも同じ話者を割り当てられる
+        if user_id not in assignments:
+            if self.content_speaker_id is not None:
+                # 指定された場合はすべての内容を同一話者で話す
+                for speaker_attribute in speaker_attributes:
+                    if speaker_attribute["value"] == self.content_speaker_id:
+                        assignments[user_id] = speaker_attribute
+                        break
+                else:
+                    raise ValueError(
+                        f"次の話者IDはサポートされていません: {self.content_speaker_id}"
+                    )
+            else:
+                assignments[user_id] = speaker_attributes[
+                    len(assignments) % len(speaker_attributes)
+                ]
+        return assignments[user_id]
 
-        unique_user_ids = list(
-            set([content.speaker_id for content in manuscript.contents])
-        )
-        if self.content_speaker_id is not None:
-            # 指定された場合はすべての内容を同一話者で話す
-            content_speaker_attribute = None
-            for speaker_attribute in speaker_attributes:
-                if speaker_attribute["value"] == self.content_speaker_id:
-                    content_speaker_attribute = speaker_attribute
-                    break
-            if content_speaker_attribute is None:
-                raise ValueError(
-                    f"次の話者IDはサポートされていません: {self.content_speaker_id}"
-                )
-            unique_user_id_to_speaker_attribute = {
-                user_id: content_speaker_attribute
-                for i, user_id in enumerate(unique_user_ids)
-            }
+    def __synthesize(
+        self, vv_core: Any, idx: int, text: str, speaker_id: int, wav_file_path: str
+    ) -> float:
+        # 合成した音声の長さ [s] を返し、読み上げ時間の見積もりに利用する
+        with span("voicevox.load_model", category="voicevox", speaker_id=speaker_id):
+            load_voicevox_model(vv_core, speaker_id)
+        with span(
+            "voicevox.audio_query",
+            category="voicevox",
+            index=idx,
+            speaker_id=speaker_id,
+            text_length=len(text),
+        ):
+            audio_query = vv_core.audio_query(text, speaker_id=speaker_id)
+        with span(
+            "voicevox.synthesis", category="voicevox", index=idx, speaker_id=speaker_id
+        ):
+            content_wav = vv_core.synthesis(audio_query, speaker_id)
+        with wave.open(wav_file_path, "wb") as output_wav:
+            with wave.open(io.BytesIO(content_wav), "rb") as wav:
+                output_wav.setnchannels(wav.getnchannels())
+                output_wav.setsampwidth(wav.getsampwidth())
+                output_wav.setframerate(wav.getframerate())
+                output_wav.writeframes(wav.readframes(wav.getnframes()))
+                duration = wav.getnframes() / wav.getframerate()
+        duration_planner.observe(text, speaker_id, duration)
+        return duration
 
-        else:
-            unique_user_id_to_speaker_attribute = {
-                user_id: speaker_attributes[i % len(speaker_attributes)]
-                for i, user_id in enumerate(unique_user_ids)
-            }
+    def restart_prepare(self) -> None:
+        # 破棄された原稿の文章は動画の長さに数えず、話者も最初から割り当て直す
+        # 合成済みの音声は、同じ文章と話者であれば新しい原稿でも利用する
+        self.prepared_speakers.clear()
+        self.prepared_duration = 0.0
+        self.prepared_exhausted = False
+
+    def prepare(self, content: Content) -> None:
+        # 原稿の生成中に完成した文章を先に合成しておく。失敗した文章は generate で合成し直す
+        check_cancelled()
+        speaker_id = self.__speaker_attribute(
+            self.prepared_speakers, content.speaker_id
+        )["value"]
+        if self.duration_budget is not None:
+            # 収まらない文章が現れた以降の文章は動画で紹介されない
+            if self.prepared_exhausted:
+                return
+            duration = duration_planner.estimate(content.text, speaker_id)
+            if self.prepared_duration + duration >= self.duration_budget:
+                self.prepared_exhausted = True
+                return
+            self.prepared_duration += duration
+        idx = sum(len(paths) for paths in self.prepared.values())
+        wav_file_path = scratch_path("audio", "prepared", f"{idx}.wav")
+        try:
+            self.__synthesize(
+                self.__core(), idx, content.text, speaker_id, wav_file_path
+            )
+        except JobCancelledError:
+            raise
+        except Exception as e:
+            self.logger.warning(f"次のコンテンツの先行した音声合成に失敗しました: {e}")
+            return
+        self.prepared.setdefault((content.text, speaker_id), []).append(wav_file_path)
+
+    def generate(self, manuscript: Manuscript) -> Audio:
+        vv_core = self.__core()
+        assignments: Dict[str, SpeakerAttribute] = {}
+
+        # 動画に収まらずに捨てられる文章は合成しない。合成前に読み上げ時間を見積もって対象を決め、
+        # 合成済みの文章は実際の長さで数え直す
+        speaker_ids = [
+            self.__speaker_attribute(assignments, content.speaker_id)["value"]
+            for content in manuscript.contents
+        ]
+        planned = len(manuscript.contents)
+        if self.duration_budget is not None:
+            planned, estimated = duration_planner.plan(
+                manuscript.contents, speaker_ids, self.duration_budget
+            )
+            if planned < len(manuscript.contents):
+                self.logger.info(
+                    f"読み上げ時間の見積もりが {self.duration_budget:.1f}s に収まる "
+                    f"{planned}/{len(manuscript.contents)} 件の文章のみ音声合成します (推定 {estimated:.1f}s)"
+                )
 
         # コンテンツの音声を生成
         content_details: list[Detail] = []
+        reused = 0
+        total_duration = 0.0
         for idx, content in enumerate(manuscript.contents):
+            check_cancelled()
+            speaker_attribute = self.__speaker_attribute(
+                assignments, content.speaker_id
+            )
+            content_speaker_id = speaker_attribute["value"]
+            prepared = self.prepared.get((content.text, content_speaker_id))
+            # 合成済みの文章は見積もりではなく実際の長さで収まるかを判定する
+            prepared_duration = wav_duration(prepared[0]) if prepared else None
+            if self.duration_budget is not None and (
+                total_duration
+                + (
+                    prepared_duration
+                    if prepared_duration is not None
+                    else duration_planner.estimate(content.text, content_speaker_id)
+                )
+                >= self.duration_budget
+            ):
+                break
             try:
                 content_output_audio_file_path = os.path.join(
                     self.output_dir, "audio", f"{idx}.wav"
                 )
-                os.makedirs(
-                    os.path.dirname(content_output_audio_file_path), exist_ok=True
+                if prepared and prepared_duration is not None:
+                    # 原稿の生成中に合成済みの音声を利用する
+                    scratch_audio_file_path = prepared.pop(0)
+                    duration = prepared_duration
+                    reused += 1
+                else:
+                    # 作業ディレクトリに書き出してから出力先に配置する
+                    scratch_audio_file_path = scratch_path("audio", f"{idx}.wav")
+                    duration = self.__synthesize(
+                        vv_core,
+                        idx,
+                        content.text,
+                        content_speaker_id,
+                        scratch_audio_file_path,
+                    )
+                content_details.append(
+                    Detail(
+                        wav_file_path=content_output_audio_file_path,
+                        transcript=content.text,
+                        speaker_id=str(content_speaker_id),
+                        speaker_gender=speaker_attribute["gender"],
+                        tags=[],
+                    )
                 )
-                os.remove(content_output_audio_file_path) if os.path.exists(
-                    content_output_audio_file_path
-                ) else None
-                content_speaker_id = unique_user_id_to_speaker_attribute[
-                    content.speaker_id
-                ]["value"]
-                content_speaker_gender = unique_user_id_to_speaker_attribute[
-                    content.speaker_id
-                ]["gender"]
-                vv_core.load_model(content_speaker_id)
-                content_audio_query = vv_core.audio_query(
-                    content.text, speaker_id=content_speaker_id
-                )
-                content_wav = vv_core.synthesis(content_audio_query, content_speaker_id)
-                with wave.open(
-                    content_output_audio_file_path, "wb"
-                ) as content_output_wav:
-                    with wave.open(io.BytesIO(content_wav), "rb") as wav:
-                        content_output_wav.setnchannels(wav.getnchannels())
-                        content_output_wav.setsampwidth(wav.getsampwidth())
-                        content_output_wav.setframerate(wav.getframerate())
-                        content_output_wav.writeframes(wav.readframes(wav.getnframes()))
-
-                        content_details.append(
-                            Detail(
-                                wav_file_path=content_output_audio_file_path,
-                                transcript=content.text,
-                                speaker_id=str(content_speaker_id),
-                                speaker_gender=content_speaker_gender,
-                                tags=[],
-                            )
-                        )
+                publish(scratch_audio_file_path, content_output_audio_file_path)
+                total_duration += duration
+            except ValueError:
+                raise
             except Exception:
                 raise Exception(
                     f"次のコンテンツの音声生成に失敗しました: {content.text}"
                 )
+            report_progress("clip", idx + 1, max(planned, idx + 1))
 
-            audio = Audio(content_details=content_details)
-
+        self.prepared.clear()
+        self.restart_prepare()
+        audio = Audio(content_details=content_details)
+        if reused:
+            self.logger.info(
+                f"原稿の生成中に合成した {reused}/{len(content_details)} 件の音声を利用しました"
+            )
         self.logger.info("VOICEVOXを用いた動画音声を生成しました")
 
         return audio
@@ -1,5 +1,25 @@
+from .deduplicating_manuscript_generator import (
+    DeduplicatingManuscriptGenerator as DeduplicatingManuscriptGenerator,
+)
+from .deduplicating_manuscript_generator import (
+    DuplicateManuscriptError as DuplicateManuscriptError,
+)
+from .manuscript_batch import (
+    DEFAULT_MAX_CONCURRENCY as DEFAULT_MAX_CONCURRENCY,
+)
+from .manuscript_batch import (
+    ManuscriptGeneratorFactory as ManuscriptGeneratorFactory,
+)
+from .manuscript_batch import ThemeManuscript as ThemeManuscript
+from .manuscript_batch import agenerate_manuscripts as agenerate_manuscripts
+from .manuscript_batch import generate_manuscripts as generate_manuscripts
+from .manuscript_generator import Content as Content
 from .manuscript_generator import IManuscriptGenerator as IManuscriptGenerator
 from .manuscript_generator import Manuscript as Manuscript
+from .manuscript_index import (
+    DEFAULT_MANUSCRIPT_INDEX_PATH as DEFAULT_MANUSCRIPT_INDEX_PATH,
+)
+from .manuscript_index import ManuscriptIndex as ManuscriptIndex
 from .pseudo_bulletin_board_manuscript_generator import (
     PseudoBulletinBoardManuscriptGenerator as PseudoBulletinBoardManuscriptGenerator,
 )
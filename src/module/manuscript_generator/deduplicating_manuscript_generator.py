@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import sys
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Optional
+
+from .manuscript_generator import Content, IManuscriptGenerator, Manuscript
+from .manuscript_index import ManuscriptIndex, ManuscriptMatch
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import bypass_llm_cache  # noqa: E402
+
+
+class DuplicateManuscriptError(Exception):
+    pass
+
+
+class DeduplicatingManuscriptGenerator(IManuscriptGenerator):
+    def __init__(
+        self,
+        generator: IManuscriptGenerator,
+        index: ManuscriptIndex,
+        logger: logging.Logger,
+        max_attempts: int = 3,
+        job_id: Optional[str] = None,
+        on_discard: Optional[Callable[[], None]] = None,
+    ) -> None:
+        # 過去に生成した原稿とほぼ同じ内容の原稿は、音声合成や画像生成を行う前に生成し直す
+        # job_id を指定した場合は、同じジョブの再試行で登録済みの原稿を重複とみなさない
+        # on_discard は原稿を破棄して生成し直す前に呼び出され、逐次受け取った文章の扱いを戻すのに用いる
+        super().__init__(logger)
+        self.generator = generator
+        self.index = index
+        self.max_attempts = max_attempts
+        self.job_id = job_id
+        self.on_discard = on_discard
+
+    def parameters(self) -> Dict[str, Any]:
+        return {
+            **self.generator.parameters(),
+            "deduplication_threshold": self.index.threshold,
+        }
+
+    def __scope(self) -> str:
+        # 種類の異なる動画の原稿同士は比較しない
+        return type(self.generator).__name__
+
+    def __check(self, manuscript: Manuscript, attempt: int) -> bool:
+        match = self.index.add_if_unique(self.__scope(), manuscript, self.job_id)
+        if match is None:
+            return True
+        self.__warn(manuscript, match, attempt)
+        # 生成し直す原稿のプロンプトで、重複した原稿と異なる内容とするよう指示する
+        if match["title"] not in self.generator.avoided_titles:
+            self.generator.avoided_titles.append(match["title"])
+        if self.on_discard is not None:
+            self.on_discard()
+        return False
+
+    def __warn(
+        self, manuscript: Manuscript, match: ManuscriptMatch, attempt: int
+    ) -> None:
+        self.logger.warning(
+            f"過去の原稿「{match['title']}」と類似しているため、原稿「{manuscript.title}」を破棄します "
+            f"(類似度: {match['similarity']:.2f}, {attempt}/{self.max_attempts}回目)"
+        )
+
+    def __attempt(self, attempt: int) -> ContextManager[None]:
+        # 生成し直す場合は、キャッシュされた同じ原稿が返らないようにする
+        if attempt == 1:
+            self.generator.avoided_titles = []
+            return nullcontext()
+        return bypass_llm_cache()
+
+    def __error(self) -> DuplicateManuscriptError:
+        return DuplicateManuscriptError(
+            f"{self.max_attempts}回生成しても過去の原稿と重複しない原稿を生成できませんでした"
+        )
+
+    def generate(self) -> Manuscript:
+        for attempt in range(1, self.max_attempts + 1):
+            with self.__attempt(attempt):
+                manuscript = self.generator.generate()
+            if self.__check(manuscript, attempt):
+                return manuscript
+        raise self.__error()
+
+    async def agenerate(self) -> Manuscript:
+        for attempt in range(1, self.max_attempts + 1):
+            with self.__attempt(attempt):
+                manuscript = await self.generator.agenerate()
+            if await asyncio.to_thread(self.__check, manuscript, attempt):
+                return manuscript
+        raise self.__error()
+
+    def stream(self, on_content: Callable[[Content], None]) -> Manuscript:
+        # 破棄した原稿の文章も on_content に渡される。受け取り側は最終的な原稿と照合する
+        for attempt in range(1, self.max_attempts + 1):
+            with self.__attempt(attempt):
+                manuscript = self.generator.stream(on_content)
+            if self.__check(manuscript, attempt):
+                return manuscript
+        raise self.__error()
+
+    async def astream(
+        self, on_content: Callable[[Content], Awaitable[None]]
+    ) -> Manuscript:
+        for attempt in range(1, self.max_attempts + 1):
+            with self.__attempt(attempt):
+                manuscript = await self.generator.astream(on_content)
+            if await asyncio.to_thread(self.__check, manuscript, attempt):
+                return manuscript
+        raise self.__error()
@@ -0,0 +1,137 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import AsyncIterator, Callable, Iterator, List, Optional, TypedDict
+
+from .manuscript_generator import IManuscriptGenerator, Manuscript
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import JobCancelledError  # noqa: E402
+
+# テーマごとの原稿生成器を作る。生成器は1テーマ分の原稿を生成する
+ManuscriptGeneratorFactory = Callable[[str], IManuscriptGenerator]
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class ThemeManuscript(TypedDict):
+    theme: str
+    manuscript: Optional[Manuscript]
+    error: Optional[str]
+    elapsed: float
+
+
+def generate_theme_manuscript(
+    factory: ManuscriptGeneratorFactory, theme: str, logger: logging.Logger
+) -> ThemeManuscript:
+    # 1テーマの失敗はそのテーマの結果として返し、他のテーマの生成は続ける
+    start = time.perf_counter()
+    try:
+        manuscript = factory(theme).generate()
+    except JobCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"テーマ「{theme}」の原稿生成に失敗しました: {e}")
+        return {
+            "theme": theme,
+            "manuscript": None,
+            "error": str(e),
+            "elapsed": time.perf_counter() - start,
+        }
+    return {
+        "theme": theme,
+        "manuscript": manuscript,
+        "error": None,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+async def agenerate_theme_manuscript(
+    factory: ManuscriptGeneratorFactory,
+    theme: str,
+    semaphore: asyncio.Semaphore,
+    logger: logging.Logger,
+) -> ThemeManuscript:
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            manuscript = await factory(theme).agenerate()
+        except JobCancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"テーマ「{theme}」の原稿生成に失敗しました: {e}")
+            return {
+                "theme": theme,
+                "manuscript": None,
+                "error": str(e),
+                "elapsed": time.perf_counter() - start,
+            }
+        return {
+            "theme": theme,
+            "manuscript": manuscript,
+            "error": None,
+            "elapsed": time.perf_counter() - start,
+        }
+
+
+def generate_manuscripts(
+    themes: List[str],
+    factory: ManuscriptGeneratorFactory,
+    logger: logging.Logger,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> Iterator[ThemeManuscript]:
+    # 複数のテーマの原稿を最大 max_concurrency 件ずつ並行して生成し、完成した順に返す
+    logger.info(
+        f"{len(themes)}件のテーマの原稿を最大{max_concurrency}件ずつ並行して生成します"
+    )
+    pool = ThreadPoolExecutor(
+        max_workers=max(1, max_concurrency), thread_name_prefix="manuscript"
+    )
+    try:
+        # 使用量の記録やトレースがスレッドでも引き継がれるよう、呼び出し元のコンテキストで実行する
+        futures = [
+            pool.submit(
+                contextvars.copy_context().run,
+                generate_theme_manuscript,
+                factory,
+                theme,
+                logger,
+            )
+            for theme in themes
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # 途中で打ち切られた場合は、まだ始まっていないテーマの生成を取り消す
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+async def agenerate_manuscripts(
+    themes: List[str],
+    factory: ManuscriptGeneratorFactory,
+    logger: logging.Logger,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> AsyncIterator[ThemeManuscript]:
+    logger.info(
+        f"{len(themes)}件のテーマの原稿を最大{max_concurrency}件ずつ並行して生成します"
+    )
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    tasks = [
+        asyncio.create_task(
+            agenerate_theme_manuscript(factory, theme, semaphore, logger)
+        )
+        for theme in themes
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
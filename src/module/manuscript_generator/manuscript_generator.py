@@ -1,6 +1,9 @@
 import abc
+import asyncio
 import logging
+from typing import Any, Awaitable, Callable, Dict, List
 
+from openai.types.chat import ChatCompletionMessageParam
 from pydantic import BaseModel, Field
 
 
@@ -29,7 +32,44 @@ class Manuscript(BaseModel):
 class IManuscriptGenerator(metaclass=abc.ABCMeta):
     def __init__(self, logger: logging.Logger) -> None:
         self.logger = logger
+        # 過去の原稿と重複して生成し直す場合に、重複した原稿のタイトルを保持する
+        self.avoided_titles: List[str] = []
 
     @abc.abstractmethod
     def generate(self) -> Manuscript:
         pass
+
+    async def agenerate(self) -> Manuscript:
+        # 非同期の API を利用できない生成器はスレッドで実行し、イベントループを止めない
+        return await asyncio.to_thread(self.generate)
+
+    def stream(self, on_content: Callable[[Content], None]) -> Manuscript:
+        # 原稿の生成中に、完成した文章から順に on_content に渡す
+        # 逐次生成できない生成器は、生成後にまとめて渡す
+        manuscript = self.generate()
+        for content in manuscript.contents:
+            on_content(content)
+        return manuscript
+
+    async def astream(
+        self, on_content: Callable[[Content], Awaitable[None]]
+    ) -> Manuscript:
+        manuscript = await self.agenerate()
+        for content in manuscript.contents:
+            await on_content(content)
+        return manuscript
+
+    def avoidance_messages(self) -> List[ChatCompletionMessageParam]:
+        # 生成し直す原稿が、重複した原稿と同じ内容にならないよう指示する
+        if not self.avoided_titles:
+            return []
+        return [
+            {
+                "role": "system",
+                "content": f"また、次のタイトルの動画とは異なる内容としてください: {'、'.join(self.avoided_titles)}",
+            }
+        ]
+
+    def parameters(self) -> Dict[str, Any]:
+        # 生成結果に影響するパラメータであり、成果物のキャッシュキーに利用する
+        return {"generator": type(self).__name__}
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Optional, Set, TypedDict
+
+import numpy as np
+
+from .manuscript_generator import Manuscript
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import tokenize  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manuscripts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scope TEXT NOT NULL,
+    title TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    job_id TEXT
+);
+CREATE TABLE IF NOT EXISTS manuscript_bands (
+    scope TEXT NOT NULL,
+    band INTEGER NOT NULL,
+    bucket TEXT NOT NULL,
+    manuscript_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS manuscript_bands_bucket ON manuscript_bands (scope, band, bucket);
+"""
+
+DEFAULT_MANUSCRIPT_INDEX_PATH = os.path.join(
+    os.path.expanduser("~"), ".shoorter", "manuscript_index.sqlite3"
+)
+
+# MinHash の署名長と LSH の分割数。32 バンド × 4 行では類似度 0.4 前後から候補になりやすい
+NUM_PERMUTATIONS = 128
+NUM_BANDS = 32
+SHINGLE_SIZE = 3
+# 32bit に収まる最大の素数。(a * x + b) が 64bit を超えないようにする
+HASH_PRIME = np.uint64(4294967291)
+
+# 署名を過去の実行と比較できるよう、ハッシュ関数の係数は固定の乱数で決める
+random_state = np.random.RandomState(20240601)
+PERMUTATION_A = random_state.randint(
+    1, int(HASH_PRIME), size=NUM_PERMUTATIONS, dtype=np.uint64
+)
+PERMUTATION_B = random_state.randint(
+    0, int(HASH_PRIME), size=NUM_PERMUTATIONS, dtype=np.uint64
+)
+
+
+class ManuscriptMatch(TypedDict):
+    id: int
+    title: str
+    similarity: float
+
+
+def text_shingles(text: str) -> Set[str]:
+    # 文章を形態素に分割し、連続する SHINGLE_SIZE 語を1つの要素とする
+    tokens = [token for token in tokenize(text) if token.strip()]
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = {" ".join(tokens)}
+    else:
+        shingles = {
+            " ".join(tokens[i : i + SHINGLE_SIZE])
+            for i in range(len(tokens) - SHINGLE_SIZE + 1)
+        }
+    shingles.discard("")
+    return shingles
+
+
+def manuscript_shingles(manuscript: Manuscript) -> Set[str]:
+    shingles: Set[str] = set()
+    for content in manuscript.contents:
+        shingles |= text_shingles(content.text)
+    return shingles
+
+
+def minhash_signature(shingles: Set[str]) -> np.ndarray:
+    if not shingles:
+        return np.full(NUM_PERMUTATIONS, int(HASH_PRIME), dtype=np.uint64)
+    values = (
+        np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(),
+                    "little",
+                )
+                for shingle in shingles
+            ],
+            dtype=np.uint64,
+        )
+        % HASH_PRIME
+    )
+    hashes = (
+        np.outer(values, PERMUTATION_A) + PERMUTATION_B[np.newaxis, :]
+    ) % HASH_PRIME
+    return hashes.min(axis=0)
+
+
+def signature_buckets(signature: np.ndarray) -> List[str]:
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    return [
+        hashlib.blake2b(
+            signature[band * rows : (band + 1) * rows].tobytes(), digest_size=8
+        ).hexdigest()
+        for band in range(NUM_BANDS)
+    ]
+
+
+class ManuscriptIndex:
+    def __init__(
+        self, db_path: str = DEFAULT_MANUSCRIPT_INDEX_PATH, threshold: float = 0.5
+    ):
+        # 過去に生成した原稿の MinHash 署名を保持し、内容がほぼ同じ原稿を検出する
+        # threshold は重複とみなす推定 Jaccard 類似度の下限
+        self.db_path = db_path
+        self.threshold = threshold
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        connection = self.__connection()
+        connection.executescript(SCHEMA)
+        # job_id のない以前のデータベースには列を追加する
+        columns = [
+            row[1] for row in connection.execute("PRAGMA table_info(manuscripts)")
+        ]
+        if "job_id" not in columns:
+            with connection:
+                connection.execute("ALTER TABLE manuscripts ADD COLUMN job_id TEXT")
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに接続する
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def __query(
+        self,
+        connection: sqlite3.Connection,
+        scope: str,
+        signature: np.ndarray,
+        job_id: Optional[str] = None,
+    ) -> Optional[ManuscriptMatch]:
+        # LSH のバケットが1つでも一致した原稿を候補とし、署名から推定した類似度が最も高いものを返す
+        # 同じジョブが登録した原稿は、再試行したジョブ自身と重複しないよう候補から除く
+        candidate_ids: Set[int] = set()
+        for band, bucket in enumerate(signature_buckets(signature)):
+            rows = connection.execute(
+                "SELECT manuscript_id FROM manuscript_bands WHERE scope = ? AND band = ? AND bucket = ?",
+                (scope, band, bucket),
+            ).fetchall()
+            candidate_ids.update(row[0] for row in rows)
+
+        best: Optional[ManuscriptMatch] = None
+        for manuscript_id in candidate_ids:
+            row = connection.execute(
+                "SELECT title, signature, job_id FROM manuscripts WHERE id = ?",
+                (manuscript_id,),
+            ).fetchone()
+            if row is None or (job_id is not None and row[2] == job_id):
+                continue
+            similarity = float(
+                np.mean(np.frombuffer(row[1], dtype=np.uint64) == signature)
+            )
+            if similarity >= self.threshold and (
+                best is None or similarity > best["similarity"]
+            ):
+                best = {"id": manuscript_id, "title": row[0], "similarity": similarity}
+        return best
+
+    def __insert(
+        self,
+        connection: sqlite3.Connection,
+        scope: str,
+        manuscript: Manuscript,
+        signature: np.ndarray,
+        job_id: Optional[str] = None,
+    ) -> int:
+        if job_id is not None:
+            # 再試行したジョブは、以前の試行で登録した原稿を置き換える
+            connection.execute(
+                "DELETE FROM manuscript_bands WHERE manuscript_id IN (SELECT id FROM manuscripts WHERE scope = ? AND job_id = ?)",
+                (scope, job_id),
+            )
+            connection.execute(
+                "DELETE FROM manuscripts WHERE scope = ? AND job_id = ?",
+                (scope, job_id),
+            )
+        cursor = connection.execute(
+            "INSERT INTO manuscripts (scope, title, signature, created_at, job_id) VALUES (?, ?, ?, ?, ?)",
+            (scope, manuscript.title, signature.tobytes(), time.time(), job_id),
+        )
+        manuscript_id = cursor.lastrowid
+        assert manuscript_id is not None
+        connection.executemany(
+            "INSERT INTO manuscript_bands (scope, band, bucket, manuscript_id) VALUES (?, ?, ?, ?)",
+            [
+                (scope, band, bucket, manuscript_id)
+                for band, bucket in enumerate(signature_buckets(signature))
+            ],
+        )
+        return manuscript_id
+
+    def query(
+        self, scope: str, manuscript: Manuscript, job_id: Optional[str] = None
+    ) -> Optional[ManuscriptMatch]:
+        signature = minhash_signature(manuscript_shingles(manuscript))
+        return self.__query(self.__connection(), scope, signature, job_id)
+
+    def add(
+        self, scope: str, manuscript: Manuscript, job_id: Optional[str] = None
+    ) -> int:
+        signature = minhash_signature(manuscript_shingles(manuscript))
+        connection = self.__connection()
+        with connection:
+            return self.__insert(connection, scope, manuscript, signature, job_id)
+
+    def add_if_unique(
+        self, scope: str, manuscript: Manuscript, job_id: Optional[str] = None
+    ) -> Optional[ManuscriptMatch]:
+        # 類似する原稿がなければ登録し、あればその原稿を返す
+        # 並行して実行される他のジョブと同じ原稿を登録しないよう、検索と登録を1つのトランザクションで行う
+        # job_id を指定した場合は、同じジョブの再試行で登録し直せるよう原稿をジョブごとに登録する
+        signature = minhash_signature(manuscript_shingles(manuscript))
+        connection = self.__connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            match = self.__query(connection, scope, signature, job_id)
+            if match is None:
+                self.__insert(connection, scope, manuscript, signature, job_id)
+        return match
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterator, List
+
+from openai.types.chat import ChatCompletionMessageParam
+from pydantic import ValidationError
+
+from .manuscript_generator import Content, Manuscript
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import OpenAICall, openai_call  # noqa: E402
+
+ContentCallback = Callable[[Content], None]
+AsyncContentCallback = Callable[[Content], Awaitable[None]]
+
+
+class ManuscriptStreamParser:
+    def __init__(self) -> None:
+        # 構造化出力の途中までの JSON から、完成した文章を先頭から順に取り出す
+        self.emitted = 0
+
+    def feed(self, parsed: Any) -> List[Content]:
+        contents = parsed.get("contents") if isinstance(parsed, dict) else None
+        if not isinstance(contents, list):
+            return []
+        # 最後の要素は書きかけの可能性があるため、次の要素が始まった時点で完成とみなす
+        completed: List[Content] = []
+        while self.emitted < len(contents) - 1:
+            try:
+                completed.append(Content.parse_obj(contents[self.emitted]))
+            except ValidationError:
+                break
+            self.emitted += 1
+        return completed
+
+    def finish(self, manuscript: Manuscript) -> List[Content]:
+        # 生成の完了後に、まだ取り出していない文章を返す
+        remaining = manuscript.contents[self.emitted :]
+        self.emitted = len(manuscript.contents)
+        return remaining
+
+
+@contextmanager
+def paused(call: OpenAICall) -> Iterator[None]:
+    # 受け取った文章を処理している時間は、API の応答時間に含めない
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        call.paused += time.perf_counter() - started
+
+
+def stream_manuscript(
+    client: Any,
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+    purpose: str,
+    parse: Callable[[Any], Manuscript],
+    on_content: ContentCallback,
+) -> Manuscript:
+    # 原稿を逐次受け取り、完成した文章から on_content に渡す
+    parser = ManuscriptStreamParser()
+    with openai_call("chat.completions.stream", model=model, purpose=purpose) as call:
+        with client.beta.chat.completions.stream(
+            model=model,
+            messages=messages,
+            response_format=Manuscript,
+            stream_options={"include_usage": True},
+        ) as stream:
+            for event in stream:
+                if event.type == "content.delta":
+                    for content in parser.feed(event.parsed):
+                        with paused(call):
+                            on_content(content)
+            completion = stream.get_final_completion()
+        call.set_response(completion)
+    manuscript = parse(completion)
+    for content in parser.finish(manuscript):
+        on_content(content)
+    return manuscript
+
+
+async def astream_manuscript(
+    client: Any,
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+    purpose: str,
+    parse: Callable[[Any], Manuscript],
+    on_content: AsyncContentCallback,
+) -> Manuscript:
+    parser = ManuscriptStreamParser()
+    with openai_call("chat.completions.stream", model=model, purpose=purpose) as call:
+        async with client.beta.chat.completions.stream(
+            model=model,
+            messages=messages,
+            response_format=Manuscript,
+            stream_options={"include_usage": True},
+        ) as stream:
+            async for event in stream:
+                if event.type == "content.delta":
+                    for content in parser.feed(event.parsed):
+                        with paused(call):
+                            await on_content(content)
+            completion = await stream.get_final_completion()
+        call.set_response(completion)
+    manuscript = parse(completion)
+    for content in parser.finish(manuscript):
+        await on_content(content)
+    return manuscript
@@ -1,9 +1,19 @@
 import logging
-from typing import List
+import os
+import sys
+from typing import Any, Awaitable, Callable, Dict, List
 
-from openai import OpenAI
+from openai.types.chat import ChatCompletionMessageParam
 
 from .manuscript_generator import Content, IManuscriptGenerator, Manuscript
+from .manuscript_stream import astream_manuscript, stream_manuscript
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import aparse_completion, openai_clients, parse_completion  # noqa: E402
+
+MODEL = "gpt-4o-2024-08-06"
 
 EXAMPLE_MANUSCRIPT = Manuscript(
     title="【爆笑】ウブすぎるイッチの美容院初体験",
@@ -61,32 +71,33 @@ class PseudoBulletinBoardManuscriptGenerator(IManuscriptGenerator):
         super().__init__(logger)
         self.themes = themes
         try:
-            self.openai_client = OpenAI(api_key=openai_apikey)
+            self.openai_client, self.async_openai_client = openai_clients(openai_apikey)
         except ValueError as e:
             raise e
 
-    def generate(self) -> Manuscript:
-        completion = self.openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"与えられるJSONは一般的な2chの会話風景です。このような形式で{','.join(self.themes)}に関する会話を生成してください。",
-                },
-                {
-                    "role": "system",
-                    "content": "なお、会話は必ず30件以上生成してください。30件未満の場合は、会話を続けてください。",
-                },
-                {
-                    "role": "user",
-                    "content": EXAMPLE_MANUSCRIPT.json(
-                        include={"title", "overview", "keywords", "contents"}
-                    ),
-                },
-            ],
-            response_format=Manuscript,
-        )
+    def parameters(self) -> Dict[str, Any]:
+        return {**super().parameters(), "themes": self.themes, "model": MODEL}
+
+    def __messages(self) -> List[ChatCompletionMessageParam]:
+        return [
+            {
+                "role": "system",
+                "content": f"与えられるJSONは一般的な2chの会話風景です。このような形式で{','.join(self.themes)}に関する会話を生成してください。",
+            },
+            {
+                "role": "system",
+                "content": "なお、会話は必ず30件以上生成してください。30件未満の場合は、会話を続けてください。",
+            },
+            *self.avoidance_messages(),
+            {
+                "role": "user",
+                "content": EXAMPLE_MANUSCRIPT.json(
+                    include={"title", "overview", "keywords", "contents"}
+                ),
+            },
+        ]
 
+    def __parse(self, completion: Any) -> Manuscript:
         manuscript = completion.choices[0].message.parsed
         if not manuscript:
             raise Exception("GPT-4oによる文章生成に失敗しました。")
@@ -95,3 +106,46 @@ class PseudoBulletinBoardManuscriptGenerator(IManuscriptGenerator):
         self.logger.info("GPTによる擬似掲示板に基づいた原稿を生成しました")
 
         return manuscript
+
+    def generate(self) -> Manuscript:
+        completion = parse_completion(
+            self.openai_client,
+            MODEL,
+            self.__messages(),
+            Manuscript,
+            "bulletin_manuscript",
+        )
+        return self.__parse(completion)
+
+    async def agenerate(self) -> Manuscript:
+        completion = await aparse_completion(
+            self.async_openai_client,
+            MODEL,
+            self.__messages(),
+            Manuscript,
+            "bulletin_manuscript",
+        )
+        return self.__parse(completion)
+
+    def stream(self, on_content: Callable[[Content], None]) -> Manuscript:
+        # 構造化出力を逐次受け取り、完成した文章から音声合成などを始められるようにする
+        return stream_manuscript(
+            self.openai_client,
+            MODEL,
+            self.__messages(),
+            "bulletin_manuscript",
+            self.__parse,
+            on_content,
+        )
+
+    async def astream(
+        self, on_content: Callable[[Content], Awaitable[None]]
+    ) -> Manuscript:
+        return await astream_manuscript(
+            self.async_openai_client,
+            MODEL,
+            self.__messages(),
+            "bulletin_manuscript",
+            self.__parse,
+            on_content,
+        )
@@ -1,9 +1,66 @@
+import asyncio
+import contextvars
 import logging
-from typing import List
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Set
 
-from openai import OpenAI
+from openai.types.chat import ChatCompletionMessageParam
+from pydantic import BaseModel, Field
 
-from .manuscript_generator import IManuscriptGenerator, Manuscript
+from .manuscript_generator import Content, IManuscriptGenerator, Manuscript
+from .manuscript_index import text_shingles
+from .manuscript_stream import astream_manuscript, stream_manuscript
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import aparse_completion, openai_clients, parse_completion  # noqa: E402
+
+MODEL = "gpt-4o-2024-08-06"
+
+# 分割して生成する場合に、各リクエストで重点的に扱う観点。重複するトリビアを減らす
+SHARD_ASPECTS = [
+    "歴史や由来",
+    "科学的な仕組み",
+    "文化や習慣",
+    "数字や記録",
+    "意外な関係",
+]
+# 重複を除いても num_trivia 個に届くよう、各リクエストで多めに生成する数
+SHARD_EXTRA_TRIVIA = 1
+# 形態素の 3-gram の Jaccard 係数がこれ以上のトリビアは同じ事実とみなす
+DUPLICATE_TRIVIA_THRESHOLD = 0.5
+
+
+class TriviaShard(BaseModel):
+    contents: list[Content] = Field(..., description="トリビアの配列")
+
+
+class ManuscriptSummary(BaseModel):
+    title: str = Field(..., description="動画のタイトル")
+    overview: str = Field(..., description="動画の概要文")
+    keywords: list[str] = Field(
+        ..., description="動画のキーワードであり、コンマ区切りで5個"
+    )
+
+
+def deduplicate_contents(contents: List[Content], threshold: float) -> List[Content]:
+    # 先に現れたトリビアを残し、ほぼ同じ内容のトリビアを取り除く
+    kept: List[Content] = []
+    kept_shingles: List[Set[str]] = []
+    for content in contents:
+        shingles = text_shingles(content.text)
+        if any(
+            len(shingles & other) / len(shingles | other) >= threshold
+            for other in kept_shingles
+            if shingles | other
+        ):
+            continue
+        kept.append(content)
+        kept_shingles.append(shingles)
+    return kept
 
 
 class TriviaManuscriptGenerator(IManuscriptGenerator):
@@ -13,43 +70,53 @@ class TriviaManuscriptGenerator(IManuscriptGenerator):
         num_trivia: int,
         openai_apikey: str,
         logger: logging.Logger,
+        num_shards: int = 1,
     ) -> None:
         super().__init__(logger)
         self.themes = themes
         self.num_trivia = num_trivia
+        # 2以上の場合は、トリビアを分割して並行に生成してから1つの原稿にまとめる
+        self.num_shards = max(1, min(num_shards, num_trivia))
         try:
-            self.openai_client = OpenAI(api_key=openai_apikey)
+            self.openai_client, self.async_openai_client = openai_clients(openai_apikey)
         except ValueError as e:
             raise e
 
-    def generate(self) -> Manuscript:
-        completion = self.openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"{','.join(self.themes)}に関する誰も知らないようなトリビアを{self.num_trivia}個生成してください。できる限り信ぴょう性の高いものを検索に基づいて生成してください。",
-                },
-                {
-                    "role": "system",
-                    "content": "なお、各トリビアはManuscript.content.textに格納してください。",
-                },
-                {
-                    "role": "system",
-                    "content": "また、タイトルは15文字以内としてください。",
-                },
-                {
-                    "role": "system",
-                    "content": "また、各トリビアは50文字以内としてください。",
-                },
-                {
-                    "role": "system",
-                    "content": "また、各トリビアは個人や会社などの特定の団体を中傷する内容や嘘を含んではいけません。",
-                },
-            ],
-            response_format=Manuscript,
-        )
+    def parameters(self) -> Dict[str, Any]:
+        return {
+            **super().parameters(),
+            "themes": self.themes,
+            "num_trivia": self.num_trivia,
+            "num_shards": self.num_shards,
+            "model": MODEL,
+        }
 
+    def __messages(self) -> List[ChatCompletionMessageParam]:
+        return [
+            {
+                "role": "system",
+                "content": f"{','.join(self.themes)}に関する誰も知らないようなトリビアを{self.num_trivia}個生成してください。できる限り信ぴょう性の高いものを検索に基づいて生成してください。",
+            },
+            {
+                "role": "system",
+                "content": "なお、各トリビアはManuscript.content.textに格納してください。",
+            },
+            {
+                "role": "system",
+                "content": "また、タイトルは15文字以内としてください。",
+            },
+            {
+                "role": "system",
+                "content": "また、各トリビアは50文字以内としてください。",
+            },
+            {
+                "role": "system",
+                "content": "また、各トリビアは個人や会社などの特定の団体を中傷する内容や嘘を含んではいけません。",
+            },
+            *self.avoidance_messages(),
+        ]
+
+    def __parse(self, completion: Any) -> Manuscript:
         manuscript = completion.choices[0].message.parsed
         if not manuscript:
             raise Exception("GPT-4oによる文章生成に失敗しました。")
@@ -59,3 +126,200 @@ class TriviaManuscriptGenerator(IManuscriptGenerator):
         self.logger.info("GPTによるトリビアに基づいた原稿を生成しました")
 
         return manuscript
+
+    def __shard_sizes(self) -> List[int]:
+        base, remainder = divmod(self.num_trivia, self.num_shards)
+        return [base + (1 if i < remainder else 0) for i in range(self.num_shards)]
+
+    def __shard_messages(
+        self, index: int, num_trivia: int
+    ) -> List[ChatCompletionMessageParam]:
+        return [
+            {
+                "role": "system",
+                "content": f"{','.join(self.themes)}に関する誰も知らないようなトリビアを{num_trivia}個生成してください。特に{SHARD_ASPECTS[index % len(SHARD_ASPECTS)]}に関するトリビアを中心にしてください。できる限り信ぴょう性の高いものを検索に基づいて生成してください。",
+            },
+            {
+                "role": "system",
+                "content": "なお、各トリビアはcontent.textに格納してください。",
+            },
+            {
+                "role": "system",
+                "content": "また、各トリビアは50文字以内としてください。",
+            },
+            {
+                "role": "system",
+                "content": "また、各トリビアは個人や会社などの特定の団体を中傷する内容や嘘を含んではいけません。",
+            },
+            *self.avoidance_messages(),
+        ]
+
+    def __summary_messages(
+        self, contents: List[Content]
+    ) -> List[ChatCompletionMessageParam]:
+        trivia = "\n".join(f"- {content.text}" for content in contents)
+        return [
+            {
+                "role": "system",
+                "content": f"{','.join(self.themes)}に関する次のトリビアを紹介する動画の、タイトル・概要文・キーワードを生成してください。\n{trivia}",
+            },
+            {
+                "role": "system",
+                "content": "また、タイトルは15文字以内としてください。",
+            },
+        ]
+
+    def __parse_shard(self, completion: Any) -> List[Content]:
+        shard = completion.choices[0].message.parsed
+        if not shard:
+            raise Exception("GPT-4oによる文章生成に失敗しました。")
+        return shard.contents
+
+    def __merge(self, shards: List[List[Content]]) -> List[Content]:
+        contents = deduplicate_contents(
+            [content for shard in shards for content in shard],
+            DUPLICATE_TRIVIA_THRESHOLD,
+        )
+        num_duplicates = sum(len(shard) for shard in shards) - len(contents)
+        if num_duplicates:
+            self.logger.info(f"重複する {num_duplicates} 件のトリビアを除きました")
+        if len(contents) < self.num_trivia:
+            self.logger.warning(
+                f"重複を除いた結果、トリビアが {len(contents)}/{self.num_trivia} 個になりました"
+            )
+        return contents[: self.num_trivia]
+
+    def __finalize(self, contents: List[Content], completion: Any) -> Manuscript:
+        summary = completion.choices[0].message.parsed
+        if not summary:
+            raise Exception("GPT-4oによる文章生成に失敗しました。")
+        manuscript = Manuscript(
+            title=summary.title,
+            overview=summary.overview,
+            keywords=summary.keywords,
+            contents=contents,
+        )
+
+        self.logger.debug(manuscript)
+
+        self.logger.info(
+            f"GPTによるトリビアに基づいた原稿を{self.num_shards}分割して生成しました"
+        )
+
+        return manuscript
+
+    def __generate_shard(self, index: int, num_trivia: int) -> List[Content]:
+        completion = parse_completion(
+            self.openai_client,
+            MODEL,
+            self.__shard_messages(index, num_trivia),
+            TriviaShard,
+            "trivia_shard",
+        )
+        return self.__parse_shard(completion)
+
+    async def __agenerate_shard(self, index: int, num_trivia: int) -> List[Content]:
+        completion = await aparse_completion(
+            self.async_openai_client,
+            MODEL,
+            self.__shard_messages(index, num_trivia),
+            TriviaShard,
+            "trivia_shard",
+        )
+        return self.__parse_shard(completion)
+
+    def __generate_sharded(self) -> Manuscript:
+        # 出力が長いほど応答に時間がかかるため、トリビアを分割して並行に生成する
+        # 使用量の記録やトレースがスレッドでも引き継がれるよう、呼び出し元のコンテキストで実行する
+        with ThreadPoolExecutor(
+            max_workers=self.num_shards, thread_name_prefix="trivia"
+        ) as pool:
+            futures = [
+                pool.submit(
+                    contextvars.copy_context().run,
+                    self.__generate_shard,
+                    index,
+                    size + SHARD_EXTRA_TRIVIA,
+                )
+                for index, size in enumerate(self.__shard_sizes())
+            ]
+            shards = [future.result() for future in futures]
+        contents = self.__merge(shards)
+        # タイトルなどは重複を除いたトリビアから決める
+        completion = parse_completion(
+            self.openai_client,
+            MODEL,
+            self.__summary_messages(contents),
+            ManuscriptSummary,
+            "trivia_summary",
+        )
+        return self.__finalize(contents, completion)
+
+    async def __agenerate_sharded(self) -> Manuscript:
+        shards = await asyncio.gather(
+            *[
+                self.__agenerate_shard(index, size + SHARD_EXTRA_TRIVIA)
+                for index, size in enumerate(self.__shard_sizes())
+            ]
+        )
+        contents = self.__merge(list(shards))
+        completion = await aparse_completion(
+            self.async_openai_client,
+            MODEL,
+            self.__summary_messages(contents),
+            ManuscriptSummary,
+            "trivia_summary",
+        )
+        return self.__finalize(contents, completion)
+
+    def generate(self) -> Manuscript:
+        if self.num_shards > 1:
+            return self.__generate_sharded()
+        completion = parse_completion(
+            self.openai_client,
+            MODEL,
+            self.__messages(),
+            Manuscript,
+            "trivia_manuscript",
+        )
+        return self.__parse(completion)
+
+    async def agenerate(self) -> Manuscript:
+        if self.num_shards > 1:
+            return await self.__agenerate_sharded()
+        completion = await aparse_completion(
+            self.async_openai_client,
+            MODEL,
+            self.__messages(),
+            Manuscript,
+            "trivia_manuscript",
+        )
+        return self.__parse(completion)
+
+    def stream(self, on_content: Callable[[Content], None]) -> Manuscript:
+        # 構造化出力を逐次受け取り、完成した文章から音声合成などを始められるようにする
+        # 分割して生成する場合は、重複を除いた後にまとめて渡す
+        if self.num_shards > 1:
+            return super().stream(on_content)
+        return stream_manuscript(
+            self.openai_client,
+            MODEL,
+            self.__messages(),
+            "trivia_manuscript",
+            self.__parse,
+            on_content,
+        )
+
+    async def astream(
+        self, on_content: Callable[[Content], Awaitable[None]]
+    ) -> Manuscript:
+        if self.num_shards > 1:
+            return await super().astream(on_content)
+        return await astream_manuscript(
+            self.async_openai_client,
+            MODEL,
+            self.__messages(),
+            "trivia_manuscript",
+            self.__parse,
+            on_content,
+        )
@@ -4,4 +4,12 @@ from .dalle_short_movie_generator import (
 from .irasutoya_short_movie_generator import (
     IrasutoyaShortMovieGenerator as IrasutoyaShortMovieGenerator,
 )
+from .movie_generator import INTRO_DURATION as INTRO_DURATION
+from .movie_generator import SHORTS_MAX_DURATION as SHORTS_MAX_DURATION
 from .movie_generator import IMovieGenerator as IMovieGenerator
+from .segment_renderer import ISegmentRenderer as ISegmentRenderer
+from .segment_renderer import LocalSegmentRenderer as LocalSegmentRenderer
+from .segment_renderer import RemoteSegmentRenderer as RemoteSegmentRenderer
+from .segment_renderer import render_segment as render_segment
+from .timeline import Scene as Scene
+from .timeline import Timeline as Timeline
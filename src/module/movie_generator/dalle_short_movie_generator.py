@@ -1,9 +1,10 @@
+import asyncio
 import logging
 import os
 import stat
 import sys
 import wave
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 os.environ["IMAGEIO_FFMPEG_EXE"] = "assets/ffmpeg"
 os.chmod("assets/ffmpeg", stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
@@ -13,25 +14,33 @@ os.chmod(
     stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR,
 )
 
-from moviepy.audio.fx.all import audio_loop, volumex  # noqa: E402
-from moviepy.editor import (  # noqa: E402
-    AudioFileClip,
-    ColorClip,
-    CompositeAudioClip,
-    CompositeVideoClip,
-    ImageClip,
-    TextClip,
-)
 from openai import OpenAI  # noqa: E402
 
-from ..audio_generator import Audio  # noqa: E402
+from ..audio_generator import Audio, Detail  # noqa: E402
 from ..manuscript_generator import Manuscript  # noqa: E402
-from .movie_generator import IMovieGenerator  # noqa: E402
+from .movie_generator import (  # noqa: E402
+    INTRO_DURATION,
+    SHORTS_MAX_DURATION,
+    IMovieGenerator,
+)
+from .timeline import (  # noqa: E402
+    SHORTS_FPS,
+    SHORTS_HEIGHT,
+    SHORTS_WIDTH,
+    Scene,
+    Timeline,
+)
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(parent_dir)
 
-from util import ImageGenerator, wrap_text  # noqa: E402
+from util import (  # noqa: E402
+    ImageGenerator,
+    check_cancelled,
+    file_digest,
+    report_progress,
+    scratch_path,
+)
 
 
 class DalleShortMovieGenerator(IMovieGenerator):
@@ -54,133 +63,97 @@ class DalleShortMovieGenerator(IMovieGenerator):
             openai_apikey=openai_apikey, logger=logger
         )
         self.bgm_file_path = bgm_file_path
+        # agenerate で同時に生成する画像の数
+        self.max_concurrent_images = 4
 
-    def generate(self, manuscript: Manuscript, audio: Audio) -> None:
-        width, height = 1080, 1920
-        font_size = 50
-
-        # 音声を順次結合し、それに合わせて動画を作成する
-        video_clips = []
-        audio_clips: List[AudioFileClip] = []
-        start_time = 0.0
-        total_duration = 0.0
-
-        # trivia では最初にサムネイル画像を3s表示する
-        thumbnail_image_path = os.path.join(self.output_dir, "thumbnail_original.png")
-        intro_duration = 3.0
-        image_clip = (
-            ImageClip(thumbnail_image_path)
-            .resize(height=height)
-            .set_start(start_time)
-            .set_duration(intro_duration)
-        )
+    def parameters(self) -> Dict[str, Any]:
+        return {**super().parameters(), "bgm": file_digest(self.bgm_file_path)}
 
-        video_clip = [image_clip]
-        video_clips += video_clip
-        start_time += intro_duration
-        total_duration += intro_duration
+    def __image_path(self, idx: int) -> str:
+        # 動画の素材としてのみ利用するため、ジョブの作業ディレクトリに置く
+        return scratch_path("movie", f"{idx}.png")
 
-        # 次にcontentsを紹介する
+    def __scenes(self, audio: Audio) -> List[Tuple[int, Detail, float]]:
+        # Shortsの制約に基づき、冒頭のサムネイルを含めて60s以内に収まる文章のみ紹介する
+        scenes = []
+        start_time = INTRO_DURATION
         for idx, content_detail in enumerate(audio.content_details):
-            content_transcript = content_detail.transcript
-            content_wav_file_path = content_detail.wav_file_path
-            with wave.open(content_wav_file_path, "rb") as wav:
+            with wave.open(content_detail.wav_file_path, "rb") as wav:
                 audio_duration = round(wav.getnframes() / wav.getframerate(), 2)
-                # Shortsの制約に基づき60s以内の動画を生成する
-                if start_time + audio_duration >= 60:
-                    break
-                # 内容にふさわしい画像を生成する
-                background_image_path = os.path.join(
-                    self.output_dir, "movie", f"{idx}.png"
-                )
-                self.image_generator.generate_from_text(
-                    text=content_transcript,
-                    image_path=background_image_path,
-                    image_size="1024x1024",
-                )
-                wrapped_texts = wrap_text(content_transcript, width // font_size)
+            if start_time + audio_duration >= SHORTS_MAX_DURATION:
+                break
+            scenes.append((idx, content_detail, audio_duration))
+            start_time += audio_duration
+        return scenes
 
-                audio_clip = (
-                    AudioFileClip(content_wav_file_path)
-                    .set_start(start_time)
-                    .set_duration(audio_duration)
-                    .fx(volumex, 1.0)
-                )
-                subtitle_clips = []
-                if len(wrapped_texts) == 1:
-                    subtitle_clip = (
-                        TextClip(
-                            content_transcript,
-                            font=self.font_path,
-                            fontsize=font_size,
-                            color="black",
-                        )
-                        .set_position(("center", 1500))
-                        .set_start(start_time)
-                        .set_duration(audio_duration)
-                    )
-                    subtitle_clips.append(subtitle_clip)
-                else:
-                    line_height = 70
-                    for i, subtext in enumerate(wrapped_texts):
-                        subtitle_clip = (
-                            TextClip(
-                                subtext,
-                                font=self.font_path,
-                                fontsize=font_size,
-                                color="black",
-                            )
-                            .set_start(start_time)
-                            .set_duration(audio_duration)
-                            .set_position(("center", 1500 + line_height * i))
-                        )
-                        subtitle_clips.append(subtitle_clip)
-
-                white_background_clip = (
-                    ColorClip(size=(width, height), color=(255, 255, 255))
-                    .set_start(start_time)
-                    .set_duration(audio_duration)
+    def generate(self, manuscript: Manuscript, audio: Audio) -> None:
+        scenes = self.__scenes(audio)
+        for idx, content_detail, _ in scenes:
+            # 内容にふさわしい画像を生成する
+            check_cancelled()
+            self.image_generator.generate_from_text(
+                text=content_detail.transcript,
+                image_path=self.__image_path(idx),
+                image_size="1024x1024",
+            )
+            report_progress("image", idx + 1, len(audio.content_details))
+        self.__render(scenes)
+
+    async def agenerate(self, manuscript: Manuscript, audio: Audio) -> None:
+        # 画像生成の API 呼び出しは並行して待ち、動画の書き出しのみスレッドで実行する
+        scenes = self.__scenes(audio)
+        semaphore = asyncio.Semaphore(self.max_concurrent_images)
+        done = 0
+
+        async def generate_image(idx: int, content_detail: Detail) -> None:
+            nonlocal done
+            async with semaphore:
+                await self.image_generator.agenerate_from_text(
+                    text=content_detail.transcript,
+                    image_path=self.__image_path(idx),
+                    image_size="1024x1024",
                 )
-                image_clip = (
-                    ImageClip(background_image_path)
-                    .set_position(("center", "center"))
-                    .set_start(start_time)
-                    .set_duration(audio_duration)
+            done += 1
+            report_progress("image", done, len(audio.content_details))
+
+        # 1枚でも失敗した場合は残りの画像生成を取り消す
+        async with asyncio.TaskGroup() as group:
+            for idx, content_detail, _ in scenes:
+                group.create_task(generate_image(idx, content_detail))
+        await asyncio.to_thread(self.__render, scenes)
+
+    def __render(self, scenes: List[Tuple[int, Detail, float]]) -> None:
+        # trivia では最初にサムネイル画像を表示し、次にcontentsを紹介する
+        timeline_scenes = []
+        start_time = INTRO_DURATION
+        for idx, content_detail, audio_duration in scenes:
+            timeline_scenes.append(
+                Scene(
+                    start=start_time,
+                    duration=audio_duration,
+                    transcript=content_detail.transcript,
+                    wav_file_path=content_detail.wav_file_path,
+                    image_path=self.__image_path(idx),
                 )
-
-                video_clip = [white_background_clip, image_clip] + subtitle_clips
-                video_clips += video_clip
-                audio_clips.append(audio_clip)
-                start_time += audio_duration
-                total_duration += audio_duration
-
-        # BGM
-        bgm_clip = (
-            AudioFileClip(self.bgm_file_path)
-            .fx(audio_loop, duration=total_duration)
-            .fx(volumex, 0.1)
-        )
-
-        # クリップの合成
-        video = CompositeVideoClip(video_clips)
-        audio = CompositeAudioClip([bgm_clip] + audio_clips)
-        video = video.set_audio(audio)
-
-        # 動画の保存
-        os.remove(self.output_movie_path) if os.path.exists(
-            self.output_movie_path
-        ) else None
-        video.write_videofile(
-            self.output_movie_path,
-            codec="libx264",
-            fps=30,
-            audio_codec="aac",
-            temp_audiofile="temp-audio.m4a",
-            remove_temp=True,
+            )
+            start_time += audio_duration
+        self.write(
+            Timeline(
+                layout="dalle",
+                width=SHORTS_WIDTH,
+                height=SHORTS_HEIGHT,
+                fps=SHORTS_FPS,
+                font_path=self.font_path,
+                intro_image_path=os.path.join(
+                    self.output_dir, "thumbnail_original.png"
+                ),
+                intro_duration=INTRO_DURATION,
+                scenes=timeline_scenes,
+                bgm_file_path=self.bgm_file_path,
+                bgv_file_path=None,
+            )
         )
 
         self.logger.info(
             f"Dall-Eを用いた短尺動画を生成しました: {self.output_movie_path}"
         )
-
-        return
@@ -0,0 +1,132 @@
+import math
+import os
+import sys
+from typing import Callable, Dict, List
+
+from moviepy.editor import (
+    ColorClip,
+    CompositeVideoClip,
+    ImageClip,
+    TextClip,
+    VideoClip,
+    VideoFileClip,
+)
+
+from .timeline import Scene, Timeline
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import wrap_text  # noqa: E402
+
+FONT_SIZE = 50
+LINE_HEIGHT = 70
+
+
+def subtitle_clips(
+    timeline: Timeline, scene: Scene, num_text_per_line: int, top: int
+) -> List[VideoClip]:
+    wrapped_texts = wrap_text(scene.transcript, num_text_per_line)
+    if len(wrapped_texts) == 1:
+        return [
+            TextClip(
+                scene.transcript,
+                font=timeline.font_path,
+                fontsize=FONT_SIZE,
+                color="black",
+            )
+            .set_position(("center", 1500))
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        ]
+    return [
+        TextClip(
+            text,
+            font=timeline.font_path,
+            fontsize=FONT_SIZE,
+            color="black",
+        )
+        .set_start(scene.start)
+        .set_duration(scene.duration)
+        .set_position(("center", top + LINE_HEIGHT * i))
+        for i, text in enumerate(wrapped_texts)
+    ]
+
+
+def intro_clip(timeline: Timeline) -> VideoClip:
+    return (
+        ImageClip(timeline.intro_image_path)
+        .resize(height=timeline.height)
+        .set_start(0.0)
+        .set_duration(timeline.intro_duration)
+    )
+
+
+def compose_irasutoya_video(timeline: Timeline) -> CompositeVideoClip:
+    # 背景動画の上に、話者の画像とホワイトボード風の字幕を重ねる
+    video_clips = [intro_clip(timeline)]
+    for scene in timeline.scenes:
+        white_board_edge_clip = (
+            ColorClip(size=(1000, 550), color=(222, 184, 135))
+            .set_position(("center", 1300))
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        )
+        white_board_clip = (
+            ColorClip(size=(960, 530), color=(255, 255, 255))
+            .set_position(("center", 1300))
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        )
+        image_clip = (
+            ImageClip(scene.image_path)
+            .set_position(lambda t: ("center", 300 + 50 * math.sin(2 * math.pi * t)))
+            .resize(height=900)
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        )
+        video_clips += (
+            [white_board_edge_clip, white_board_clip]
+            + subtitle_clips(timeline, scene, timeline.width // FONT_SIZE - 2, top=1400)
+            + [image_clip]
+        )
+
+    # BGV
+    assert timeline.bgv_file_path is not None
+    bgv_clip = (
+        VideoFileClip(timeline.bgv_file_path)
+        .resize((timeline.width, timeline.height))
+        .loop(duration=timeline.total_duration)
+    )
+    return CompositeVideoClip([bgv_clip] + video_clips)
+
+
+def compose_dalle_video(timeline: Timeline) -> CompositeVideoClip:
+    # 白背景の中央に生成した画像を表示し、その下に字幕を表示する
+    video_clips = [intro_clip(timeline)]
+    for scene in timeline.scenes:
+        white_background_clip = (
+            ColorClip(size=(timeline.width, timeline.height), color=(255, 255, 255))
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        )
+        image_clip = (
+            ImageClip(scene.image_path)
+            .set_position(("center", "center"))
+            .set_start(scene.start)
+            .set_duration(scene.duration)
+        )
+        video_clips += [white_background_clip, image_clip] + subtitle_clips(
+            timeline, scene, timeline.width // FONT_SIZE, top=1500
+        )
+    return CompositeVideoClip(video_clips)
+
+
+LAYOUTS: Dict[str, Callable[[Timeline], CompositeVideoClip]] = {
+    "irasutoya": compose_irasutoya_video,
+    "dalle": compose_dalle_video,
+}
+
+
+def compose_video(timeline: Timeline) -> CompositeVideoClip:
+    return LAYOUTS[timeline.layout](timeline)
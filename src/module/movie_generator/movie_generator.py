@@ -1,14 +1,33 @@
 import abc
+import asyncio
 import logging
 import os
 import sys
+from typing import Any, Dict, Optional
 
 from ..audio_generator import Audio
 from ..manuscript_generator import Manuscript
+from .layouts import compose_video
+from .segment_renderer import ISegmentRenderer
+from .timeline import Timeline, compose_audio
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(parent_dir)
 
+from util import (  # noqa: E402
+    MoviePyProgressLogger,
+    file_digest,
+    granted_cpu,
+    publish,
+    scratch_path,
+    span,
+)
+
+# Shorts として投稿できる動画の長さの上限 [s]。冒頭のサムネイルを含めてこれ未満に収める
+SHORTS_MAX_DURATION = 60.0
+# 冒頭にサムネイル画像を表示する時間 [s]
+INTRO_DURATION = 3.0
+
 
 class IMovieGenerator(metaclass=abc.ABCMeta):
     def __init__(
@@ -24,7 +43,53 @@ class IMovieGenerator(metaclass=abc.ABCMeta):
         self.output_dir = output_dir
         self.output_movie_path = os.path.join(output_dir, "movie.mp4")
         os.makedirs(os.path.dirname(self.output_movie_path), exist_ok=True)
+        # segment_renderer を指定した場合は動画を区間に分けて複数のプロセスやノードで書き出す
+        self.segment_renderer: Optional[ISegmentRenderer] = None
 
     @abc.abstractmethod
     def generate(self, manuscript: Manuscript, audio: Audio) -> None:
         pass
+
+    async def agenerate(self, manuscript: Manuscript, audio: Audio) -> None:
+        # 動画の書き出しは CPU の処理が大半のため、スレッドで実行してイベントループを止めない
+        await asyncio.to_thread(self.generate, manuscript, audio)
+
+    def write(self, timeline: Timeline) -> None:
+        # ジョブの作業ディレクトリに書き出し、完了後に出力先へ配置する
+        movie_path = scratch_path("movie.mp4")
+        if self.segment_renderer is not None:
+            self.segment_renderer.render(timeline, movie_path)
+            publish(movie_path, self.output_movie_path)
+            return
+
+        # クリップの合成
+        video = compose_video(timeline).set_audio(compose_audio(timeline))
+
+        # 動画の保存
+        # キャンセルや失敗で中断された場合の書きかけのファイルは、作業ディレクトリごと削除される
+        with span(
+            "moviepy.write_videofile",
+            category="render",
+            duration=timeline.total_duration,
+            num_clips=len(video.clips),
+        ):
+            video.write_videofile(
+                movie_path,
+                codec="libx264",
+                fps=timeline.fps,
+                audio_codec="aac",
+                temp_audiofile=scratch_path("temp-audio.m4a"),
+                remove_temp=True,
+                # ガバナーから割り当てられたCPU数に libx264 のスレッド数を合わせる
+                threads=granted_cpu(),
+                logger=MoviePyProgressLogger(),
+            )
+        publish(movie_path, self.output_movie_path)
+
+    def parameters(self) -> Dict[str, Any]:
+        # 生成結果に影響するパラメータであり、成果物のキャッシュキーに利用する
+        return {
+            "generator": type(self).__name__,
+            "is_short": self.is_short,
+            "font": file_digest(self.font_path),
+        }
@@ -0,0 +1,332 @@
+import abc
+import contextvars
+import logging
+import math
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+from moviepy.config import get_setting
+
+from .layouts import compose_video
+from .timeline import Timeline, compose_audio
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+
+from util import check_cancelled, file_digest, granted_cpu, report_progress, span  # noqa: E402
+
+# フレーム番号で表した区間 [開始, 終了)
+FrameRange = Tuple[int, int]
+
+
+def plan_segments(timeline: Timeline, num_segments: int) -> List[FrameRange]:
+    # シーンの境目で分割し、各区間の長さがなるべく揃うようにする
+    # 境目をフレームの位置に揃えるため、区間ごとに書き出したフレームは一括で書き出した場合と一致する
+    fps = timeline.fps
+    total_frames = math.ceil(timeline.total_duration * fps)
+    boundaries = sorted(
+        {round(scene.start * fps) for scene in timeline.scenes} - {0, total_frames}
+    )
+    cuts = {0, total_frames}
+    for i in range(1, num_segments):
+        if boundaries:
+            target = total_frames * i / num_segments
+            cuts.add(min(boundaries, key=lambda boundary: abs(boundary - target)))
+    points = sorted(cuts)
+    return [(start, end) for start, end in zip(points, points[1:]) if end > start]
+
+
+def render_segment(
+    timeline: Timeline,
+    frames: FrameRange,
+    output_path: str,
+    threads: Optional[int] = None,
+) -> None:
+    # 区間の映像のみを書き出す。音声は結合時に動画全体で1つのものを利用する
+    start_frame, end_frame = frames
+    fps = timeline.fps
+    # moviepy は [0, duration) を 1/fps 刻みで書き出すため、終端を半フレーム手前にしてフレーム数を揃える
+    end = min((end_frame - 0.5) / fps, timeline.total_duration)
+    video = compose_video(timeline).subclip(start_frame / fps, end)
+    video.write_videofile(
+        output_path,
+        codec="libx264",
+        fps=fps,
+        audio=False,
+        threads=threads,
+        logger=None,
+    )
+
+
+def render_audio(timeline: Timeline, output_path: str) -> None:
+    compose_audio(timeline).write_audiofile(
+        output_path, fps=44100, codec="aac", logger=None
+    )
+
+
+def concat_segments(
+    segment_paths: List[str], audio_path: str, output_path: str
+) -> None:
+    # 同じ設定でエンコードした区間を再エンコードせずに連結し、音声を多重化する
+    list_path = f"{output_path}.segments.txt"
+    with open(list_path, "w", encoding="utf-8") as file:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            file.write(f"file '{escaped}'\n")
+    try:
+        result = subprocess.run(
+            [
+                get_setting("FFMPEG_BINARY"),
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_path,
+                "-i",
+                audio_path,
+                "-map",
+                "0:v",
+                "-map",
+                "1:a",
+                "-c",
+                "copy",
+                "-movflags",
+                "+faststart",
+                output_path,
+            ],
+            capture_output=True,
+        )
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        raise Exception(
+            f"区間の結合に失敗しました: {result.stderr.decode('utf-8', 'replace')}"
+        )
+
+
+class ISegmentRenderer(metaclass=abc.ABCMeta):
+    def __init__(
+        self, logger: logging.Logger, num_segments: Optional[int] = None
+    ) -> None:
+        # 動画を区間に分けて並行して書き出し、最後に再エンコードせずに連結する
+        self.logger = logger
+        self.num_segments = num_segments
+
+    @abc.abstractmethod
+    def slots(self) -> int:
+        # 同時に書き出せる区間の数
+        pass
+
+    @abc.abstractmethod
+    def render_segment(
+        self, timeline: Timeline, frames: FrameRange, output_path: str
+    ) -> None:
+        pass
+
+    def render(self, timeline: Timeline, output_path: str) -> None:
+        # 書き出し先が空くのを待つ間に偏りが出ないよう、既定では書き出し先の2倍の区間に分ける
+        segments = plan_segments(
+            timeline,
+            self.num_segments if self.num_segments is not None else 2 * self.slots(),
+        )
+        work_dir = f"{output_path}.segments"
+        os.makedirs(work_dir, exist_ok=True)
+        segment_paths = [
+            os.path.join(work_dir, f"{i:04d}.mp4") for i in range(len(segments))
+        ]
+        audio_path = os.path.join(work_dir, "audio.m4a")
+        self.logger.info(f"動画を{len(segments)}個の区間に分けて書き出します")
+        try:
+            with span(
+                "segments.render",
+                category="render",
+                num_segments=len(segments),
+                slots=self.slots(),
+            ):
+                self.__render_all(timeline, segments, segment_paths, audio_path)
+            with span("segments.concat", category="render"):
+                concat_segments(segment_paths, audio_path, output_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def __render_all(
+        self,
+        timeline: Timeline,
+        segments: List[FrameRange],
+        segment_paths: List[str],
+        audio_path: str,
+    ) -> None:
+        # 区間の映像と並行して、音声を動画全体で1つ書き出す
+        with ThreadPoolExecutor(
+            max_workers=self.slots() + 1, thread_name_prefix="segment"
+        ) as pool:
+            futures: Dict[Future, str] = {
+                pool.submit(
+                    contextvars.copy_context().run, render_audio, timeline, audio_path
+                ): "audio"
+            }
+            for frames, path in zip(segments, segment_paths):
+                futures[
+                    pool.submit(
+                        contextvars.copy_context().run,
+                        self.render_segment,
+                        timeline,
+                        frames,
+                        path,
+                    )
+                ] = "segment"
+            done_segments = 0
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = wait(
+                        pending, timeout=0.5, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        future.result()
+                        if futures[future] == "segment":
+                            done_segments += 1
+                            report_progress("segment", done_segments, len(segments))
+                    check_cancelled()
+            finally:
+                # 失敗時はまだ開始していない区間を書き出さない
+                for future in pending:
+                    future.cancel()
+
+
+class LocalSegmentRenderer(ISegmentRenderer):
+    def __init__(
+        self,
+        processes: int,
+        logger: logging.Logger,
+        num_segments: Optional[int] = None,
+    ) -> None:
+        # ローカルの子プロセスを書き出し先とする。動作確認や1台での並列化に利用する
+        super().__init__(logger, num_segments)
+        self.processes = processes
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.threads: Optional[int] = None
+
+    def slots(self) -> int:
+        return self.processes
+
+    def render(self, timeline: Timeline, output_path: str) -> None:
+        # ガバナーから割り当てられたCPU数をプロセスで分け合う
+        cpu = granted_cpu() or os.cpu_count() or 1
+        self.threads = max(1, cpu // self.processes)
+        with ProcessPoolExecutor(max_workers=self.processes) as self.pool:
+            super().render(timeline, output_path)
+        self.pool = None
+
+    def render_segment(
+        self, timeline: Timeline, frames: FrameRange, output_path: str
+    ) -> None:
+        assert self.pool is not None
+        future = self.pool.submit(
+            render_segment, timeline, frames, output_path, self.threads
+        )
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return
+            except TimeoutError:
+                check_cancelled()
+
+
+class RemoteSegmentRenderer(ISegmentRenderer):
+    def __init__(
+        self,
+        urls: List[str],
+        logger: logging.Logger,
+        slots_per_worker: int = 1,
+        num_segments: Optional[int] = None,
+        timeout: float = 600.0,
+    ) -> None:
+        # HTTP で区間の書き出しを受け付けるノード (cli.py render-worker) を書き出し先とする
+        super().__init__(logger, num_segments)
+        self.urls = [url.rstrip("/") for url in urls]
+        self.slots_per_worker = slots_per_worker
+        self.timeout = timeout
+        # 空いている書き出し先から順に区間を割り当てる
+        self.available: queue.Queue[str] = queue.Queue()
+        for url in self.urls:
+            for _ in range(slots_per_worker):
+                self.available.put(url)
+        self.uploaded: Dict[str, Set[str]] = {url: set() for url in self.urls}
+        self.upload_lock = threading.Lock()
+
+    def slots(self) -> int:
+        return len(self.urls) * self.slots_per_worker
+
+    def __upload_assets(self, url: str, timeline: Timeline) -> Dict[str, str]:
+        # 素材はハッシュ値で識別し、書き出し先がまだ持っていないものだけを送る
+        names: Dict[str, str] = {}
+        for path in timeline.video_asset_paths():
+            name = f"{file_digest(path)}{os.path.splitext(path)[1].lower()}"
+            names[path] = name
+            with self.upload_lock:
+                if name in self.uploaded[url]:
+                    continue
+            response = requests.head(f"{url}/assets/{name}", timeout=self.timeout)
+            if response.status_code == 404:
+                with span("segments.upload", category="http", url=url, asset=path):
+                    with open(path, "rb") as file:
+                        response = requests.put(
+                            f"{url}/assets/{name}", data=file, timeout=self.timeout
+                        )
+            if response.status_code >= 400:
+                raise Exception(
+                    f"素材の送信に失敗しました ({url}, {path}): {response.status_code} {response.text}"
+                )
+            with self.upload_lock:
+                self.uploaded[url].add(name)
+        return names
+
+    def render_segment(
+        self, timeline: Timeline, frames: FrameRange, output_path: str
+    ) -> None:
+        while True:
+            try:
+                url = self.available.get(timeout=0.5)
+                break
+            except queue.Empty:
+                check_cancelled()
+        try:
+            names = self.__upload_assets(url, timeline)
+            with span("segments.remote", category="http", url=url, frames=frames):
+                with requests.post(
+                    f"{url}/segments",
+                    json={
+                        "timeline": timeline.with_video_assets(names).dict(),
+                        "start_frame": frames[0],
+                        "end_frame": frames[1],
+                    },
+                    stream=True,
+                    timeout=self.timeout,
+                ) as response:
+                    if response.status_code != 200:
+                        raise Exception(
+                            f"区間の書き出しに失敗しました ({url}): {response.status_code} {response.text}"
+                        )
+                    with open(output_path, "wb") as file:
+                        for chunk in response.iter_content(1024 * 1024):
+                            file.write(chunk)
+        finally:
+            self.available.put(url)
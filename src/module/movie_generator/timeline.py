@@ -0,0 +1,78 @@
+from typing import Dict, List, Literal, Optional
+
+from moviepy.audio.fx.all import audio_loop, volumex
+from moviepy.editor import AudioFileClip, CompositeAudioClip
+from pydantic import BaseModel, Field
+
+# Shorts の縦長動画の解像度とフレームレート
+SHORTS_WIDTH = 1080
+SHORTS_HEIGHT = 1920
+SHORTS_FPS = 30
+
+
+class Scene(BaseModel):
+    start: float = Field(description="シーンの開始時刻 [s]")
+    duration: float = Field(description="シーンの長さ [s]")
+    transcript: str = Field(description="字幕として表示する文章")
+    wav_file_path: str = Field(description="シーンの音声ファイルのパス")
+    image_path: str = Field(description="シーンに表示する画像のパス")
+
+
+class Timeline(BaseModel):
+    # 動画の構成を表す。クリップはこの内容のみから組み立てるため、別のプロセスやノードでも同じ動画を書き出せる
+    layout: Literal["irasutoya", "dalle"] = Field(description="画面の構成")
+    width: int = Field(SHORTS_WIDTH, description="動画の幅")
+    height: int = Field(SHORTS_HEIGHT, description="動画の高さ")
+    fps: int = Field(SHORTS_FPS, description="動画のフレームレート")
+    font_path: str = Field(description="字幕のフォントファイルのパス")
+    intro_image_path: str = Field(description="冒頭に表示する画像のパス")
+    intro_duration: float = Field(description="冒頭の画像を表示する長さ [s]")
+    scenes: List[Scene] = Field(description="冒頭に続いて紹介する各シーン")
+    bgm_file_path: str = Field(description="BGMファイルのパス")
+    bgv_file_path: Optional[str] = Field(None, description="背景動画ファイルのパス")
+
+    @property
+    def total_duration(self) -> float:
+        return self.intro_duration + sum(scene.duration for scene in self.scenes)
+
+    def video_asset_paths(self) -> List[str]:
+        # 映像の書き出しに必要なファイル。音声は書き出しを分担するノードには送らない
+        paths = [self.font_path, self.intro_image_path] + [
+            scene.image_path for scene in self.scenes
+        ]
+        if self.bgv_file_path is not None:
+            paths.append(self.bgv_file_path)
+        return list(dict.fromkeys(paths))
+
+    def with_video_assets(self, mapping: Dict[str, str]) -> "Timeline":
+        # 映像に必要なファイルのパスを mapping に従って置き換えた複製を返す
+        return self.copy(
+            update={
+                "font_path": mapping[self.font_path],
+                "intro_image_path": mapping[self.intro_image_path],
+                "scenes": [
+                    scene.copy(update={"image_path": mapping[scene.image_path]})
+                    for scene in self.scenes
+                ],
+                "bgv_file_path": mapping[self.bgv_file_path]
+                if self.bgv_file_path is not None
+                else None,
+            }
+        )
+
+
+def compose_audio(timeline: Timeline) -> CompositeAudioClip:
+    audio_clips = [
+        AudioFileClip(scene.wav_file_path)
+        .set_start(scene.start)
+        .set_duration(scene.duration)
+        .fx(volumex, 1.0)
+        for scene in timeline.scenes
+    ]
+    # BGM
+    bgm_clip = (
+        AudioFileClip(timeline.bgm_file_path)
+        .fx(audio_loop, duration=timeline.total_duration)
+        .fx(volumex, 0.1)
+    )
+    return CompositeAudioClip([bgm_clip] + audio_clips)
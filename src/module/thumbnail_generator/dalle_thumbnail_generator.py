@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import sys
@@ -10,7 +11,7 @@ from .thumbnail_generator import IThumbnailGenerator, Manuscript
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(parent_dir)
 
-from util import ImageGenerator, wrap_text  # noqa: E402
+from util import ImageGenerator, publish, scratch_path, wrap_text  # noqa: E402
 
 
 class DalleThumbnailGenerator(IThumbnailGenerator):
@@ -30,16 +31,31 @@ class DalleThumbnailGenerator(IThumbnailGenerator):
             openai_apikey=openai_apikey, logger=logger
         )
 
-    def generate(self, manuscript: Manuscript) -> None:
-        width, height = 1080, 1920
+    @property
+    def background_image_path(self) -> str:
+        return scratch_path("original_background.png")
 
-        background_image_path = os.path.join(self.output_dir, "original_background.png")
+    def generate(self, manuscript: Manuscript) -> None:
         self.image_generator.generate_from_keywords(
             keywords=manuscript.keywords,
-            image_path=background_image_path,
+            image_path=self.background_image_path,
+            image_size="1024x1024",
+        )
+        self.__compose(manuscript)
+
+    async def agenerate(self, manuscript: Manuscript) -> None:
+        # 画像生成は非同期に待ち、画像の合成のみスレッドで実行する
+        await self.image_generator.agenerate_from_keywords(
+            keywords=manuscript.keywords,
+            image_path=self.background_image_path,
             image_size="1024x1024",
         )
-        background = Image.open(background_image_path).convert("RGBA")
+        await asyncio.to_thread(self.__compose, manuscript)
+
+    def __compose(self, manuscript: Manuscript) -> None:
+        width, height = 1080, 1920
+
+        background = Image.open(self.background_image_path).convert("RGBA")
         background = background.resize((1024, 1024))
 
         canvas = Image.new("RGBA", (width, height), (255, 255, 255, 255))
@@ -72,10 +88,14 @@ class DalleThumbnailGenerator(IThumbnailGenerator):
                 y_bottom += text_height + 10
 
         # 後続の動画生成で使えるようにオリジナルサイズの画像を保存する
-        canvas.save(self.output_original_thumbnail_path, quality=85)
+        original_thumbnail_path = scratch_path("thumbnail_original.png")
+        canvas.save(original_thumbnail_path, quality=85)
         # ショート動画のアップロード用にミニサイズをサムネイルとして保存する
         canvas = canvas.resize((width // 2, height // 2), Image.ANTIALIAS)
-        canvas.save(self.output_thumbnail_path, quality=85)
+        thumbnail_path = scratch_path("thumbnail.png")
+        canvas.save(thumbnail_path, quality=85)
+        publish(original_thumbnail_path, self.output_original_thumbnail_path)
+        publish(thumbnail_path, self.output_thumbnail_path)
 
         self.logger.info(
             f"Dall-Eを用いてサムネイル画像を生成しました 縮小版: {self.output_thumbnail_path}"
@@ -1,13 +1,17 @@
 import abc
+import asyncio
 import logging
 import os
 import sys
+from typing import Any, Dict
 
 from ..manuscript_generator import Manuscript
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(parent_dir)
 
+from util import file_digest  # noqa: E402
+
 
 class IThumbnailGenerator(metaclass=abc.ABCMeta):
     def __init__(
@@ -33,5 +37,13 @@ class IThumbnailGenerator(metaclass=abc.ABCMeta):
     ) -> None:
         pass
 
+    async def agenerate(self, manuscript: Manuscript) -> None:
+        # 非同期の API を利用できない生成器はスレッドで実行し、イベントループを止めない
+        await asyncio.to_thread(self.generate, manuscript)
+
     def skip(self) -> None:
         pass
+
+    def parameters(self) -> Dict[str, Any]:
+        # 生成結果に影響するパラメータであり、成果物のキャッシュキーに利用する
+        return {"generator": type(self).__name__, "font": file_digest(self.font_path)}
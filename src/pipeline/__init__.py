@@ -0,0 +1,12 @@
+from .cache import ArtifactCache as ArtifactCache
+from .cache import ArtifactCodec as ArtifactCodec
+from .executor import StageExecutionError as StageExecutionError
+from .executor import StageGraphExecutor as StageGraphExecutor
+from .history import DEFAULT_HISTORY_PATH as DEFAULT_HISTORY_PATH
+from .history import JobEstimate as JobEstimate
+from .history import StageEstimate as StageEstimate
+from .history import StageHistory as StageHistory
+from .stage import Stage as Stage
+from .stages import AUDIO_STAGE_RESOURCES as AUDIO_STAGE_RESOURCES
+from .stages import build_artifact_cache as build_artifact_cache
+from .stages import build_stages as build_stages
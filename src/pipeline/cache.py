@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from util import file_digest, json_digest  # noqa: E402
+
+
+class ArtifactCodec:
+    def __init__(
+        self,
+        dump: Callable[[Any, str], Any],
+        load: Callable[[Any, str], Any],
+        files: Callable[[Any], List[str]],
+    ) -> None:
+        # dump/load は成果物とJSONを相互変換する。パスはルートディレクトリからの相対パスで保存する
+        self.dump = dump
+        self.load = load
+        self.files = files
+
+
+class ArtifactCache:
+    def __init__(
+        self,
+        output_dir: str,
+        root_dir: str,
+        codecs: Dict[str, ArtifactCodec],
+        logger: logging.Logger,
+    ) -> None:
+        self.output_dir = output_dir
+        self.root_dir = root_dir
+        self.codecs = codecs
+        self.logger = logger
+        self.manifest_path = os.path.join(output_dir, "manifest.json")
+        self.objects_dir = os.path.join(output_dir, "cache")
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def __read_manifest(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_path):
+            return {"stages": {}}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"キャッシュのマニフェストを読み込めませんでした: {e}")
+            return {"stages": {}}
+
+    def __write_manifest(self, manifest: Dict[str, Any]) -> None:
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def __link(self, source_path: str, path: str) -> None:
+        # 同じ内容のファイルを複製せずハードリンクで共有する。出力先のファイルは常に置き換えで
+        # 書き出されるため、リンク先の内容が書き換わることはない
+        try:
+            os.link(source_path, f"{path}.tmp")
+        except OSError:
+            # ハードリンクを作れないファイルシステムでは複製する
+            shutil.copy2(source_path, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def __collect(self, manifest: Dict[str, Any]) -> None:
+        # マニフェストから参照されなくなったファイルを削除する
+        referenced = {
+            digest
+            for entry in manifest["stages"].values()
+            for digest in entry["files"].values()
+        }
+        for name in os.listdir(self.objects_dir):
+            if name not in referenced and not name.endswith(".tmp"):
+                os.remove(os.path.join(self.objects_dir, name))
+
+    def __relpath(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root_dir))
+
+    def __abspath(self, relpath: str) -> str:
+        return os.path.join(self.root_dir, relpath)
+
+    def fingerprint(self, name: str, value: Any) -> Dict[str, Any]:
+        codec = self.codecs[name]
+        return {
+            "data": codec.dump(value, self.root_dir),
+            "files": {
+                self.__relpath(path): file_digest(path) for path in codec.files(value)
+            },
+        }
+
+    def key(
+        self, stage_name: str, parameters: Dict[str, Any], inputs: Dict[str, Any]
+    ) -> str:
+        # ステージの入力成果物の内容とパラメータのみからキーを算出する
+        return json_digest(
+            {
+                "stage": stage_name,
+                "parameters": parameters,
+                "inputs": {
+                    name: self.fingerprint(name, value)
+                    for name, value in sorted(inputs.items())
+                },
+            }
+        )
+
+    def load(self, stage_name: str, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.__read_manifest()["stages"].get(stage_name)
+        if entry is None or entry["key"] != key:
+            return None
+
+        for relpath, digest in entry["files"].items():
+            path = self.__abspath(relpath)
+            if os.path.exists(path) and file_digest(path) == digest:
+                continue
+            object_path = os.path.join(self.objects_dir, digest)
+            if not os.path.exists(object_path):
+                self.logger.warning(
+                    f"キャッシュされたファイルが見つかりません: {relpath}"
+                )
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.__link(object_path, path)
+
+        return {
+            name: self.codecs[name].load(data, self.root_dir)
+            for name, data in entry["outputs"].items()
+        }
+
+    def store(self, stage_name: str, key: str, outputs: Dict[str, Any]) -> None:
+        paths = {
+            path: file_digest(path)
+            for name, value in outputs.items()
+            for path in self.codecs[name].files(value)
+        }
+        files = {self.__relpath(path): digest for path, digest in paths.items()}
+
+        with self.lock:
+            # 他のステージの保存で参照されていないファイルとして削除されないよう、ロック内で配置する
+            for path, digest in paths.items():
+                object_path = os.path.join(self.objects_dir, digest)
+                if not os.path.exists(object_path):
+                    self.__link(path, object_path)
+            manifest = self.__read_manifest()
+            manifest["stages"][stage_name] = {
+                "key": key,
+                "outputs": {
+                    name: self.codecs[name].dump(value, self.root_dir)
+                    for name, value in outputs.items()
+                },
+                "files": files,
+                "created_at": time.time(),
+            }
+            self.__write_manifest(manifest)
+            self.__collect(manifest)
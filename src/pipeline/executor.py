@@ -0,0 +1,499 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import AsyncExitStack, ExitStack, nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from util import (  # noqa: E402
+    JobCancelledError,
+    ProgressReporter,
+    ResourceGovernor,
+    ResourceMonitor,
+    SamplingProfiler,
+    Tracer,
+    UsageRecorder,
+    check_cancelled,
+    progress_reporting,
+    scratch_directory,
+    span,
+    stage_scope,
+    tracing,
+    usage_recording,
+)
+
+from .cache import ArtifactCache  # noqa: E402
+from .history import JobEstimate, StageEstimate, StageHistory  # noqa: E402
+from .stage import Stage  # noqa: E402
+
+
+class StageExecutionError(Exception):
+    def __init__(self, stage: Stage, error: BaseException) -> None:
+        super().__init__(f"{stage.label}中にエラーが発生しました。 {error}")
+        self.stage = stage
+        self.error = error
+
+
+class StageGraphExecutor:
+    def __init__(
+        self,
+        stages: List[Stage],
+        logger: logging.Logger,
+        max_workers: Optional[int] = None,
+        on_stage_start: Optional[Callable[[Stage], None]] = None,
+        on_stage_end: Optional[Callable[[Stage], None]] = None,
+        cache: Optional[ArtifactCache] = None,
+        trace_path: Optional[str] = None,
+        progress: Optional[ProgressReporter] = None,
+        resource_report_path: Optional[str] = None,
+        governor: Optional[ResourceGovernor] = None,
+        history: Optional[StageHistory] = None,
+        profile_stages: Optional[List[str]] = None,
+        profile_dir: Optional[str] = None,
+        scratch_dir: Optional[str] = None,
+        usage_path: Optional[str] = None,
+    ) -> None:
+        self.stages = stages
+        self.logger = logger
+        self.max_workers = max_workers if max_workers is not None else len(stages)
+        self.on_stage_start = on_stage_start
+        self.on_stage_end = on_stage_end
+        self.cache = cache
+        # trace_path を指定した場合は実行後に Chrome trace 形式でトレースを書き出す
+        self.trace_path = trace_path
+        self.tracer = Tracer()
+        # progress を指定した場合は各ステージの細かな進捗を通知し、キャンセルを受け付ける
+        self.progress = progress if progress is not None else ProgressReporter()
+        # resource_report_path を指定した場合はステージごとのメモリ・CPU・I/O・子プロセス数を計測して書き出す
+        self.resource_report_path = resource_report_path
+        # governor を指定した場合は負荷の高いステージを予算の範囲内でのみ実行する
+        self.governor = governor
+        self.resources = ResourceMonitor() if resource_report_path is not None else None
+        # history を指定した場合は完了したステージの所要時間を記録し、残り時間の予測に利用する
+        self.history = history
+        self.artifacts: Dict[str, Any] = {}
+        self.started_at: Dict[str, float] = {}
+        self.finished: List[str] = []
+        self.predictions: Optional[Dict[str, Optional[float]]] = None
+        self.generators: Dict[str, Optional[str]] = {}
+        self.estimate_lock = threading.Lock()
+        # profile_stages に指定したステージの実行中は Python のスタックを採取し、profile_dir に書き出す
+        self.profile_stages = profile_stages or []
+        self.profile_dir = profile_dir
+        self.profiler = SamplingProfiler() if self.profile_stages else None
+        # 中間ファイルは実行ごとに scratch_dir (未指定の場合は一時ディレクトリ) 内に作成する作業ディレクトリに置く
+        self.scratch_dir = scratch_dir
+        # OpenAI API の呼び出しごとのトークン数・応答時間・推定費用を記録し、usage_path を指定した場合は書き出す
+        self.usage = UsageRecorder()
+        self.usage_path = usage_path
+        self.__validate()
+
+    def __validate(self) -> None:
+        names = [stage.name for stage in self.stages]
+        if len(names) != len(set(names)):
+            raise ValueError(f"ステージ名が重複しています: {names}")
+        producers: Dict[str, str] = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(
+                        f"成果物 {output} が複数のステージで生成されます: {producers[output]}, {stage.name}"
+                    )
+                producers[output] = stage.name
+        unknown = [name for name in self.profile_stages if name not in names]
+        if unknown:
+            raise ValueError(f"プロファイル対象のステージが存在しません: {unknown}")
+
+    def cancel(self) -> None:
+        self.progress.cancel()
+
+    def __execute(self, stage: Stage, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with (
+            span(stage.name, category="stage", label=stage.label) as stage_span,
+            stage_scope(stage.name),
+            self.resources.measure(stage.name)
+            if self.resources is not None
+            else nullcontext(),
+        ):
+            check_cancelled()
+            if self.cache is None or stage.parameters is None:
+                return self.__run_stage(stage, inputs)
+
+            with span("cache.lookup", category="cache"):
+                key = self.cache.key(stage.name, stage.parameters(), inputs)
+                outputs = self.cache.load(stage.name, key)
+            if outputs is not None:
+                self.logger.info(f"{stage.label}はキャッシュ済みの成果物を再利用します")
+                if stage_span is not None:
+                    stage_span.set_attribute("cache_hit", True)
+                return outputs
+
+            outputs = self.__run_stage(stage, inputs)
+            with span("cache.store", category="cache"):
+                self.cache.store(
+                    stage.name, key, {name: outputs[name] for name in stage.outputs}
+                )
+            return outputs
+
+    def __run_stage(
+        self, stage: Stage, inputs: Dict[str, Any], acquire: bool = True
+    ) -> Dict[str, Any]:
+        # arun では予算をイベントループ上で確保してからスレッドで実行するため、acquire=False で呼び出す
+        with ExitStack() as stack:
+            if acquire and self.governor is not None and stage.resources is not None:
+                with span("governor.acquire", category="governor"):
+                    stack.enter_context(
+                        self.governor.acquire(stage.resources, name=stage.label)
+                    )
+            if self.profiler is not None and stage.name in self.profile_stages:
+                stack.enter_context(self.profiler.sampling(stage.name))
+            # 予算の確保を待った時間は所要時間に含めない
+            self.started_at[stage.name] = time.monotonic()
+            outputs = stage.run(**inputs)
+            self.__record(stage, inputs, time.monotonic() - self.started_at[stage.name])
+            return outputs
+
+    def __generator(self, stage: Stage) -> Optional[str]:
+        if stage.name not in self.generators:
+            self.generators[stage.name] = (
+                stage.parameters().get("generator")
+                if stage.parameters is not None
+                else None
+            )
+        return self.generators[stage.name]
+
+    def __record(self, stage: Stage, inputs: Dict[str, Any], duration: float) -> None:
+        # キャッシュを再利用したステージは実際の所要時間ではないため記録しない
+        if self.history is None:
+            return
+        try:
+            self.history.record(
+                stage.name,
+                self.__generator(stage),
+                stage.features(inputs) if stage.features is not None else {},
+                duration,
+            )
+        except Exception as e:
+            self.logger.warning(f"{stage.label}の所要時間を記録できませんでした: {e}")
+
+    def __predict(self) -> Dict[str, Optional[float]]:
+        # 成果物が揃うたびに特徴量が増えるため、予測は成果物の更新時にのみ計算し直す
+        with self.estimate_lock:
+            if self.predictions is None:
+                artifacts = dict(self.artifacts)
+                predictions: Dict[str, Optional[float]] = {}
+                for stage in self.stages:
+                    try:
+                        predictions[stage.name] = (
+                            self.history.predict(
+                                stage.name,
+                                self.__generator(stage),
+                                stage.features(artifacts)
+                                if stage.features is not None
+                                else {},
+                            )
+                            if self.history is not None
+                            else None
+                        )
+                    except Exception as e:
+                        self.logger.warning(
+                            f"{stage.label}の所要時間を予測できませんでした: {e}"
+                        )
+                        predictions[stage.name] = None
+                self.predictions = predictions
+            return self.predictions
+
+    def estimate(self) -> JobEstimate:
+        predictions = self.__predict()
+        now = time.monotonic()
+        producers = {
+            output: stage.name for stage in self.stages for output in stage.outputs
+        }
+        estimates: Dict[str, StageEstimate] = {}
+        # 依存するステージの完了を待つため、各ステージの完了までの時間は依存元の最大値に自身の残り時間を加えたものになる
+        finish: Dict[str, Optional[float]] = {}
+        for stage in self.stages:
+            predicted = predictions.get(stage.name)
+            if stage.name in self.finished:
+                estimates[stage.name] = {
+                    "status": "succeeded",
+                    "elapsed": None,
+                    "predicted": predicted,
+                    "remaining": 0.0,
+                }
+                finish[stage.name] = 0.0
+                continue
+            started_at = self.started_at.get(stage.name)
+            elapsed = now - started_at if started_at is not None else None
+            remaining = (
+                max(predicted - (elapsed or 0.0), 0.0)
+                if predicted is not None
+                else None
+            )
+            estimates[stage.name] = {
+                "status": "running" if started_at is not None else "pending",
+                "elapsed": elapsed,
+                "predicted": predicted,
+                "remaining": remaining,
+            }
+            dependencies = [
+                finish.get(producers[name])
+                for name in stage.inputs
+                if name in producers
+            ]
+            finish[stage.name] = (
+                None
+                if remaining is None or any(d is None for d in dependencies)
+                else max([0.0] + dependencies) + remaining  # type: ignore
+            )
+        return {
+            "stages": estimates,
+            "remaining": None
+            if any(value is None for value in finish.values())
+            else max(finish.values(), default=0.0),  # type: ignore
+        }
+
+    def __start(self, stage: Stage, artifacts: Dict[str, Any]) -> Dict[str, Any]:
+        self.logger.info(f"{stage.label}を開始します")
+        if self.on_stage_start is not None:
+            self.on_stage_start(stage)
+        return {name: artifacts[name] for name in stage.inputs}
+
+    def __fail(self, stage: Stage, error: Exception) -> StageExecutionError:
+        if isinstance(error, JobCancelledError):
+            self.logger.info(f"{stage.label}を中断しました")
+        else:
+            self.logger.error(f"{stage.label}中にエラーが発生しました。 {error}")
+        # 並行して実行中の他のステージも中断させる
+        self.progress.cancel()
+        return StageExecutionError(stage, error)
+
+    def __complete(
+        self, stage: Stage, outputs: Dict[str, Any], artifacts: Dict[str, Any]
+    ) -> None:
+        missing = [name for name in stage.outputs if name not in outputs]
+        if missing:
+            raise StageExecutionError(
+                stage,
+                ValueError(f"成果物が生成されませんでした: {missing}"),
+            )
+        artifacts.update({name: outputs[name] for name in stage.outputs})
+        self.finished.append(stage.name)
+        with self.estimate_lock:
+            self.predictions = None
+        self.logger.info(f"{stage.label}が完了しました")
+        if self.on_stage_end is not None:
+            self.on_stage_end(stage)
+
+    def run(self, initial: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if self.resources is not None:
+            self.resources.start()
+        try:
+            with (
+                tracing(self.tracer),
+                progress_reporting(self.progress),
+                scratch_directory(self.scratch_dir),
+                usage_recording(self.usage),
+                span("pipeline", category="pipeline"),
+            ):
+                return self.__run(initial)
+        finally:
+            self.__export()
+
+    async def arun(self, initial: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # run の非同期版。arun を持つステージはイベントループ上で実行するため、
+        # 1つのイベントループで多数のジョブの API 呼び出しを並行して待てる
+        if self.resources is not None:
+            self.resources.start()
+        try:
+            with (
+                tracing(self.tracer),
+                progress_reporting(self.progress),
+                scratch_directory(self.scratch_dir),
+                usage_recording(self.usage),
+                span("pipeline", category="pipeline"),
+            ):
+                return await self.__arun(initial)
+        finally:
+            await asyncio.to_thread(self.__export)
+
+    def __export(self) -> None:
+        if self.trace_path is not None:
+            self.tracer.export_chrome_trace(self.trace_path)
+            self.logger.info(f"トレースを出力しました: {self.trace_path}")
+        if self.profiler is not None and self.profile_dir is not None:
+            for path in self.profiler.export(self.profile_dir):
+                self.logger.info(f"プロファイルを出力しました: {path}")
+        if self.resources is not None and self.resource_report_path is not None:
+            self.resources.stop()
+            self.resources.export(self.resource_report_path)
+            self.logger.info(
+                f"リソース使用量を出力しました: {self.resource_report_path}"
+            )
+        usage = self.usage.summary()
+        if usage["calls"]:
+            self.logger.info(
+                f"OpenAI API を {usage['calls']} 回呼び出しました (推定費用 ${usage['cost']:.4f})"
+            )
+        if self.usage_path is not None:
+            self.usage.export(self.usage_path)
+            self.logger.info(f"OpenAI API の使用量を出力しました: {self.usage_path}")
+
+    def __run(self, initial: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # 残り時間の予測で参照するため、成果物は実行器に保持する
+        self.artifacts = artifacts = dict(initial or {})
+        pending = list(self.stages)
+        running: Dict[Future, Stage] = {}
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="stage"
+        ) as pool:
+            try:
+                while pending or running:
+                    check_cancelled()
+                    # 入力がすべて揃ったステージを投入する
+                    for stage in [
+                        stage
+                        for stage in pending
+                        if all(name in artifacts for name in stage.inputs)
+                    ]:
+                        pending.remove(stage)
+                        inputs = self.__start(stage, artifacts)
+                        # トレースなどのコンテキストをワーカースレッドに引き継ぐ
+                        context = contextvars.copy_context()
+                        running[
+                            pool.submit(context.run, self.__execute, stage, inputs)
+                        ] = stage
+
+                    if not running:
+                        raise ValueError(
+                            f"入力が揃わないステージがあります: {[stage.name for stage in pending]}"
+                        )
+
+                    done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        try:
+                            outputs = future.result()
+                        except Exception as e:
+                            raise self.__fail(stage, e) from e
+                        self.__complete(stage, outputs, artifacts)
+            finally:
+                # 失敗時はまだ開始していないステージを実行しない
+                for future in running:
+                    future.cancel()
+
+        return artifacts
+
+    async def __arun(self, initial: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        self.artifacts = artifacts = dict(initial or {})
+        pending = list(self.stages)
+        running: Dict[asyncio.Task, Stage] = {}
+
+        try:
+            while pending or running:
+                check_cancelled()
+                for stage in [
+                    stage
+                    for stage in pending
+                    if all(name in artifacts for name in stage.inputs)
+                ]:
+                    pending.remove(stage)
+                    inputs = self.__start(stage, artifacts)
+                    running[asyncio.create_task(self.__aexecute(stage, inputs))] = stage
+
+                if not running:
+                    raise ValueError(
+                        f"入力が揃わないステージがあります: {[stage.name for stage in pending]}"
+                    )
+
+                done, _ = await asyncio.wait(
+                    running.keys(), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    stage = running.pop(task)
+                    try:
+                        outputs = task.result()
+                    except Exception as e:
+                        raise self.__fail(stage, e) from e
+                    self.__complete(stage, outputs, artifacts)
+        finally:
+            # 失敗時は実行中のステージを取り消し、スレッドで実行中のステージは中断を待つ
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        return artifacts
+
+    async def __aexecute(self, stage: Stage, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with (
+            span(stage.name, category="stage", label=stage.label) as stage_span,
+            stage_scope(stage.name),
+        ):
+            check_cancelled()
+            if self.cache is None or stage.parameters is None:
+                return await self.__arun_stage(stage, inputs)
+
+            with span("cache.lookup", category="cache"):
+                key = await asyncio.to_thread(
+                    self.cache.key, stage.name, stage.parameters(), inputs
+                )
+                outputs = await asyncio.to_thread(self.cache.load, stage.name, key)
+            if outputs is not None:
+                self.logger.info(f"{stage.label}はキャッシュ済みの成果物を再利用します")
+                if stage_span is not None:
+                    stage_span.set_attribute("cache_hit", True)
+                return outputs
+
+            outputs = await self.__arun_stage(stage, inputs)
+            with span("cache.store", category="cache"):
+                await asyncio.to_thread(
+                    self.cache.store,
+                    stage.name,
+                    key,
+                    {name: outputs[name] for name in stage.outputs},
+                )
+            return outputs
+
+    async def __arun_stage(
+        self, stage: Stage, inputs: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        async with AsyncExitStack() as stack:
+            # 予算の空きを待つ間にスレッドを占有しないよう、予算はイベントループ上で確保する
+            if self.governor is not None and stage.resources is not None:
+                with span("governor.acquire", category="governor"):
+                    await stack.enter_async_context(
+                        self.governor.acquire_async(stage.resources, name=stage.label)
+                    )
+            if stage.arun is None:
+                # 非同期版を持たないステージは run と同様にスレッドで実行する
+                return await asyncio.to_thread(
+                    self.__run_stage_in_thread, stage, inputs
+                )
+
+            # リソース使用量とプロファイルはスレッド単位で計測するため、非同期のステージでは計測しない
+            self.started_at[stage.name] = time.monotonic()
+            outputs = await stage.arun(**inputs)
+            await asyncio.to_thread(
+                self.__record,
+                stage,
+                inputs,
+                time.monotonic() - self.started_at[stage.name],
+            )
+            return outputs
+
+    def __run_stage_in_thread(
+        self, stage: Stage, inputs: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        with (
+            self.resources.measure(stage.name)
+            if self.resources is not None
+            else nullcontext()
+        ):
+            return self.__run_stage(stage, inputs, acquire=False)
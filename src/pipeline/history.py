@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from typing import Dict, List, Literal, Optional, TypedDict
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stage_timings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    generator TEXT,
+    features TEXT NOT NULL,
+    duration REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_timings_stage ON stage_timings (stage, generator, created_at);
+"""
+
+
+class StageEstimate(TypedDict):
+    status: Literal["pending", "running", "succeeded"]
+    elapsed: Optional[float]
+    predicted: Optional[float]
+    remaining: Optional[float]
+
+
+class JobEstimate(TypedDict):
+    stages: Dict[str, StageEstimate]
+    # 並行して実行できるステージを考慮した、ジョブ全体の残り時間
+    remaining: Optional[float]
+
+
+DEFAULT_HISTORY_PATH = os.path.join(
+    os.path.expanduser("~"), ".shoorter", "stage_history.sqlite3"
+)
+
+
+class StageHistory:
+    # 予測には新しい順にこの件数までの記録を利用する
+    MAX_SAMPLES = 200
+
+    def __init__(self, db_path: str = DEFAULT_HISTORY_PATH) -> None:
+        # 完了したステージの所要時間と特徴量を記録し、同じ生成器の記録から所要時間を予測する
+        self.db_path = db_path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.__connection().executescript(SCHEMA)
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに接続する
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def record(
+        self,
+        stage: str,
+        generator: Optional[str],
+        features: Dict[str, float],
+        duration: float,
+    ) -> None:
+        connection = self.__connection()
+        with connection:
+            connection.execute(
+                "INSERT INTO stage_timings (stage, generator, features, duration, created_at) VALUES (?, ?, ?, ?, ?)",
+                (stage, generator, json.dumps(features), duration, time.time()),
+            )
+
+    def __samples(
+        self, stage: str, generator: Optional[str]
+    ) -> List[tuple[Dict[str, float], float]]:
+        rows = (
+            self.__connection()
+            .execute(
+                "SELECT features, duration FROM stage_timings WHERE stage = ? AND generator IS ? ORDER BY created_at DESC LIMIT ?",
+                (stage, generator, self.MAX_SAMPLES),
+            )
+            .fetchall()
+        )
+        if not rows:
+            # 同じ生成器の記録がなければ、ステージのすべての記録から予測する
+            rows = (
+                self.__connection()
+                .execute(
+                    "SELECT features, duration FROM stage_timings WHERE stage = ? ORDER BY created_at DESC LIMIT ?",
+                    (stage, self.MAX_SAMPLES),
+                )
+                .fetchall()
+            )
+        return [(json.loads(features), duration) for features, duration in rows]
+
+    def predict(
+        self, stage: str, generator: Optional[str], features: Dict[str, float]
+    ) -> Optional[float]:
+        samples = self.__samples(stage, generator)
+        if not samples:
+            return None
+        durations = [duration for _, duration in samples]
+        keys = sorted(
+            key
+            for key in features
+            if all(key in sample_features for sample_features, _ in samples)
+        )
+        # 特徴量の数に対して記録が十分にある場合は線形回帰で、それ以外は中央値で予測する
+        if keys and len(samples) >= len(keys) + 3:
+            x = np.array(
+                [[1.0] + [sample[key] for key in keys] for sample, _ in samples]
+            )
+            coefficients, _, rank, _ = np.linalg.lstsq(
+                x, np.array(durations), rcond=None
+            )
+            if rank == x.shape[1]:
+                prediction = float(
+                    np.dot(coefficients, [1.0] + [features[key] for key in keys])
+                )
+                if prediction > 0:
+                    return prediction
+        return statistics.median(durations)
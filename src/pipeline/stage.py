@@ -0,0 +1,41 @@
+import os
+import sys
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from util import ResourceDemand  # noqa: E402
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        label: str,
+        inputs: List[str],
+        outputs: List[str],
+        run: Callable[..., Dict[str, Any]],
+        parameters: Optional[Callable[[], Dict[str, Any]]] = None,
+        resources: Optional[ResourceDemand] = None,
+        features: Optional[Callable[[Dict[str, Any]], Dict[str, float]]] = None,
+        arun: Optional[Callable[..., Awaitable[Dict[str, Any]]]] = None,
+    ) -> None:
+        # inputs の各成果物をキーワード引数として run に渡し、outputs の各成果物を辞書で受け取る
+        self.name = name
+        self.label = label
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+        # parameters が指定されたステージのみ成果物をキャッシュする
+        self.parameters = parameters
+        # resources が指定されたステージはガバナーから予算を確保してから実行する
+        self.resources = resources
+        # features は揃っている成果物から所要時間の予測に用いる特徴量を求める
+        self.features = features
+        # arun は run の非同期版であり、非同期に実行する場合に run の代わりに利用する
+        self.arun = arun
+
+    def __repr__(self) -> str:
+        return (
+            f"Stage(name={self.name!r}, inputs={self.inputs}, outputs={self.outputs})"
+        )
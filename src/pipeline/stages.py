@@ -0,0 +1,225 @@
+import logging
+import os
+import sys
+import wave
+from typing import Any, Dict, List, Optional
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from module.audio_generator import Audio, IAudioGenerator  # noqa: E402
+from module.manuscript_generator import IManuscriptGenerator, Manuscript  # noqa: E402
+from module.movie_generator import IMovieGenerator  # noqa: E402
+from module.thumbnail_generator import IThumbnailGenerator  # noqa: E402
+from util import ResourceDemand  # noqa: E402
+
+from .cache import ArtifactCache, ArtifactCodec  # noqa: E402
+from .stage import Stage  # noqa: E402
+
+# 各ステージの見積もり。原稿生成は OpenAI の応答待ちが大半のため予算を確保しない
+AUDIO_STAGE_RESOURCES: ResourceDemand = {
+    "cpu": 2,
+    "memory_bytes": 1024**3,
+    "subprocesses": 0,
+}
+THUMBNAIL_STAGE_RESOURCES: ResourceDemand = {
+    "cpu": 1,
+    "memory_bytes": 256 * 1024**2,
+    "subprocesses": 0,
+}
+# 動画生成はクリップごとに ffmpeg の読み込みプロセスと ImageMagick を起動し、libx264 でエンコードする
+MOVIE_STAGE_RESOURCES: ResourceDemand = {
+    "cpu": 4,
+    "memory_bytes": 2 * 1024**3,
+    "subprocesses": 8,
+}
+
+
+def dump_audio(audio: Audio, root_dir: str) -> Dict[str, Any]:
+    data = audio.dict()
+    for detail in data["content_details"]:
+        detail["wav_file_path"] = os.path.relpath(detail["wav_file_path"], root_dir)
+    return data
+
+
+def load_audio(data: Dict[str, Any], root_dir: str) -> Audio:
+    audio = Audio.parse_obj(data)
+    for detail in audio.content_details:
+        detail.wav_file_path = os.path.join(root_dir, detail.wav_file_path)
+    return audio
+
+
+ARTIFACT_CODECS = {
+    "manuscript": ArtifactCodec(
+        dump=lambda manuscript, root_dir: manuscript.dict(),
+        load=lambda data, root_dir: Manuscript.parse_obj(data),
+        files=lambda manuscript: [],
+    ),
+    "audio": ArtifactCodec(
+        dump=dump_audio,
+        load=load_audio,
+        files=lambda audio: [detail.wav_file_path for detail in audio.content_details],
+    ),
+    "thumbnail": ArtifactCodec(
+        dump=lambda paths, root_dir: [os.path.relpath(p, root_dir) for p in paths],
+        load=lambda data, root_dir: [os.path.join(root_dir, p) for p in data],
+        files=lambda paths: paths,
+    ),
+    "movie": ArtifactCodec(
+        dump=lambda paths, root_dir: [os.path.relpath(p, root_dir) for p in paths],
+        load=lambda data, root_dir: [os.path.join(root_dir, p) for p in data],
+        files=lambda paths: paths,
+    ),
+}
+
+
+def audio_seconds(audio: Audio) -> float:
+    seconds = 0.0
+    for detail in audio.content_details:
+        with wave.open(detail.wav_file_path, "rb") as wav:
+            seconds += wav.getnframes() / wav.getframerate()
+    return seconds
+
+
+def build_artifact_cache(
+    output_dir: str, logger: logging.Logger, root_dir: Optional[str] = None
+) -> ArtifactCache:
+    return ArtifactCache(
+        output_dir=output_dir,
+        root_dir=root_dir if root_dir is not None else output_dir,
+        codecs=ARTIFACT_CODECS,
+        logger=logger,
+    )
+
+
+def build_stages(
+    manuscript_generator: IManuscriptGenerator,
+    audio_generator: IAudioGenerator,
+    thumbnail_generator: IThumbnailGenerator,
+    movie_generator: IMovieGenerator,
+    stream_manuscript: bool = False,
+) -> List[Stage]:
+    # stream_manuscript を指定した場合は、原稿の生成中に完成した文章から音声合成を始める
+    def manuscript_stage() -> Dict[str, Any]:
+        if stream_manuscript:
+            audio_generator.restart_prepare()
+            return {"manuscript": manuscript_generator.stream(audio_generator.prepare)}
+        return {"manuscript": manuscript_generator.generate()}
+
+    def audio_stage(manuscript: Manuscript) -> Dict[str, Any]:
+        return {"audio": audio_generator.generate(manuscript)}
+
+    def thumbnail_stage(manuscript: Manuscript) -> Dict[str, Any]:
+        thumbnail_generator.generate(manuscript)
+        return {
+            "thumbnail": [
+                thumbnail_generator.output_thumbnail_path,
+                thumbnail_generator.output_original_thumbnail_path,
+            ]
+        }
+
+    def movie_stage(
+        manuscript: Manuscript, audio: Audio, thumbnail: List[str]
+    ) -> Dict[str, Any]:
+        # 動画の冒頭でサムネイル画像を利用するため、サムネイル生成の完了を待つ
+        movie_generator.generate(manuscript, audio)
+        return {"movie": [movie_generator.output_movie_path]}
+
+    # StageGraphExecutor.arun で利用する非同期版
+    async def amanuscript_stage() -> Dict[str, Any]:
+        if stream_manuscript:
+            audio_generator.restart_prepare()
+            return {
+                "manuscript": await manuscript_generator.astream(
+                    audio_generator.aprepare
+                )
+            }
+        return {"manuscript": await manuscript_generator.agenerate()}
+
+    async def aaudio_stage(manuscript: Manuscript) -> Dict[str, Any]:
+        return {"audio": await audio_generator.agenerate(manuscript)}
+
+    async def athumbnail_stage(manuscript: Manuscript) -> Dict[str, Any]:
+        await thumbnail_generator.agenerate(manuscript)
+        return {
+            "thumbnail": [
+                thumbnail_generator.output_thumbnail_path,
+                thumbnail_generator.output_original_thumbnail_path,
+            ]
+        }
+
+    async def amovie_stage(
+        manuscript: Manuscript, audio: Audio, thumbnail: List[str]
+    ) -> Dict[str, Any]:
+        await movie_generator.agenerate(manuscript, audio)
+        return {"movie": [movie_generator.output_movie_path]}
+
+    def job_features(artifacts: Dict[str, Any]) -> Dict[str, float]:
+        # 所要時間の予測に用いる特徴量であり、成果物が揃うほど多くの特徴量が得られる
+        features: Dict[str, float] = {}
+        manuscript: Optional[Manuscript] = artifacts.get("manuscript")
+        if manuscript is not None:
+            features["num_contents"] = len(manuscript.contents)
+            features["num_characters"] = sum(
+                len(content.text) for content in manuscript.contents
+            )
+        elif "num_trivia" in manuscript_generator.parameters():
+            features["num_contents"] = manuscript_generator.parameters()["num_trivia"]
+        if "num_contents" in features:
+            # 画像生成を利用する動画は文章ごとに画像を生成する
+            features["num_images"] = (
+                features["num_contents"]
+                if hasattr(movie_generator, "image_generator")
+                else 0
+            )
+        audio: Optional[Audio] = artifacts.get("audio")
+        if audio is not None:
+            features["audio_seconds"] = audio_seconds(audio)
+        return features
+
+    return [
+        Stage(
+            name="manuscript",
+            label="原稿生成",
+            inputs=[],
+            outputs=["manuscript"],
+            run=manuscript_stage,
+            arun=amanuscript_stage,
+            parameters=manuscript_generator.parameters,
+            features=job_features,
+            # 逐次受け取る場合は原稿の生成中に音声合成を行うため、音声合成の予算を確保する
+            resources=AUDIO_STAGE_RESOURCES if stream_manuscript else None,
+        ),
+        Stage(
+            name="audio",
+            label="音声合成",
+            inputs=["manuscript"],
+            outputs=["audio"],
+            run=audio_stage,
+            arun=aaudio_stage,
+            parameters=audio_generator.parameters,
+            features=job_features,
+            resources=AUDIO_STAGE_RESOURCES,
+        ),
+        Stage(
+            name="thumbnail",
+            label="サムネイル生成",
+            inputs=["manuscript"],
+            outputs=["thumbnail"],
+            run=thumbnail_stage,
+            arun=athumbnail_stage,
+            parameters=thumbnail_generator.parameters,
+            features=job_features,
+            resources=THUMBNAIL_STAGE_RESOURCES,
+        ),
+        Stage(
+            name="movie",
+            label="動画生成",
+            inputs=["manuscript", "audio", "thumbnail"],
+            outputs=["movie"],
+            run=movie_stage,
+            arun=amovie_stage,
+            parameters=movie_generator.parameters,
+            features=job_features,
+            resources=MOVIE_STAGE_RESOURCES,
+        ),
+    ]
@@ -0,0 +1,7 @@
+from .app import create_app as create_app
+from .app import serve_cmd as serve_cmd
+from .job_server import JobQueueFullError as JobQueueFullError
+from .job_server import JobServer as JobServer
+from .job_server import ServerJob as ServerJob
+from .render_worker import create_render_worker_app as create_render_worker_app
+from .render_worker import render_worker_cmd as render_worker_cmd
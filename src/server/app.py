@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from command import JobSpec, warm_up_with_defaults  # noqa: E402
+from util import ResourceBudget, ResourceGovernor  # noqa: E402
+
+from .job_server import (  # noqa: E402
+    DEFAULT_JOB_RETENTION,
+    TERMINAL_STATUSES,
+    InvalidJobSpecError,
+    JobQueueFullError,
+    JobServer,
+    ServerJob,
+)
+
+# SSE の接続を維持するため、イベントがない間もコメント行を送る間隔
+KEEPALIVE_INTERVAL = 15.0
+EVENT_POLL_INTERVAL = 0.2
+
+
+def create_app(server: JobServer) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        yield
+        await asyncio.to_thread(server.shutdown)
+
+    app = FastAPI(title="Shoorter", lifespan=lifespan)
+
+    def get_job(job_id: str) -> ServerJob:
+        job = server.get(job_id)
+        if job is None:
+            raise HTTPException(
+                status_code=404, detail=f"ジョブ {job_id} が見つかりません"
+            )
+        return job
+
+    @app.post("/jobs", status_code=202)
+    def submit_job(spec: JobSpec) -> Dict[str, Any]:
+        try:
+            return server.submit(spec).summary()
+        except InvalidJobSpecError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        except JobQueueFullError as e:
+            raise HTTPException(status_code=429, detail=str(e)) from e
+
+    @app.get("/jobs")
+    def list_jobs() -> List[Dict[str, Any]]:
+        return [job.summary() for job in server.list()]
+
+    @app.get("/jobs/{job_id}")
+    def get_job_status(job_id: str) -> Dict[str, Any]:
+        return get_job(job_id).summary()
+
+    @app.post("/jobs/{job_id}/cancel", status_code=202)
+    def cancel_job(job_id: str) -> Dict[str, Any]:
+        get_job(job_id)
+        job = server.cancel(job_id)
+        assert job is not None
+        return job.summary()
+
+    @app.get("/jobs/{job_id}/events")
+    async def stream_job_events(
+        job_id: str, last_event_id: Optional[int] = Header(None)
+    ) -> StreamingResponse:
+        job = get_job(job_id)
+
+        async def event_stream() -> AsyncIterator[str]:
+            # 再接続時は Last-Event-ID の次のイベントから送り直す
+            last_id = last_event_id if last_event_id is not None else -1
+            idle = 0.0
+            while True:
+                events = job.events_after(last_id)
+                for event in events:
+                    last_id = event["id"]
+                    yield (
+                        f"id: {event['id']}\n"
+                        f"event: {event['event']}\n"
+                        f"data: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+                    )
+                    if (
+                        event["event"] == "status"
+                        and event["data"]["status"] in TERMINAL_STATUSES
+                    ):
+                        return
+                if events:
+                    idle = 0.0
+                elif idle >= KEEPALIVE_INTERVAL:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+                await asyncio.sleep(EVENT_POLL_INTERVAL)
+                idle += EVENT_POLL_INTERVAL
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    def completed_file(job_id: str, path_attr: str, media_type: str) -> FileResponse:
+        job = get_job(job_id)
+        if job.status != "succeeded":
+            raise HTTPException(
+                status_code=409, detail=f"ジョブ {job_id} は完了していません"
+            )
+        path = getattr(job, path_attr)
+        if not os.path.exists(path):
+            raise HTTPException(status_code=404, detail="ファイルが見つかりません")
+        return FileResponse(path, media_type=media_type)
+
+    @app.get("/jobs/{job_id}/movie")
+    def get_movie(job_id: str) -> FileResponse:
+        return completed_file(job_id, "movie_path", "video/mp4")
+
+    @app.get("/jobs/{job_id}/thumbnail")
+    def get_thumbnail(job_id: str) -> FileResponse:
+        return completed_file(job_id, "thumbnail_path", "image/png")
+
+    @app.get("/metrics")
+    def get_metrics() -> PlainTextResponse:
+        # Prometheus のテキスト形式で、完了したジョブの OpenAI API の使用量を返す
+        return PlainTextResponse(
+            server.usage.to_prometheus(), media_type="text/plain; version=0.0.4"
+        )
+
+    return app
+
+
+def serve_cmd(
+    host: str,
+    port: int,
+    output_dir: str,
+    num_workers: int,
+    logger: logging.Logger,
+    max_queued: int = 100,
+    use_cache: bool = True,
+    budget: Optional[ResourceBudget] = None,
+    retention: float = DEFAULT_JOB_RETENTION,
+    input_dir: str = ".",
+) -> None:
+    import uvicorn
+
+    governor = ResourceGovernor(**budget, logger=logger) if budget is not None else None
+    # ジョブはサーバーのプロセス内で実行されるため、起動時に一度だけ初期化すればよい
+    warm_up_with_defaults(logger, governor)
+    server = JobServer(
+        output_dir=output_dir,
+        logger=logger,
+        num_workers=num_workers,
+        max_queued=max_queued,
+        use_cache=use_cache,
+        governor=governor,
+        retention=retention,
+        input_dir=input_dir,
+    )
+    logger.info(f"http://{host}:{port} でジョブを受け付けます")
+    uvicorn.run(create_app(server), host=host, port=port)
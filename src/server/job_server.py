@@ -0,0 +1,352 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Dict, List, Literal, Optional, TypedDict
+
+import ulid
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from command import JOB_RESOURCES, JobSpec, build_job_executor  # noqa: E402
+from pipeline import (  # noqa: E402
+    JobEstimate,
+    Stage,
+    StageExecutionError,
+    StageGraphExecutor,
+)
+from util import (  # noqa: E402
+    ProgressReporter,
+    ResourceGovernor,
+    UsageRecorder,
+    progress_reporting,
+)
+
+ServerJobStatus = Literal["queued", "running", "succeeded", "failed", "cancelled"]
+TERMINAL_STATUSES = {"succeeded", "failed", "cancelled"}
+# 終了したジョブの状態を保持する期間 [s] と件数の上限。超えたものは古い順に破棄する
+DEFAULT_JOB_RETENTION = 3600.0
+DEFAULT_MAX_FINISHED_JOBS = 1000
+# HTTP で受け付けるジョブで、サーバーが読み込むファイルを指すフィールド。input_dir 内に限る
+INPUT_PATH_FIELDS = [
+    "font_path",
+    "bgm_file_path",
+    "onnxruntime_lib_path",
+    "open_jtalk_dict_dir_path",
+    "man_image_dir",
+    "woman_image_dir",
+    "bgv_file_path",
+]
+# サーバーが書き込むディレクトリを指すフィールド。サーバー側の設定のみで決める
+OUTPUT_PATH_FIELDS = ["cassette_dir", "scratch_dir"]
+
+
+class JobEvent(TypedDict):
+    id: int
+    event: str
+    data: Dict[str, Any]
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class InvalidJobSpecError(Exception):
+    pass
+
+
+def resolve_spec_paths(spec: JobSpec, input_dir: str) -> JobSpec:
+    # 利用者がサーバー上の任意のファイルを読み書きできないよう、パスを input_dir 内に解決する
+    for field in OUTPUT_PATH_FIELDS:
+        if getattr(spec, field):
+            raise InvalidJobSpecError(f"{field} は指定できません")
+    resolved: Dict[str, str] = {}
+    for field in INPUT_PATH_FIELDS:
+        value = getattr(spec, field)
+        if value is None:
+            continue
+        path = os.path.realpath(os.path.join(input_dir, value))
+        if os.path.commonpath([path, input_dir]) != input_dir:
+            raise InvalidJobSpecError(
+                f"{field} には {input_dir} 内のパスを指定してください: {value}"
+            )
+        resolved[field] = path
+    return spec.copy(update=resolved)
+
+
+class ServerJob:
+    # 進捗通知のうち、同じステージ・単位の通知はこの間隔で間引いてイベントにする
+    PROGRESS_EVENT_INTERVAL = 0.2
+
+    def __init__(self, job_id: str, spec: JobSpec, output_dir: str) -> None:
+        self.id = job_id
+        self.spec = spec
+        self.output_dir = output_dir
+        self.status: ServerJobStatus = "queued"
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.stages: Dict[str, str] = {}
+        self.progress: Dict[str, Dict[str, int]] = {}
+        self.events: List[JobEvent] = []
+        self.next_event_id = 0
+        self.condition = threading.Condition()
+        self.reporter = ProgressReporter(on_progress=self.__on_progress)
+        # ステージの失敗時も reporter はキャンセルされるため、利用者によるキャンセルと区別する
+        self.cancel_requested = threading.Event()
+        self.last_progress_event: Dict[tuple, float] = {}
+        self.executor: Optional[StageGraphExecutor] = None
+        # 終了後に executor を破棄した後も返す OpenAI API の使用量
+        self.usage_summary: Optional[Dict[str, Any]] = None
+
+    def publish(self, event: str, data: Dict[str, Any]) -> None:
+        with self.condition:
+            self.events.append({"id": self.next_event_id, "event": event, "data": data})
+            self.next_event_id += 1
+            self.condition.notify_all()
+
+    def events_after(self, last_event_id: int) -> List[JobEvent]:
+        with self.condition:
+            return [event for event in self.events if event["id"] > last_event_id]
+
+    def release(self) -> None:
+        # 終了したジョブは、使用量の集計と終了を伝えるイベントのみを残して実行時の状態を破棄する
+        if self.executor is not None:
+            self.usage_summary = self.executor.usage.summary()
+            self.executor = None
+        with self.condition:
+            self.events = [
+                event
+                for event in self.events
+                if event["event"] == "status"
+                and event["data"]["status"] in TERMINAL_STATUSES
+            ][-1:]
+        self.last_progress_event.clear()
+
+    def set_status(self, status: ServerJobStatus, error: Optional[str] = None) -> None:
+        self.status = status
+        self.error = error
+        if status == "running":
+            self.started_at = time.time()
+        if status in TERMINAL_STATUSES:
+            self.finished_at = time.time()
+        self.publish("status", {"status": status, "error": error})
+
+    def set_stage(self, stage: Stage, status: str) -> None:
+        self.stages[stage.name] = status
+        self.publish(
+            "stage",
+            {
+                "stage": stage.name,
+                "label": stage.label,
+                "status": status,
+                "eta": self.estimate(),
+            },
+        )
+
+    def estimate(self) -> Optional[JobEstimate]:
+        # 過去の所要時間から予測したステージごと・ジョブ全体の残り時間
+        executor = self.executor
+        if executor is None or self.status in TERMINAL_STATUSES:
+            return None
+        return executor.estimate()
+
+    def __on_progress(
+        self, stage: Optional[str], unit: str, done: int, total: int
+    ) -> None:
+        if stage is None:
+            return
+        self.progress[stage] = {"unit": unit, "done": done, "total": total}  # type: ignore
+        now = time.monotonic()
+        key = (stage, unit)
+        if (
+            done < total
+            and now - self.last_progress_event.get(key, 0)
+            < self.PROGRESS_EVENT_INTERVAL
+        ):
+            return
+        self.last_progress_event[key] = now
+        estimate = self.estimate()
+        self.publish(
+            "progress",
+            {
+                "stage": stage,
+                "unit": unit,
+                "done": done,
+                "total": total,
+                "remaining": estimate["remaining"] if estimate is not None else None,
+            },
+        )
+
+    @property
+    def movie_path(self) -> str:
+        return os.path.join(self.output_dir, "movie.mp4")
+
+    @property
+    def thumbnail_path(self) -> str:
+        return os.path.join(self.output_dir, "thumbnail.png")
+
+    def summary(self) -> Dict[str, Any]:
+        executor = self.executor
+        return {
+            "id": self.id,
+            "type": self.spec.type,
+            "theme": self.spec.theme,
+            "name": self.spec.name,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stages": dict(self.stages),
+            "progress": dict(self.progress),
+            "eta": self.estimate(),
+            "openai": (
+                executor.usage.summary() if executor is not None else self.usage_summary
+            ),
+        }
+
+
+class JobServer:
+    def __init__(
+        self,
+        output_dir: str,
+        logger: logging.Logger,
+        num_workers: int = 1,
+        max_queued: int = 100,
+        use_cache: bool = True,
+        governor: Optional[ResourceGovernor] = None,
+        retention: float = DEFAULT_JOB_RETENTION,
+        max_finished: int = DEFAULT_MAX_FINISHED_JOBS,
+        input_dir: str = ".",
+    ) -> None:
+        self.output_dir = os.path.abspath(output_dir)
+        # ジョブが参照するフォント・BGM・画像などは input_dir 内のものに限る
+        self.input_dir = os.path.realpath(input_dir)
+        self.logger = logger
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.use_cache = use_cache
+        # governor を指定した場合は予算に空きができるまでジョブの開始を待たせる
+        self.governor = governor
+        self.retention = retention
+        self.max_finished = max_finished
+        self.jobs: Dict[str, ServerJob] = {}
+        self.lock = threading.Lock()
+        # 全ジョブの OpenAI API の使用量。/metrics で公開する
+        # 呼び出しごとの記録は保持せず、累計のみを持つ
+        self.usage = UsageRecorder(keep_calls=False)
+        # 同時に生成するジョブ数を num_workers に制限し、残りは待機させる
+        self.pool = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="server-job"
+        )
+
+    def __evict(self) -> None:
+        # 保持期間を過ぎたものと、件数の上限を超えた古いものから終了したジョブを破棄する
+        # 呼び出し側で self.lock を取得しておく
+        finished = sorted(
+            (job.finished_at, job.id)
+            for job in self.jobs.values()
+            if job.finished_at is not None
+        )
+        expired = time.time() - self.retention
+        for idx, (finished_at, job_id) in enumerate(finished):
+            if finished_at < expired or len(finished) - idx > self.max_finished:
+                del self.jobs[job_id]
+
+    def submit(self, spec: JobSpec) -> ServerJob:
+        spec = resolve_spec_paths(spec, self.input_dir)
+        with self.lock:
+            self.__evict()
+            queued = [job for job in self.jobs.values() if job.status == "queued"]
+            if len(queued) >= self.max_queued:
+                raise JobQueueFullError(
+                    f"待機中のジョブが上限 ({self.max_queued}件) に達しています"
+                )
+            job_id = str(ulid.new())
+            name = re.sub(r"[^0-9A-Za-z_.-]+", "_", spec.name or spec.type)
+            job = ServerJob(
+                job_id, spec, os.path.join(self.output_dir, f"{job_id}_{name}")
+            )
+            self.jobs[job_id] = job
+        job.publish("status", {"status": "queued", "error": None})
+        self.pool.submit(self.__run, job)
+        self.logger.info(f"ジョブ {job_id} を受け付けました")
+        return job
+
+    def get(self, job_id: str) -> Optional[ServerJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[ServerJob]:
+        with self.lock:
+            self.__evict()
+            return list(self.jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[ServerJob]:
+        job = self.get(job_id)
+        if job is not None and job.status not in TERMINAL_STATUSES:
+            job.cancel_requested.set()
+            job.reporter.cancel()
+            # 待機中のジョブは開始時にキャンセル済みとして扱う
+            self.logger.info(f"ジョブ {job_id} のキャンセルを受け付けました")
+        return job
+
+    def __run(self, job: ServerJob) -> None:
+        if job.cancel_requested.is_set():
+            job.set_status("cancelled")
+            job.release()
+            return
+        logger = self.logger.getChild(job.id)
+        try:
+            with ExitStack() as stack:
+                if self.governor is not None:
+                    stack.enter_context(progress_reporting(job.reporter))
+                    stack.enter_context(
+                        self.governor.acquire(
+                            JOB_RESOURCES, name=f"ジョブ {job.id}", admission=True
+                        )
+                    )
+                os.makedirs(job.output_dir, exist_ok=True)
+                job.executor = build_job_executor(
+                    spec=job.spec,
+                    output_dir=job.output_dir,
+                    logger=logger,
+                    use_cache=self.use_cache,
+                    on_stage_start=lambda stage: job.set_stage(stage, "running"),
+                    on_stage_end=lambda stage: job.set_stage(stage, "succeeded"),
+                    progress=job.reporter,
+                    governor=self.governor,
+                    job_id=job.id,
+                )
+                job.set_status("running")
+                job.executor.run()
+            job.set_status("succeeded")
+            self.logger.info(f"ジョブ {job.id} が完了しました")
+        except Exception as e:
+            if job.cancel_requested.is_set():
+                job.set_status("cancelled")
+                self.logger.info(f"ジョブ {job.id} をキャンセルしました")
+                return
+            if isinstance(e, StageExecutionError):
+                job.set_stage(e.stage, "failed")
+            job.set_status("failed", str(e))
+            self.logger.error(f"ジョブ {job.id} が失敗しました: {e}")
+        finally:
+            # 失敗・キャンセルしたジョブの呼び出しも費用がかかるため集計に含める
+            if job.executor is not None:
+                self.usage.merge(job.executor.usage)
+            job.release()
+
+    def shutdown(self) -> None:
+        # 実行中のジョブを中断してから終了する
+        for job in self.list():
+            if job.status not in TERMINAL_STATUSES:
+                job.cancel_requested.set()
+                job.reporter.cancel()
+        self.pool.shutdown(wait=True, cancel_futures=False)
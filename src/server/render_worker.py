@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from module.movie_generator import Timeline, render_segment  # noqa: E402
+
+# 素材は内容の SHA-256 と拡張子で識別する
+ASSET_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]+)?$")
+
+
+class SegmentRequest(BaseModel):
+    timeline: Timeline = Field(description="素材名で記述した動画の構成")
+    start_frame: int = Field(description="書き出す区間の開始フレーム")
+    end_frame: int = Field(description="書き出す区間の終了フレーム (含まない)")
+
+
+def create_render_worker_app(
+    cache_dir: str, slots: int, logger: logging.Logger
+) -> FastAPI:
+    app = FastAPI(title="Shoorter render worker")
+    os.makedirs(cache_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(slots)
+
+    def asset_path(name: str) -> str:
+        if not ASSET_NAME_PATTERN.match(name):
+            raise HTTPException(status_code=400, detail=f"素材名が不正です: {name}")
+        return os.path.join(cache_dir, name)
+
+    @app.head("/assets/{name}")
+    def has_asset(name: str) -> Response:
+        if not os.path.exists(asset_path(name)):
+            raise HTTPException(status_code=404, detail=f"素材 {name} がありません")
+        return Response(status_code=200)
+
+    @app.put("/assets/{name}", status_code=201)
+    async def put_asset(name: str, request: Request) -> Response:
+        path = asset_path(name)
+        # 受信中のファイルを参照されないよう、ハッシュ値を確認してから配置する
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                async for chunk in request.stream():
+                    digest.update(chunk)
+                    file.write(chunk)
+            if digest.hexdigest() != name[:64]:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"素材 {name} の内容がハッシュ値と一致しません",
+                )
+            os.replace(temp_path, path)
+        finally:
+            os.remove(temp_path) if os.path.exists(temp_path) else None
+        return Response(status_code=201)
+
+    @app.post("/segments")
+    async def post_segment(request: SegmentRequest) -> FileResponse:
+        if not 0 <= request.start_frame < request.end_frame:
+            raise HTTPException(
+                status_code=400,
+                detail=f"区間 [{request.start_frame}, {request.end_frame}) が不正です",
+            )
+        mapping = {
+            name: asset_path(name) for name in request.timeline.video_asset_paths()
+        }
+        missing = [name for name, path in mapping.items() if not os.path.exists(path)]
+        if missing:
+            raise HTTPException(
+                status_code=409, detail=f"素材が送信されていません: {missing}"
+            )
+        # 音声は区間の書き出しに利用しないため、素材名のままでよい
+        timeline = request.timeline.with_video_assets(mapping)
+        fd, output_path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        try:
+            async with semaphore:
+                logger.info(
+                    f"区間 [{request.start_frame}, {request.end_frame}) を書き出します"
+                )
+                await asyncio.to_thread(
+                    render_segment,
+                    timeline,
+                    (request.start_frame, request.end_frame),
+                    output_path,
+                )
+        except BaseException:
+            os.remove(output_path)
+            raise
+        return FileResponse(
+            output_path,
+            media_type="video/mp4",
+            background=BackgroundTask(os.remove, output_path),
+        )
+
+    return app
+
+
+def render_worker_cmd(
+    host: str,
+    port: int,
+    cache_dir: str,
+    slots: int,
+    logger: logging.Logger,
+) -> None:
+    import uvicorn
+
+    logger.info(f"http://{host}:{port} で動画の区間の書き出しを受け付けます")
+    uvicorn.run(
+        create_render_worker_app(cache_dir=cache_dir, slots=slots, logger=logger),
+        host=host,
+        port=port,
+    )
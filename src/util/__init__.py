@@ -1,12 +1,52 @@
+from .cassette import Cassette as Cassette
+from .cassette import CassetteMissError as CassetteMissError
+from .cassette import CassetteMode as CassetteMode
+from .cassette import attach_cassette as attach_cassette
+from .cassette import to_jsonable as to_jsonable
 from .flet import file_picker_row as file_picker_row
+from .governor import ResourceBudget as ResourceBudget
+from .governor import ResourceDemand as ResourceDemand
+from .governor import ResourceGovernor as ResourceGovernor
+from .governor import granted_cpu as granted_cpu
+from .governor import parse_size as parse_size
+from .hash import directory_digest as directory_digest
+from .hash import file_digest as file_digest
+from .hash import json_digest as json_digest
 from .license import FFMPEG_LICENSE as FFMPEG_LICENSE
 from .license import IMAGEMAICK_LICENSE as IMAGEMAICK_LICENSE
 from .license import OPEN_JTALK_LICENSE as OPEN_JTALK_LICENSE
 from .license import SELF_SOURCE_CODE as SELF_SOURCE_CODE
 from .license import VOICEVOX_LICENSE as VOICEVOX_LICENSE
+from .llm_cache import DEFAULT_LLM_CACHE_PATH as DEFAULT_LLM_CACHE_PATH
+from .llm_cache import LLMCache as LLMCache
+from .llm_cache import attach_llm_cache as attach_llm_cache
+from .llm_cache import bypass_llm_cache as bypass_llm_cache
+from .llm_cache import get_llm_cache as get_llm_cache
+from .nlp import count_morae as count_morae
+from .nlp import get_tagger as get_tagger
 from .nlp import tokenize as tokenize
 from .nlp import wrap_text as wrap_text
 from .openai import ImageGenerator as ImageGenerator
+from .openai import aparse_completion as aparse_completion
+from .openai import parse_completion as parse_completion
+from .profiler import SamplingProfiler as SamplingProfiler
+from .progress import JobCancelledError as JobCancelledError
+from .progress import MoviePyProgressLogger as MoviePyProgressLogger
+from .progress import ProgressReporter as ProgressReporter
+from .progress import check_cancelled as check_cancelled
+from .progress import progress_reporting as progress_reporting
+from .progress import report_progress as report_progress
+from .progress import stage_scope as stage_scope
+from .rate_limit import RateLimit as RateLimit
+from .rate_limit import RateLimiter as RateLimiter
+from .rate_limit import get_rate_limiter as get_rate_limiter
+from .rate_limit import openai_clients as openai_clients
+from .resources import ResourceMonitor as ResourceMonitor
+from .resources import ResourceReport as ResourceReport
+from .resources import StageResourceUsage as StageResourceUsage
+from .scratch import publish as publish
+from .scratch import scratch_directory as scratch_directory
+from .scratch import scratch_path as scratch_path
 from .setup import (
     check_is_downloaded_voicevox_dependencies as check_is_downloaded_voicevox_dependencies,
 )
@@ -14,9 +54,19 @@ from .setup import check_is_installed_ffmpeg as check_is_installed_ffmpeg
 from .setup import (
     check_is_installed_voicevox_wheel as check_is_installed_voicevox_wheel,
 )
+from .setup import default_onnxruntime_lib_path as default_onnxruntime_lib_path
 from .setup import (
     download_and_install_voicevox_wheel as download_and_install_voicevox_wheel,
 )
 from .setup import download_voicevox_dependencies as download_voicevox_dependencies
 from .setup import get_onnxruntime_lib_path as get_onnxruntime_lib_path
 from .setup import get_open_jtalk_dict_dir_path as get_open_jtalk_dict_dir_path
+from .tracing import Span as Span
+from .tracing import Tracer as Tracer
+from .tracing import span as span
+from .tracing import tracing as tracing
+from .usage import OpenAICall as OpenAICall
+from .usage import UsageRecorder as UsageRecorder
+from .usage import mark_replayed as mark_replayed
+from .usage import openai_call as openai_call
+from .usage import usage_recording as usage_recording
@@ -0,0 +1,473 @@
+import json
+import os
+import tempfile
+import threading
+from dataclasses import asdict, is_dataclass
+from types import SimpleNamespace
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from pydantic import BaseModel
+
+from .hash import json_digest
+from .usage import mark_replayed
+
+CassetteMode = Literal["auto", "record", "replay"]
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def to_jsonable(value: Any) -> Any:
+    # リクエストをキーにするため、dataclass や pydantic のモデルを JSON で表せる値に変換する
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if is_dataclass(value) and not isinstance(value, type):
+        return asdict(value)
+    if isinstance(value, SimpleNamespace):
+        return {key: to_jsonable(item) for key, item in vars(value).items()}
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    return value
+
+
+class Cassette:
+    def __init__(self, directory: str, mode: CassetteMode = "auto") -> None:
+        # 外部 API の応答をリクエストごとに directory に記録し、2回目以降は記録から再生する
+        # auto: 記録があれば再生し、なければ呼び出して記録する
+        # record: 常に呼び出して記録し直す
+        # replay: 記録のみを利用し、記録がなければ CassetteMissError とする
+        self.directory = directory
+        self.mode = mode
+        self.counts = {"hit": 0, "miss": 0}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __paths(self, kind: str, request: Any) -> Tuple[str, str]:
+        key = json_digest({"kind": kind, "request": to_jsonable(request)})
+        base = os.path.join(self.directory, kind, key)
+        return f"{base}.json", f"{base}.bin"
+
+    def load(self, kind: str, request: Any) -> Optional[Tuple[Any, Optional[bytes]]]:
+        # 記録された (応答, バイナリ) を返す。記録から再生しない場合は None
+        json_path, bin_path = self.__paths(kind, request)
+        if self.mode == "record" or not os.path.exists(json_path):
+            if self.mode == "replay":
+                raise CassetteMissError(
+                    f"カセットに記録されていないリクエストです: {kind} {json_path}"
+                )
+            with self.lock:
+                self.counts["miss"] += 1
+            return None
+        with open(json_path, "r", encoding="utf-8") as file:
+            response = json.load(file)["response"]
+        body = None
+        if os.path.exists(bin_path):
+            with open(bin_path, "rb") as file:
+                body = file.read()
+        with self.lock:
+            self.counts["hit"] += 1
+        # 記録から再生した呼び出しは費用の集計から除く
+        mark_replayed()
+        return response, body
+
+    def __write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def store(
+        self, kind: str, request: Any, response: Any, body: Optional[bytes]
+    ) -> None:
+        # 本体を先に書き出し、記録の JSON が存在すれば本体も揃っているようにする
+        json_path, bin_path = self.__paths(kind, request)
+        if body is not None:
+            self.__write(bin_path, body)
+        self.__write(
+            json_path,
+            json.dumps(
+                {"kind": kind, "request": to_jsonable(request), "response": response},
+                ensure_ascii=False,
+                indent=2,
+            ).encode("utf-8"),
+        )
+
+    def play(
+        self,
+        kind: str,
+        request: Any,
+        call: Callable[[], Any],
+        encode: Callable[[Any], Tuple[Any, Optional[bytes]]],
+        decode: Callable[[Any, Optional[bytes]], Any],
+    ) -> Any:
+        # encode は応答を (JSON で表せる値, バイナリ) に、decode はその逆に変換する
+        recorded = self.load(kind, request)
+        if recorded is not None:
+            return decode(*recorded)
+        result = call()
+        self.store(kind, request, *encode(result))
+        return result
+
+    async def aplay(
+        self,
+        kind: str,
+        request: Any,
+        call: Callable[[], Awaitable[Any]],
+        encode: Callable[[Any], Tuple[Any, Optional[bytes]]],
+        decode: Callable[[Any, Optional[bytes]], Any],
+    ) -> Any:
+        recorded = self.load(kind, request)
+        if recorded is not None:
+            return decode(*recorded)
+        result = await call()
+        self.store(kind, request, *encode(result))
+        return result
+
+
+def encode_completion(completion: Any) -> Tuple[Any, Optional[bytes]]:
+    # 本アプリは parsed と refusal、使用量のみを参照する
+    message = completion.choices[0].message
+    return {
+        "parsed": message.parsed.dict() if message.parsed is not None else None,
+        "refusal": message.refusal,
+        "usage": to_jsonable(getattr(completion, "usage", None)),
+        "model": getattr(completion, "model", None),
+    }, None
+
+
+def completion_decoder(
+    response_format: Type[BaseModel],
+) -> Callable[[Any, Optional[bytes]], Any]:
+    def decode(response: Any, body: Optional[bytes]) -> Any:
+        parsed = (
+            response_format.parse_obj(response["parsed"])
+            if response["parsed"] is not None
+            else None
+        )
+        usage = response.get("usage")
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(
+                    message=SimpleNamespace(
+                        parsed=parsed, refusal=response.get("refusal")
+                    )
+                )
+            ],
+            usage=SimpleNamespace(**usage) if isinstance(usage, dict) else None,
+            model=response.get("model"),
+        )
+
+    return decode
+
+
+def completion_request(
+    model: str, messages: List[Any], response_format: Type[BaseModel], kwargs: Any
+) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "messages": messages,
+        "response_format": response_format.schema(),
+        **kwargs,
+    }
+
+
+def encode_images(response: Any) -> Tuple[Any, Optional[bytes]]:
+    return {
+        "data": [
+            {"url": item.url, "revised_prompt": getattr(item, "revised_prompt", None)}
+            for item in response.data
+        ]
+    }, None
+
+
+def decode_images(response: Any, body: Optional[bytes]) -> Any:
+    return SimpleNamespace(data=[SimpleNamespace(**item) for item in response["data"]])
+
+
+COMPLETION_STREAM_KIND = "openai.chat.completions.stream"
+
+
+class RecordedCompletionStream:
+    # 記録から再生する場合は途中経過を再現せず、完了後の応答のみを返す
+    def __init__(self, completion: Any) -> None:
+        self.completion = completion
+
+    def __enter__(self) -> "RecordedCompletionStream":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter([])
+
+    def get_final_completion(self) -> Any:
+        return self.completion
+
+
+class AsyncRecordedCompletionStream:
+    def __init__(self, completion: Any) -> None:
+        self.completion = completion
+
+    async def __aenter__(self) -> "AsyncRecordedCompletionStream":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self
+
+    async def __anext__(self) -> Any:
+        raise StopAsyncIteration
+
+    async def get_final_completion(self) -> Any:
+        return self.completion
+
+
+class RecordingCompletionStream:
+    # 途中経過はそのまま受け渡し、完了後の応答を記録する
+    def __init__(self, manager: Any, store: Callable[[Any], None]) -> None:
+        self.manager = manager
+        self.store = store
+
+    def __enter__(self) -> "RecordingCompletionStream":
+        self.stream = self.manager.__enter__()
+        return self
+
+    def __exit__(self, *args: Any) -> Any:
+        return self.manager.__exit__(*args)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.stream)
+
+    def get_final_completion(self) -> Any:
+        completion = self.stream.get_final_completion()
+        self.store(completion)
+        return completion
+
+
+class AsyncRecordingCompletionStream:
+    def __init__(self, manager: Any, store: Callable[[Any], None]) -> None:
+        self.manager = manager
+        self.store = store
+
+    async def __aenter__(self) -> "AsyncRecordingCompletionStream":
+        self.stream = await self.manager.__aenter__()
+        return self
+
+    async def __aexit__(self, *args: Any) -> Any:
+        return await self.manager.__aexit__(*args)
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self.stream.__aiter__()
+
+    async def get_final_completion(self) -> Any:
+        completion = await self.stream.get_final_completion()
+        self.store(completion)
+        return completion
+
+
+class CassetteCompletions:
+    def __init__(self, completions: Any, cassette: Cassette) -> None:
+        self.completions = completions
+        self.cassette = cassette
+
+    def parse(
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        return self.cassette.play(
+            "openai.chat.completions.parse",
+            completion_request(model, messages, response_format, kwargs),
+            lambda: self.completions.parse(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            encode_completion,
+            completion_decoder(response_format),
+        )
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        recorded = self.cassette.load(COMPLETION_STREAM_KIND, request)
+        if recorded is not None:
+            return RecordedCompletionStream(
+                completion_decoder(response_format)(*recorded)
+            )
+        return RecordingCompletionStream(
+            self.completions.stream(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            lambda completion: self.cassette.store(
+                COMPLETION_STREAM_KIND, request, *encode_completion(completion)
+            ),
+        )
+
+
+class CassetteAsyncCompletions(CassetteCompletions):
+    async def parse(  # type: ignore[override]
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        return await self.cassette.aplay(
+            "openai.chat.completions.parse",
+            completion_request(model, messages, response_format, kwargs),
+            lambda: self.completions.parse(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            encode_completion,
+            completion_decoder(response_format),
+        )
+
+    def stream(  # type: ignore[override]
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        recorded = self.cassette.load(COMPLETION_STREAM_KIND, request)
+        if recorded is not None:
+            return AsyncRecordedCompletionStream(
+                completion_decoder(response_format)(*recorded)
+            )
+        return AsyncRecordingCompletionStream(
+            self.completions.stream(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            lambda completion: self.cassette.store(
+                COMPLETION_STREAM_KIND, request, *encode_completion(completion)
+            ),
+        )
+
+
+class CassetteImages:
+    def __init__(self, images: Any, cassette: Cassette) -> None:
+        self.images = images
+        self.cassette = cassette
+
+    def generate(self, **kwargs: Any) -> Any:
+        return self.cassette.play(
+            "openai.images.generate",
+            kwargs,
+            lambda: self.images.generate(**kwargs),
+            encode_images,
+            decode_images,
+        )
+
+
+class CassetteAsyncImages(CassetteImages):
+    async def generate(self, **kwargs: Any) -> Any:  # type: ignore[override]
+        return await self.cassette.aplay(
+            "openai.images.generate",
+            kwargs,
+            lambda: self.images.generate(**kwargs),
+            encode_images,
+            decode_images,
+        )
+
+
+class CassetteOpenAI:
+    # OpenAI クライアントのうち、本アプリが利用する API の応答を記録・再生する
+    def __init__(self, client: Any, cassette: Cassette) -> None:
+        completions = CassetteCompletions(client.beta.chat.completions, cassette)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = CassetteImages(client.images, cassette)
+
+
+class CassetteAsyncOpenAI:
+    def __init__(self, client: Any, cassette: Cassette) -> None:
+        completions = CassetteAsyncCompletions(client.beta.chat.completions, cassette)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = CassetteAsyncImages(client.images, cassette)
+
+
+class RecordedResponse:
+    def __init__(self, status_code: int, content: bytes) -> None:
+        self.status_code = status_code
+        self.content = content
+
+    def iter_content(self, chunk_size: int = 1) -> Iterator[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class CassetteHttpSession:
+    # 画像のダウンロードを記録・再生する。生成された画像の URL は記録ごとに異なるため、URL をキーにしてよい
+    def __init__(self, session: Any, cassette: Cassette) -> None:
+        self.session = session
+        self.cassette = cassette
+
+    def get(self, url: str, **kwargs: Any) -> Any:
+        def call() -> RecordedResponse:
+            response = self.session.get(url=url, **kwargs)
+            return RecordedResponse(response.status_code, response.content)
+
+        return self.cassette.play(
+            "http.get",
+            {"url": url},
+            call,
+            lambda response: ({"status_code": response.status_code}, response.content),
+            lambda response, body: RecordedResponse(
+                response["status_code"], body or b""
+            ),
+        )
+
+
+def attach_cassette(generator: Any, cassette: Cassette) -> None:
+    # 生成器が保持する外部 API のクライアントを、応答を記録・再生するものに差し替える
+    if hasattr(generator, "openai_client"):
+        generator.openai_client = CassetteOpenAI(generator.openai_client, cassette)
+    if hasattr(generator, "async_openai_client"):
+        generator.async_openai_client = CassetteAsyncOpenAI(
+            generator.async_openai_client, cassette
+        )
+    if hasattr(generator, "image_generator"):
+        attach_cassette(generator.image_generator, cassette)
+    if hasattr(generator, "http_session"):
+        generator.http_session = CassetteHttpSession(generator.http_session, cassette)
+    if hasattr(generator, "cassette"):
+        generator.cassette = cassette
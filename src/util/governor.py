@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, TypedDict
+
+from .progress import check_cancelled
+
+
+class ResourceDemand(TypedDict, total=False):
+    cpu: int
+    memory_bytes: int
+    subprocesses: int
+
+
+class ResourceBudget(TypedDict, total=False):
+    # 未指定の予算はホストの性能から決める
+    cpu: Optional[int]
+    memory_bytes: Optional[int]
+    subprocesses: Optional[int]
+
+
+RESOURCE_KEYS = ["cpu", "memory_bytes", "subprocesses"]
+
+
+def parse_size(value: str) -> int:
+    # "512M" や "8G" のような表記をバイト数に変換する
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", value, re.I)
+    if match is None:
+        raise ValueError(f"サイズの指定が不正です: {value}")
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+def physical_memory_bytes() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class ResourceGovernor:
+    def __init__(
+        self,
+        cpu: Optional[int] = None,
+        memory_bytes: Optional[int] = None,
+        subprocesses: Optional[int] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        # 予算を超える要求は、実行中の処理が予算を返却するまで待機させる
+        cpu_count = os.cpu_count() or 1
+        total_memory = physical_memory_bytes()
+        self.budget: Dict[str, int] = {
+            "cpu": cpu if cpu is not None else cpu_count,
+            "memory_bytes": memory_bytes
+            if memory_bytes is not None
+            else int(total_memory * 0.8)
+            if total_memory is not None
+            else 8 * 1024**3,
+            "subprocesses": subprocesses if subprocesses is not None else 4 * cpu_count,
+        }
+        self.in_use: Dict[str, int] = {key: 0 for key in RESOURCE_KEYS}
+        self.holders = 0
+        self.stage_holders = 0
+        self.condition = threading.Condition()
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self.logger = logger
+
+    def split(self, num_workers: int) -> ResourceBudget:
+        # プロセス間では予算を共有できないため、ワーカープロセスごとに等分した予算を返す
+        # 各プロセスの予算は起動時に固定され、他のプロセスの空きを利用することはない。
+        # 1プロセス分の予算を超える要求は待機せず、grant_for によりその予算まで切り詰めて実行される
+        return {
+            "cpu": max(1, self.budget["cpu"] // num_workers),
+            "memory_bytes": max(1, self.budget["memory_bytes"] // num_workers),
+            "subprocesses": max(1, self.budget["subprocesses"] // num_workers),
+        }
+
+    def grant_for(self, demand: ResourceDemand) -> ResourceDemand:
+        # 予算より大きな要求は予算に切り詰め、単独であれば必ず実行できるようにする
+        return {
+            key: min(demand.get(key, 0), self.budget[key])  # type: ignore
+            for key in RESOURCE_KEYS
+        }
+
+    def __fits(self, grant: ResourceDemand, admission: bool) -> bool:
+        # ジョブが確保した分だけで予算が埋まってもステージが止まらないよう、
+        # 他に実行中のステージがなければステージは必ず開始できる
+        if (self.holders if admission else self.stage_holders) == 0:
+            return True
+        return all(
+            self.in_use[key] + grant.get(key, 0) <= self.budget[key]  # type: ignore
+            for key in RESOURCE_KEYS
+        )
+
+    @contextmanager
+    def acquire(
+        self, demand: ResourceDemand, name: str, admission: bool = False
+    ) -> Iterator[ResourceDemand]:
+        # admission はジョブ全体の受け入れ、それ以外は負荷の高いステージの実行に利用する
+        grant = self.grant_for(demand)
+        self.__reserve(grant, name, admission)
+        token = current_grant.set(grant)
+        try:
+            yield grant
+        finally:
+            current_grant.reset(token)
+            self.__release(grant, admission)
+
+    @asynccontextmanager
+    async def acquire_async(
+        self, demand: ResourceDemand, name: str, admission: bool = False
+    ) -> AsyncIterator[ResourceDemand]:
+        # 空きを待つ間もイベントループを止めず、スレッドも占有しない
+        grant = self.grant_for(demand)
+        loop = asyncio.get_running_loop()
+        waited_from: Optional[float] = None
+        while True:
+            released = asyncio.Event()
+            with self.condition:
+                if self.__fits(grant, admission):
+                    self.__take(grant, admission)
+                    break
+                self.waiters.append((loop, released))
+            if waited_from is None:
+                waited_from = self.__log_waiting(name)
+            try:
+                await asyncio.wait_for(released.wait(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.waiters.remove((loop, released))
+            # 待機中もキャンセルを受け付ける
+            check_cancelled()
+        self.__log_started(name, waited_from)
+        token = current_grant.set(grant)
+        try:
+            yield grant
+        finally:
+            current_grant.reset(token)
+            self.__release(grant, admission)
+
+    def __reserve(self, grant: ResourceDemand, name: str, admission: bool) -> None:
+        waited_from: Optional[float] = None
+        with self.condition:
+            while not self.__fits(grant, admission):
+                if waited_from is None:
+                    waited_from = self.__log_waiting(name)
+                # 待機中もキャンセルを受け付ける
+                self.condition.wait(timeout=0.5)
+                check_cancelled()
+            self.__take(grant, admission)
+        self.__log_started(name, waited_from)
+
+    def __take(self, grant: ResourceDemand, admission: bool) -> None:
+        for key in RESOURCE_KEYS:
+            self.in_use[key] += grant.get(key, 0)  # type: ignore
+        self.holders += 1
+        self.stage_holders += 0 if admission else 1
+
+    def __release(self, grant: ResourceDemand, admission: bool) -> None:
+        with self.condition:
+            for key in RESOURCE_KEYS:
+                self.in_use[key] -= grant.get(key, 0)  # type: ignore
+            self.holders -= 1
+            self.stage_holders -= 0 if admission else 1
+            self.condition.notify_all()
+            # イベントループ上で待機している acquire_async にも返却を知らせる
+            for loop, released in self.waiters:
+                loop.call_soon_threadsafe(released.set)
+
+    def __log_waiting(self, name: str) -> float:
+        if self.logger is not None:
+            self.logger.info(
+                f"{name}はリソースの空きを待機しています (使用中: {self.usage()})"
+            )
+        return time.perf_counter()
+
+    def __log_started(self, name: str, waited_from: Optional[float]) -> None:
+        if waited_from is not None and self.logger is not None:
+            self.logger.info(
+                f"{name}を開始します (待機時間: {time.perf_counter() - waited_from:.1f}s)"
+            )
+
+    def usage(self) -> Dict[str, str]:
+        return {key: f"{self.in_use[key]}/{self.budget[key]}" for key in RESOURCE_KEYS}
+
+
+current_grant: ContextVar[Optional[ResourceDemand]] = ContextVar(
+    "current_grant", default=None
+)
+
+
+def granted_cpu() -> Optional[int]:
+    # 実行中のステージに割り当てられたCPU数。ガバナーを利用していない場合は None
+    grant = current_grant.get()
+    if grant is None or not grant.get("cpu"):
+        return None
+    return grant["cpu"]
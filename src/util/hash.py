@@ -0,0 +1,39 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+_digest_cache: Dict[Tuple[str, int, int], str] = {}
+_digest_cache_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    # 同じファイルを何度もハッシュ化しないよう、サイズと更新時刻が同じ間は結果を使い回す
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digest_cache_lock:
+        if cache_key in _digest_cache:
+            return _digest_cache[cache_key]
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    with _digest_cache_lock:
+        _digest_cache[cache_key] = digest
+    return digest
+
+
+def directory_digest(path: str) -> Dict[str, str]:
+    return {
+        f: file_digest(os.path.join(path, f))
+        for f in sorted(os.listdir(path))
+        if os.path.isfile(os.path.join(path, f))
+    }
+
+
+def json_digest(value: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
@@ -0,0 +1,318 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Type
+
+from pydantic import BaseModel
+
+from .cassette import (
+    AsyncRecordedCompletionStream,
+    AsyncRecordingCompletionStream,
+    RecordedCompletionStream,
+    RecordingCompletionStream,
+    completion_decoder,
+    completion_request,
+    encode_completion,
+)
+from .governor import parse_size
+from .hash import json_digest
+from .usage import mark_replayed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+DEFAULT_LLM_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".shoorter", "llm_cache.sqlite3"
+)
+DEFAULT_LLM_CACHE_TTL = 7 * 24 * 3600.0
+DEFAULT_LLM_CACHE_MAX_BYTES = 64 * 1024**2
+
+COMPLETION_PARSE_KIND = "chat.completions.parse"
+COMPLETION_STREAM_KIND = "chat.completions.stream"
+
+# 原稿の重複検出で生成し直す場合など、同じリクエストでも新しい応答が必要な間は参照しない
+llm_cache_bypassed: ContextVar[bool] = ContextVar("llm_cache_bypassed", default=False)
+
+
+@contextmanager
+def bypass_llm_cache() -> Iterator[None]:
+    # 応答の保存は行うため、次回以降は新しい応答が再利用される
+    token = llm_cache_bypassed.set(True)
+    try:
+        yield
+    finally:
+        llm_cache_bypassed.reset(token)
+
+
+class LLMCache:
+    def __init__(
+        self,
+        db_path: str = DEFAULT_LLM_CACHE_PATH,
+        ttl: float = DEFAULT_LLM_CACHE_TTL,
+        max_bytes: int = DEFAULT_LLM_CACHE_MAX_BYTES,
+    ) -> None:
+        # モデル・メッセージ全体・応答のスキーマが同じリクエストの応答を再利用する
+        # ttl 秒を過ぎた応答は利用せず、合計が max_bytes を超えたら参照が古いものから削除する
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.counts = {"hit": 0, "miss": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.__connection().executescript(SCHEMA)
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに接続する
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def __count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counts[name] += value
+
+    def key(self, kind: str, request: Dict[str, Any]) -> str:
+        return json_digest({"kind": kind, "request": request})
+
+    def get(self, kind: str, request: Dict[str, Any]) -> Optional[Any]:
+        if llm_cache_bypassed.get():
+            self.__count("miss")
+            return None
+        key = self.key(kind, request)
+        now = time.time()
+        connection = self.__connection()
+        with connection:
+            row = connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                connection.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+        if row is None:
+            self.__count("miss")
+            return None
+        self.__count("hit")
+        # キャッシュから返した呼び出しは費用の集計から除く
+        mark_replayed()
+        return json.loads(row[0])
+
+    def put(self, kind: str, request: Dict[str, Any], response: Any) -> None:
+        data = json.dumps(response, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        connection = self.__connection()
+        with connection:
+            # 並行して書き込む他のプロセスと合計サイズの判定が食い違わないよう、書き込みロックを取ってから行う
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, kind, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.key(kind, request), kind, data, size, now, now),
+            )
+            evicted = self.__evict(connection, now)
+        if evicted:
+            self.__count("evicted", evicted)
+
+    def __evict(self, connection: sqlite3.Connection, now: float) -> int:
+        evicted = connection.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        ).rowcount
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return evicted
+        for key, size in connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        row = (
+            self.__connection()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses")
+            .fetchone()
+        )
+        with self.lock:
+            return {**self.counts, "entries": row[0], "bytes": row[1]}
+
+
+default_llm_cache: Optional[LLMCache] = None
+default_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    # プロセス内で共有する既定のキャッシュ。SHOORTER_LLM_CACHE_DB・SHOORTER_LLM_CACHE_TTL (秒)・
+    # SHOORTER_LLM_CACHE_MAX_BYTES (例: 256M) で保存先・有効期限・容量を変更できる
+    global default_llm_cache
+    with default_llm_cache_lock:
+        if default_llm_cache is None:
+            default_llm_cache = LLMCache(
+                os.environ.get("SHOORTER_LLM_CACHE_DB", DEFAULT_LLM_CACHE_PATH),
+                ttl=float(
+                    os.environ.get("SHOORTER_LLM_CACHE_TTL", DEFAULT_LLM_CACHE_TTL)
+                ),
+                max_bytes=parse_size(os.environ["SHOORTER_LLM_CACHE_MAX_BYTES"])
+                if os.environ.get("SHOORTER_LLM_CACHE_MAX_BYTES")
+                else DEFAULT_LLM_CACHE_MAX_BYTES,
+            )
+        return default_llm_cache
+
+
+def store_completion(
+    cache: LLMCache, kind: str, request: Dict[str, Any], completion: Any
+) -> None:
+    # 拒否された応答や解析に失敗した応答は再利用しない
+    response, _ = encode_completion(completion)
+    if response["parsed"] is not None:
+        cache.put(kind, request, response)
+
+
+class CachedCompletions:
+    def __init__(self, completions: Any, cache: LLMCache) -> None:
+        self.completions = completions
+        self.cache = cache
+
+    def parse(
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        cached = self.cache.get(COMPLETION_PARSE_KIND, request)
+        if cached is not None:
+            return completion_decoder(response_format)(cached, None)
+        completion = self.completions.parse(
+            model=model, messages=messages, response_format=response_format, **kwargs
+        )
+        store_completion(self.cache, COMPLETION_PARSE_KIND, request, completion)
+        return completion
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        cached = self.cache.get(COMPLETION_STREAM_KIND, request)
+        if cached is not None:
+            return RecordedCompletionStream(
+                completion_decoder(response_format)(cached, None)
+            )
+        return RecordingCompletionStream(
+            self.completions.stream(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            lambda completion: store_completion(
+                self.cache, COMPLETION_STREAM_KIND, request, completion
+            ),
+        )
+
+
+class CachedAsyncCompletions(CachedCompletions):
+    async def parse(  # type: ignore[override]
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        cached = self.cache.get(COMPLETION_PARSE_KIND, request)
+        if cached is not None:
+            return completion_decoder(response_format)(cached, None)
+        completion = await self.completions.parse(
+            model=model, messages=messages, response_format=response_format, **kwargs
+        )
+        store_completion(self.cache, COMPLETION_PARSE_KIND, request, completion)
+        return completion
+
+    def stream(  # type: ignore[override]
+        self,
+        model: str,
+        messages: List[Any],
+        response_format: Type[BaseModel],
+        **kwargs: Any,
+    ) -> Any:
+        request = completion_request(model, messages, response_format, kwargs)
+        cached = self.cache.get(COMPLETION_STREAM_KIND, request)
+        if cached is not None:
+            return AsyncRecordedCompletionStream(
+                completion_decoder(response_format)(cached, None)
+            )
+        return AsyncRecordingCompletionStream(
+            self.completions.stream(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                **kwargs,
+            ),
+            lambda completion: store_completion(
+                self.cache, COMPLETION_STREAM_KIND, request, completion
+            ),
+        )
+
+
+class CachedOpenAI:
+    # OpenAI クライアントのうち、構造化出力の応答のみをキャッシュする。画像生成はそのまま呼び出す
+    def __init__(self, client: Any, cache: LLMCache) -> None:
+        completions = CachedCompletions(client.beta.chat.completions, cache)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = client.images
+
+
+class CachedAsyncOpenAI:
+    def __init__(self, client: Any, cache: LLMCache) -> None:
+        completions = CachedAsyncCompletions(client.beta.chat.completions, cache)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+        self.images = client.images
+
+
+def attach_llm_cache(generator: Any, cache: LLMCache) -> None:
+    # 生成器が保持する OpenAI クライアントを、応答をキャッシュするものに差し替える
+    # カセットと併用する場合は、カセットより先に差し替えてカセットがキャッシュを包むようにする
+    if hasattr(generator, "openai_client"):
+        generator.openai_client = CachedOpenAI(generator.openai_client, cache)
+    if hasattr(generator, "async_openai_client"):
+        generator.async_openai_client = CachedAsyncOpenAI(
+            generator.async_openai_client, cache
+        )
+    if hasattr(generator, "image_generator"):
+        attach_llm_cache(generator.image_generator, cache)
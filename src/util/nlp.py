@@ -1,11 +1,25 @@
+import threading
+
 import fugashi
 
+# Tagger の生成は辞書の読み込みを伴い重いため、プロセス内で使い回す。
+# Tagger はスレッドセーフではないため、解析はロックを取得して行う
+tagger: fugashi.Tagger | None = None
+tagger_lock = threading.Lock()
+
+
+def get_tagger() -> fugashi.Tagger:
+    global tagger
+    if tagger is None:
+        tagger = fugashi.Tagger()
+    return tagger
+
 
 def tokenize(text: str) -> list[str]:
-    tagger = fugashi.Tagger()
-    texts = []
-    for token in tagger(text):
-        texts.append(token.surface)
+    with tagger_lock:
+        texts = []
+        for token in get_tagger()(text):
+            texts.append(token.surface)
     return texts
 
 def wrap_text(text: str, num_text_per_line: int) -> list[str]:
@@ -18,4 +32,37 @@ def wrap_text(text: str, num_text_per_line: int) -> list[str]:
         line += token
     if line:
         wrapped_texts.append(line)
-    return wrapped_texts
\ No newline at end of file
+    return wrapped_texts
+
+
+# 拗音などの小書きの仮名は直前の仮名と合わせて1モーラとする
+SMALL_KANA = set("ァィゥェォャュョヮぁぃぅぇぉゃゅょゎ")
+
+
+def surface_morae(surface: str) -> int:
+    # 辞書に読みがない語は表記から見積もる。数字や英字は1文字を2モーラ程度で読む
+    morae = 0
+    for char in surface:
+        if char in SMALL_KANA:
+            continue
+        if "ぁ" <= char <= "ゖ" or "ァ" <= char <= "ヺ" or char == "ー":
+            morae += 1
+        elif char.isalnum():
+            morae += 2
+    return morae
+
+
+def count_morae(text: str) -> int:
+    # 形態素解析で得た発音の仮名からモーラ数を数える
+    with tagger_lock:
+        readings = [
+            (token.surface, getattr(token.feature, "pron", None))
+            for token in get_tagger()(text)
+        ]
+    morae = 0
+    for surface, pron in readings:
+        if pron is None or pron == "*":
+            morae += surface_morae(surface)
+        else:
+            morae += sum(1 for char in pron if char not in SMALL_KANA)
+    return morae
@@ -1,16 +1,97 @@
+import asyncio
 import logging
 import os
-from typing import List, Literal
+from typing import Any, List, Literal, Type
 
 import requests
-from openai import OpenAI
+from openai import RateLimitError
+from openai.types.chat import ChatCompletionMessageParam
 from pydantic import BaseModel
 
+from .progress import JobCancelledError, check_cancelled
+from .rate_limit import openai_clients
+from .tracing import span
+from .usage import openai_call
+
 
 class Keywords(BaseModel):
     keywords: List[str]
 
 
+ImageSize = Literal["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"]
+
+KEYWORD_MODEL = "gpt-4o-2024-08-06"
+IMAGE_MODEL = "dall-e-3"
+KEYWORD_FILTER_PROMPT = "OpenAI Usage policiesを参照して、Dall-Eを用いて画像生成をする上でPolicyに抵触するようなキーワードは、類似する抽象的な別のキーワードに置き換えてください。例えば個人名や不適切な単語、個別の具体的な作品名が抵触するキーワードです。"
+# キーワードでの画像生成に失敗した場合に代わりに用いるプロンプト
+FALLBACK_IMAGE_PROMPT = "動画"
+
+
+# 以下は同期版と非同期版の組であり、使用量の記録を含めて呼び出し方以外は同じとする
+
+
+def parse_completion(
+    client: Any,
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+    response_format: Type[BaseModel],
+    purpose: str,
+) -> Any:
+    with openai_call("chat.completions.parse", model=model, purpose=purpose) as call:
+        completion = client.beta.chat.completions.parse(
+            model=model, messages=messages, response_format=response_format
+        )
+        call.set_response(completion)
+    return completion
+
+
+async def aparse_completion(
+    client: Any,
+    model: str,
+    messages: List[ChatCompletionMessageParam],
+    response_format: Type[BaseModel],
+    purpose: str,
+) -> Any:
+    with openai_call("chat.completions.parse", model=model, purpose=purpose) as call:
+        completion = await client.beta.chat.completions.parse(
+            model=model, messages=messages, response_format=response_format
+        )
+        call.set_response(completion)
+    return completion
+
+
+def generate_image(client: Any, prompt: str, size: ImageSize, purpose: str) -> Any:
+    with openai_call(
+        "images.generate",
+        model=IMAGE_MODEL,
+        purpose=purpose,
+        size=size,
+        quality="standard",
+    ) as call:
+        response = client.images.generate(
+            model=IMAGE_MODEL, prompt=prompt, size=size, quality="standard", n=1
+        )
+        call.set_response(response)
+    return response
+
+
+async def agenerate_image(
+    client: Any, prompt: str, size: ImageSize, purpose: str
+) -> Any:
+    with openai_call(
+        "images.generate",
+        model=IMAGE_MODEL,
+        purpose=purpose,
+        size=size,
+        quality="standard",
+    ) as call:
+        response = await client.images.generate(
+            model=IMAGE_MODEL, prompt=prompt, size=size, quality="standard", n=1
+        )
+        call.set_response(response)
+    return response
+
+
 class ImageGenerator:
     def __init__(
         self,
@@ -19,144 +100,185 @@ class ImageGenerator:
     ):
         self.logger = logger
         try:
-            self.openai_client = OpenAI(api_key=openai_apikey)
+            self.openai_client, self.async_openai_client = openai_clients(openai_apikey)
         except ValueError as e:
             raise e
+        self.http_session: Any = requests.Session()
 
-    def __filter_keywords(self, keywords: List[str]) -> List[str]:
-        filter_response = self.openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "OpenAI Usage policiesを参照して、Dall-Eを用いて画像生成をする上でPolicyに抵触するようなキーワードは、類似する抽象的な別のキーワードに置き換えてください。例えば個人名や不適切な単語、個別の具体的な作品名が抵触するキーワードです。",
-                },
-                {
-                    "role": "user",
-                    "content": f"{','.join(keywords)}",
-                },
-            ],
-            response_format=Keywords,
-        )
-        filtered_keywords = filter_response.choices[0].message.parsed
-        if not filtered_keywords:
-            raise ValueError("画像生成に用いるキーワードの抽出に失敗しました。")
-        return filtered_keywords.keywords
+    def __filter_messages(
+        self, keywords: List[str]
+    ) -> List[ChatCompletionMessageParam]:
+        return [
+            {
+                "role": "system",
+                "content": KEYWORD_FILTER_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"{','.join(keywords)}",
+            },
+        ]
 
-    def __extract_and_filter_keywords(self, text: str) -> List[str]:
-        filter_response = self.openai_client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "DALL-Eを用いた画像生成において効果的なキーワードをできるだけたくさん抽出してください。",
-                },
-                {
-                    "role": "system",
-                    "content": "OpenAI Usage policiesを参照して、Dall-Eを用いて画像生成をする上でPolicyに抵触するようなキーワードは、類似する抽象的な別のキーワードに置き換えてください。例えば個人名や不適切な単語、個別の具体的な作品名が抵触するキーワードです。",
-                },
-                {
-                    "role": "user",
-                    "content": text,
-                },
-            ],
-            response_format=Keywords,
-        )
+    def __extract_messages(self, text: str) -> List[ChatCompletionMessageParam]:
+        return [
+            {
+                "role": "system",
+                "content": "DALL-Eを用いた画像生成において効果的なキーワードをできるだけたくさん抽出してください。",
+            },
+            {
+                "role": "system",
+                "content": KEYWORD_FILTER_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": text,
+            },
+        ]
+
+    def __parse_keywords(self, filter_response: Any) -> List[str]:
         filtered_keywords = filter_response.choices[0].message.parsed
         if not filtered_keywords:
             raise ValueError("画像生成に用いるキーワードの抽出に失敗しました。")
-        return filtered_keywords.keywords
-
-    def generate_from_keywords(
-        self,
-        keywords: List[str],
-        image_path: str,
-        image_size: Literal[
-            "256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"
-        ],
-    ) -> None:
-        filtered_keywords = self.__filter_keywords(keywords)
-        self.logger.info(f"フィルター後キーワード一覧: {filtered_keywords}")
-        if len(filtered_keywords) == 0:
+        self.logger.info(f"フィルター後キーワード一覧: {filtered_keywords.keywords}")
+        if len(filtered_keywords.keywords) == 0:
             self.logger.info(
                 "フィルター後キーワードが空のため、動画というキーワードで生成を試みます"
             )
-            filtered_keywords = ["動画"]
+            return [FALLBACK_IMAGE_PROMPT]
+        return filtered_keywords.keywords
+
+    def __fallback_prompt(self, error: Exception) -> str:
+        # 再試行しても上限を超える場合は、別のプロンプトで呼び出しても失敗する
+        # キャンセルされた場合も、別のプロンプトで呼び出し直さない
+        if isinstance(error, (RateLimitError, JobCancelledError)):
+            raise error
+        self.logger.error(f"画像生成に失敗しました: {error}")
+        self.logger.info("代わりに動画というキーワードで生成を試みます")
+        return FALLBACK_IMAGE_PROMPT
+
+    def __image_url(self, image_generation_response: Any) -> str:
+        image_url = image_generation_response.data[0].url
+        if image_url is None:
+            raise ValueError("DALL-Eでの画像生成に失敗しました。")
+        return image_url
+
+    def __generate_image(self, keywords: List[str], image_size: ImageSize) -> str:
         try:
-            image_generation_response = self.openai_client.images.generate(
-                model="dall-e-3",
-                prompt=f"{','.join(filtered_keywords)}",
-                size=image_size,
-                quality="standard",
-                n=1,
+            response = generate_image(
+                self.openai_client, ",".join(keywords), image_size, "image"
             )
         except Exception as e:
-            self.logger.error(f"画像生成に失敗しました: {e}")
-            self.logger.info("代わりに動画というキーワードで生成を試みます")
-            image_generation_response = self.openai_client.images.generate(
-                model="dall-e-3",
-                prompt="動画",
-                size=image_size,
-                quality="standard",
-                n=1,
+            response = generate_image(
+                self.openai_client,
+                self.__fallback_prompt(e),
+                image_size,
+                "image_fallback",
             )
-        image_url = image_generation_response.data[0].url
-        if image_url is None:
-            raise ValueError("DALL-Eでの画像生成に失敗しました。")
+        return self.__image_url(response)
+
+    def __download(self, image_url: str, image_path: str) -> None:
         os.makedirs(os.path.dirname(image_path), exist_ok=True)
         os.remove(image_path) if os.path.exists(image_path) else None
-        response = requests.get(url=image_url)
-        if response.status_code == 200:
-            with open(image_path, "wb") as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            self.logger.info(f"画像を保存しました: {image_path}")
-        else:
-            raise ValueError(f"画像のダウンロードに失敗しました: {image_url}")
+        with span("image.download", category="http", image_path=image_path):
+            response = self.http_session.get(url=image_url)
+            if response.status_code == 200:
+                with open(image_path, "wb") as file:
+                    for chunk in response.iter_content(1024):
+                        file.write(chunk)
+                self.logger.info(f"画像を保存しました: {image_path}")
+            else:
+                raise ValueError(f"画像のダウンロードに失敗しました: {image_url}")
+
+    def generate_from_keywords(
+        self,
+        keywords: List[str],
+        image_path: str,
+        image_size: ImageSize,
+    ) -> None:
+        check_cancelled()
+        filter_response = parse_completion(
+            self.openai_client,
+            KEYWORD_MODEL,
+            self.__filter_messages(keywords),
+            Keywords,
+            "filter_keywords",
+        )
+        self.__download(
+            self.__generate_image(self.__parse_keywords(filter_response), image_size),
+            image_path,
+        )
 
     def generate_from_text(
         self,
         text: str,
         image_path: str,
-        image_size: Literal[
-            "256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"
-        ],
+        image_size: ImageSize,
     ) -> None:
-        filtered_keywords = self.__extract_and_filter_keywords(text)
-        self.logger.info(f"フィルター後キーワード一覧: {filtered_keywords}")
-        if len(filtered_keywords) == 0:
-            self.logger.info(
-                "フィルター後キーワードが空のため、動画というキーワードで生成を試みます"
-            )
-            filtered_keywords = ["動画"]
+        check_cancelled()
+        filter_response = parse_completion(
+            self.openai_client,
+            KEYWORD_MODEL,
+            self.__extract_messages(text),
+            Keywords,
+            "extract_and_filter_keywords",
+        )
+        self.__download(
+            self.__generate_image(self.__parse_keywords(filter_response), image_size),
+            image_path,
+        )
+
+    # 以下は AsyncOpenAI を利用する非同期版であり、1つのイベントループで多数の API 呼び出しを並行させられる
+
+    async def __agenerate_image(
+        self, keywords: List[str], image_size: ImageSize
+    ) -> str:
         try:
-            image_generation_response = self.openai_client.images.generate(
-                model="dall-e-3",
-                prompt=f"{','.join(filtered_keywords)}",
-                size=image_size,
-                quality="standard",
-                n=1,
+            response = await agenerate_image(
+                self.async_openai_client, ",".join(keywords), image_size, "image"
             )
         except Exception as e:
-            self.logger.error(f"画像生成に失敗しました: {e}")
-            self.logger.info("代わりに動画というキーワードで生成を試みます")
-            image_generation_response = self.openai_client.images.generate(
-                model="dall-e-3",
-                prompt="動画",
-                size=image_size,
-                quality="standard",
-                n=1,
+            response = await agenerate_image(
+                self.async_openai_client,
+                self.__fallback_prompt(e),
+                image_size,
+                "image_fallback",
             )
-        image_url = image_generation_response.data[0].url
-        if image_url is None:
-            raise ValueError("DALL-Eでの画像生成に失敗しました。")
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        os.remove(image_path) if os.path.exists(image_path) else None
-        response = requests.get(url=image_url)
-        if response.status_code == 200:
-            with open(image_path, "wb") as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            self.logger.info(f"画像を保存しました: {image_path}")
-        else:
-            raise ValueError(f"画像のダウンロードに失敗しました: {image_url}")
+        return self.__image_url(response)
+
+    async def agenerate_from_keywords(
+        self,
+        keywords: List[str],
+        image_path: str,
+        image_size: ImageSize,
+    ) -> None:
+        check_cancelled()
+        filter_response = await aparse_completion(
+            self.async_openai_client,
+            KEYWORD_MODEL,
+            self.__filter_messages(keywords),
+            Keywords,
+            "filter_keywords",
+        )
+        image_url = await self.__agenerate_image(
+            self.__parse_keywords(filter_response), image_size
+        )
+        await asyncio.to_thread(self.__download, image_url, image_path)
+
+    async def agenerate_from_text(
+        self,
+        text: str,
+        image_path: str,
+        image_size: ImageSize,
+    ) -> None:
+        check_cancelled()
+        filter_response = await aparse_completion(
+            self.async_openai_client,
+            KEYWORD_MODEL,
+            self.__extract_messages(text),
+            Keywords,
+            "extract_and_filter_keywords",
+        )
+        image_url = await self.__agenerate_image(
+            self.__parse_keywords(filter_response), image_size
+        )
+        await asyncio.to_thread(self.__download, image_url, image_path)
@@ -0,0 +1,160 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from types import FrameType
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# スタックの各フレームを (関数名, ファイル名, 行番号) で表す
+StackFrame = Tuple[str, str, int]
+
+
+def frame_stack(frame: Optional[FrameType]) -> Tuple[StackFrame, ...]:
+    # 呼び出し元から順に並べたスタック。行番号は関数の定義位置を利用し、同じ関数を1つにまとめる
+    stack: List[StackFrame] = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_qualname, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def frame_label(frame: StackFrame) -> str:
+    name, filename, line = frame
+    # collapsed stack 形式の区切り文字を含めない
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(";", ":")
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005) -> None:
+        # 対象のスレッドのスタックを interval 秒ごとに採取する。外部のツールを接続せずにホットスポットを調べられる
+        self.interval = interval
+        self.targets: Dict[int, str] = {}
+        self.samples: Dict[str, List[Tuple[Tuple[StackFrame, ...], float]]] = {}
+        self.durations: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        # 採取のスレッドごとに停止のイベントを持ち、停止直後に次の採取が始まっても確実に止める
+        self.stop_event: Optional[threading.Event] = None
+
+    @contextmanager
+    def sampling(self, name: str) -> Iterator[None]:
+        # with ブロックを実行しているスレッドのスタックを name のプロファイルとして採取する
+        thread_id = threading.get_ident()
+        start = time.perf_counter()
+        with self.lock:
+            self.targets[thread_id] = name
+            self.samples.setdefault(name, [])
+            if self.thread is None:
+                self.stop_event = threading.Event()
+                self.thread = threading.Thread(
+                    target=self.__sample_loop,
+                    args=(self.stop_event,),
+                    name="profiler",
+                    daemon=True,
+                )
+                self.thread.start()
+        try:
+            yield
+        finally:
+            thread = None
+            with self.lock:
+                del self.targets[thread_id]
+                self.durations[name] = (
+                    self.durations.get(name, 0.0) + time.perf_counter() - start
+                )
+                if not self.targets and self.stop_event is not None:
+                    thread, self.thread = self.thread, None
+                    self.stop_event.set()
+                    self.stop_event = None
+            if thread is not None:
+                thread.join()
+
+    def __sample_loop(self, stop_event: threading.Event) -> None:
+        last = time.perf_counter()
+        while not stop_event.wait(self.interval):
+            now = time.perf_counter()
+            # 採取の間隔は負荷によって揺らぐため、実際の経過時間を重みにする
+            weight, last = now - last, now
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, name in self.targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.samples[name].append((frame_stack(frame), weight))
+            del frames
+
+    def names(self) -> List[str]:
+        with self.lock:
+            return [name for name, samples in self.samples.items() if samples]
+
+    def to_collapsed(self, name: str) -> str:
+        # flamegraph.pl や speedscope で読み込める collapsed stack 形式。値はミリ秒
+        with self.lock:
+            samples = list(self.samples.get(name, []))
+        # 重みはサンプリング間隔の実測値 [s] のため、小数のまま合計する
+        weights: Dict[str, float] = defaultdict(float)
+        for stack, weight in samples:
+            weights[";".join(frame_label(frame) for frame in stack)] += weight
+        return "".join(
+            f"{stack} {max(1, round(weight * 1000))}\n"
+            for stack, weight in sorted(
+                weights.items(), key=lambda item: item[1], reverse=True
+            )
+        )
+
+    def to_speedscope(self, name: str) -> Dict[str, Any]:
+        # speedscope の sampled 形式。採取した順に並ぶため時系列でも確認できる
+        with self.lock:
+            samples = list(self.samples.get(name, []))
+            duration = self.durations.get(name, 0.0)
+        frame_indices: Dict[StackFrame, int] = {}
+        frames: List[Dict[str, Any]] = []
+        stacks: List[List[int]] = []
+        for stack, _ in samples:
+            indices = []
+            for frame in stack:
+                if frame not in frame_indices:
+                    frame_indices[frame] = len(frames)
+                    frames.append(
+                        {"name": frame[0], "file": frame[1], "line": frame[2]}
+                    )
+                indices.append(frame_indices[frame])
+            stacks.append(indices)
+        weights = [weight for _, weight in samples]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "shoorter",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": max(duration, sum(weights)),
+                    "samples": stacks,
+                    "weights": weights,
+                }
+            ],
+        }
+
+    def export(self, output_dir: str) -> List[str]:
+        # プロファイルごとに profile_<name>.collapsed と profile_<name>.speedscope.json を書き出す
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for name in self.names():
+            collapsed_path = os.path.join(output_dir, f"profile_{name}.collapsed")
+            with open(collapsed_path, "w", encoding="utf-8") as file:
+                file.write(self.to_collapsed(name))
+            speedscope_path = os.path.join(
+                output_dir, f"profile_{name}.speedscope.json"
+            )
+            with open(speedscope_path, "w", encoding="utf-8") as file:
+                json.dump(self.to_speedscope(name), file, ensure_ascii=False)
+            paths += [collapsed_path, speedscope_path]
+        return paths
@@ -0,0 +1,87 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional
+
+import proglog
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class ProgressReporter:
+    def __init__(
+        self,
+        on_progress: Optional[Callable[[Optional[str], str, int, int], None]] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> None:
+        # on_progress は (ステージ名, 単位, 完了数, 総数) を受け取る
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event or threading.Event()
+
+    def report(self, unit: str, done: int, total: int) -> None:
+        if self.on_progress is not None:
+            self.on_progress(current_stage.get(), unit, done, total)
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise JobCancelledError("生成がキャンセルされました")
+
+
+current_progress: ContextVar[Optional[ProgressReporter]] = ContextVar(
+    "current_progress", default=None
+)
+current_stage: ContextVar[Optional[str]] = ContextVar("current_stage", default=None)
+
+
+@contextmanager
+def progress_reporting(reporter: ProgressReporter) -> Iterator[ProgressReporter]:
+    token = current_progress.set(reporter)
+    try:
+        yield reporter
+    finally:
+        current_progress.reset(token)
+
+
+@contextmanager
+def stage_scope(stage_name: str) -> Iterator[None]:
+    token = current_stage.set(stage_name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+def report_progress(unit: str, done: int, total: int) -> None:
+    reporter = current_progress.get()
+    if reporter is not None:
+        reporter.report(unit, done, total)
+
+
+def check_cancelled() -> None:
+    reporter = current_progress.get()
+    if reporter is not None:
+        reporter.check_cancelled()
+
+
+class MoviePyProgressLogger(proglog.ProgressBarLogger):
+    # write_videofile のフレーム書き出しの進捗を通知し、キャンセル時はエンコードを中断する
+    def __init__(self) -> None:
+        super().__init__()
+        self.reporter = current_progress.get()
+
+    def bars_callback(
+        self, bar: str, attr: str, value: Any, old_value: Any = None
+    ) -> None:
+        if self.reporter is None or bar != "t" or attr != "index":
+            return
+        self.reporter.report("frame", value + 1, self.bars[bar]["total"])
+        self.reporter.check_cancelled()
@@ -0,0 +1,429 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Tuple, TypedDict
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from .progress import check_cancelled
+from .tracing import span
+from .usage import current_openai_call
+
+
+class RateLimit(TypedDict, total=False):
+    rpm: int
+    tpm: int
+
+
+# OpenAI の Tier 1 相当の上限。環境変数 SHOORTER_OPENAI_RATE_LIMITS に
+# {"gpt-4o-2024-08-06": {"rpm": 5000, "tpm": 800000}} のような JSON を指定すると上書きできる
+DEFAULT_RATE_LIMITS: Dict[str, RateLimit] = {
+    "gpt-4o-2024-08-06": {"rpm": 500, "tpm": 30000},
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200000},
+    "dall-e-3": {"rpm": 500},
+}
+DEFAULT_RATE_LIMIT_PATH = os.path.join(
+    os.path.expanduser("~"), ".shoorter", "rate_limit.sqlite3"
+)
+# 応答のトークン数は事前に分からないため、max_tokens の指定がなければこの値で見積もり、応答後に精算する
+DEFAULT_COMPLETION_TOKENS = 1000
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        limits: Optional[Dict[str, RateLimit]] = None,
+        db_path: Optional[str] = None,
+    ) -> None:
+        # モデルごとに 1分あたりのリクエスト数 (rpm) とトークン数 (tpm) のトークンバケットを持つ
+        # db_path を指定した場合はバケットを SQLite に置き、同じホストの全プロセスで上限を共有する
+        # 上限のないモデルは制限しない
+        self.limits = limits if limits is not None else DEFAULT_RATE_LIMITS
+        self.db_path = db_path
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self.__connection().executescript(SCHEMA)
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに接続する
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            assert self.db_path is not None
+            connection = sqlite3.connect(self.db_path, timeout=30.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def __update(
+        self, key: str, capacity: int, update: Callable[[float], float]
+    ) -> float:
+        # 経過時間に応じて補充した残量に update を適用し、更新後の残量を返す
+        # 残量は負になり得る。負の分は後続の呼び出しが補充を待つ時間となる
+        now = time.time()
+        rate = capacity / 60
+        if self.db_path is None:
+            with self.lock:
+                tokens, updated_at = self.buckets.get(key, (capacity, now))
+                tokens = min(
+                    capacity,
+                    update(min(capacity, tokens + (now - updated_at) * rate)),
+                )
+                self.buckets[key] = (tokens, now)
+                return tokens
+        connection = self.__connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated_at = row if row is not None else (capacity, now)
+            tokens = min(
+                capacity,
+                update(min(capacity, tokens + max(0.0, now - updated_at) * rate)),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+        return tokens
+
+    def reserve(self, model: str, tokens: int) -> float:
+        # 1リクエストと tokens トークンを予約し、送信まで待つべき秒数を返す
+        limit = self.limits.get(model, {})
+        delay = 0.0
+        if "rpm" in limit:
+            remaining = self.__update(
+                f"{model}:requests", limit["rpm"], lambda value: value - 1
+            )
+            delay = max(delay, -remaining / (limit["rpm"] / 60))
+        if "tpm" in limit and tokens > 0:
+            # 1分の上限を超える見積もりでも、単独であれば送信できるようにする
+            amount = min(tokens, limit["tpm"])
+            remaining = self.__update(
+                f"{model}:tokens", limit["tpm"], lambda value: value - amount
+            )
+            delay = max(delay, -remaining / (limit["tpm"] / 60))
+        return delay
+
+    def release(self, model: str, tokens: int) -> None:
+        # 送信しなかったリクエストの予約を返却する
+        limit = self.limits.get(model, {})
+        if "rpm" in limit:
+            self.__update(f"{model}:requests", limit["rpm"], lambda value: value + 1)
+        self.settle(model, -tokens)
+
+    def settle(self, model: str, difference: int) -> None:
+        # 見積もりと実際のトークン数との差を精算する
+        limit = self.limits.get(model, {})
+        if "tpm" in limit and difference != 0:
+            amount = max(-limit["tpm"], min(difference, limit["tpm"]))
+            self.__update(f"{model}:tokens", limit["tpm"], lambda value: value - amount)
+
+    def pause(self, model: str, seconds: float) -> bool:
+        # 429 を受け取った場合は、同じモデルへの全てのリクエストを seconds 秒待たせる
+        # rpm の上限がないモデルは待たせられないため False を返し、呼び出し元が自ら待機する
+        limit = self.limits.get(model, {})
+        if "rpm" not in limit:
+            return False
+        rate = limit["rpm"] / 60
+        self.__update(
+            f"{model}:requests",
+            limit["rpm"],
+            lambda value: min(value, -seconds * rate),
+        )
+        return True
+
+    def acquire(self, model: str, tokens: int) -> None:
+        delay = self.reserve(model, tokens)
+        if delay <= 0:
+            return
+        try:
+            with span("openai.rate_limit", category="openai", model=model):
+                sleep(delay)
+        except BaseException:
+            self.release(model, tokens)
+            raise
+
+    async def aacquire(self, model: str, tokens: int) -> None:
+        # SQLite のロックを待つ可能性があるため、予約はスレッドで行う
+        delay = await asyncio.to_thread(self.reserve, model, tokens)
+        if delay <= 0:
+            return
+        try:
+            with span("openai.rate_limit", category="openai", model=model):
+                await asleep(delay)
+        except BaseException:
+            await asyncio.to_thread(self.release, model, tokens)
+            raise
+
+
+def sleep(seconds: float) -> None:
+    # 待機中もキャンセルを受け付ける
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(0.5, remaining))
+        check_cancelled()
+
+
+async def asleep(seconds: float) -> None:
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(0.5, remaining))
+        check_cancelled()
+
+
+default_rate_limiter: Optional[RateLimiter] = None
+default_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    # プロセス内で共有する既定の制限器。バケットは SHOORTER_RATE_LIMIT_DB (既定は ~/.shoorter) に置く
+    global default_rate_limiter
+    with default_rate_limiter_lock:
+        if default_rate_limiter is None:
+            limits = dict(DEFAULT_RATE_LIMITS)
+            if os.environ.get("SHOORTER_OPENAI_RATE_LIMITS"):
+                # tpm のみの指定などでは、指定しなかった上限に既定値を残す
+                for model, limit in json.loads(
+                    os.environ["SHOORTER_OPENAI_RATE_LIMITS"]
+                ).items():
+                    limits[model] = {**limits.get(model, {}), **limit}
+            default_rate_limiter = RateLimiter(
+                limits,
+                os.environ.get("SHOORTER_RATE_LIMIT_DB", DEFAULT_RATE_LIMIT_PATH),
+            )
+        return default_rate_limiter
+
+
+def request_cost(request: httpx.Request) -> Tuple[Optional[str], int]:
+    # 本文からモデル名と、消費するトークン数の見積もりを求める
+    try:
+        body = json.loads(request.content)
+    except ValueError:
+        return None, 0
+    if not isinstance(body, dict) or not isinstance(body.get("model"), str):
+        return None, 0
+    if "messages" not in body:
+        return body["model"], 0
+    # 日本語はおおむね 1文字 1トークン以下となるため、文字数を上限の見積もりとする
+    prompt_tokens = len(json.dumps(body["messages"], ensure_ascii=False))
+    completion_tokens = (
+        body.get("max_completion_tokens")
+        or body.get("max_tokens")
+        or DEFAULT_COMPLETION_TOKENS
+    )
+    return body["model"], prompt_tokens + completion_tokens
+
+
+def should_retry(response: httpx.Response) -> bool:
+    should_retry_header = response.headers.get("x-should-retry")
+    if should_retry_header in ("true", "false"):
+        return should_retry_header == "true"
+    return response.status_code in RETRY_STATUS_CODES
+
+
+def retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    # Retry-After が指定されていればその長さによらず従い、なければジッター付きの指数バックオフとする
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                delay = float(response.headers["retry-after-ms"]) / 1000
+            elif "retry-after" in response.headers:
+                value = response.headers["retry-after"]
+                try:
+                    delay = float(value)
+                except ValueError:
+                    delay = parsedate_to_datetime(value).timestamp() - time.time()
+            else:
+                delay = -1.0
+        except (TypeError, ValueError):
+            delay = -1.0
+        if delay >= 0:
+            return delay
+    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def response_tokens(response: httpx.Response) -> Optional[int]:
+    try:
+        usage = response.json().get("usage") or {}
+    except (ValueError, AttributeError):
+        return None
+    total_tokens = usage.get("total_tokens")
+    return total_tokens if isinstance(total_tokens, int) else None
+
+
+def record_retry(attempt: int) -> None:
+    call = current_openai_call.get()
+    if call is not None:
+        call.retries = attempt
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    # 送信前に制限器で予約し、429 や 5xx、接続エラーは上限の範囲内で再試行する
+    def __init__(
+        self,
+        transport: httpx.BaseTransport,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = MAX_RETRIES,
+    ) -> None:
+        self.transport = transport
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = self.limiter or get_rate_limiter()
+        model, tokens = request_cost(request)
+        attempt = 0
+        while True:
+            if model is not None:
+                limiter.acquire(model, tokens)
+            try:
+                response: Optional[httpx.Response] = self.transport.handle_request(
+                    request
+                )
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            if response is not None and (
+                attempt >= self.max_retries or not should_retry(response)
+            ):
+                if model is not None and tokens and response.status_code == 200:
+                    # ストリーミングの応答は読み切れないため、見積もりのままとする
+                    if response.headers.get("content-type", "").startswith(
+                        "application/json"
+                    ):
+                        response.read()
+                        actual = response_tokens(response)
+                        if actual is not None:
+                            limiter.settle(model, actual - tokens)
+                return response
+            delay = retry_delay(attempt, response)
+            if response is not None:
+                response.close()
+            if model is not None:
+                # 処理されなかったリクエストのトークンは消費されない
+                limiter.settle(model, -tokens)
+            attempt += 1
+            record_retry(attempt)
+            # 429 の場合は、次の予約で同じモデルの他のリクエストと揃って待機する
+            # 制限器で待たせられないモデルは、ここで待機する
+            if not (
+                model is not None
+                and response is not None
+                and response.status_code == 429
+                and limiter.pause(model, delay)
+            ):
+                sleep(delay)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = MAX_RETRIES,
+    ) -> None:
+        self.transport = transport
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = self.limiter or get_rate_limiter()
+        model, tokens = request_cost(request)
+        attempt = 0
+        while True:
+            if model is not None:
+                await limiter.aacquire(model, tokens)
+            try:
+                response: Optional[
+                    httpx.Response
+                ] = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            if response is not None and (
+                attempt >= self.max_retries or not should_retry(response)
+            ):
+                if model is not None and tokens and response.status_code == 200:
+                    if response.headers.get("content-type", "").startswith(
+                        "application/json"
+                    ):
+                        await response.aread()
+                        actual = response_tokens(response)
+                        if actual is not None:
+                            await asyncio.to_thread(
+                                limiter.settle, model, actual - tokens
+                            )
+                return response
+            delay = retry_delay(attempt, response)
+            if response is not None:
+                await response.aclose()
+            if model is not None:
+                await asyncio.to_thread(limiter.settle, model, -tokens)
+            attempt += 1
+            record_retry(attempt)
+            if not (
+                model is not None
+                and response is not None
+                and response.status_code == 429
+                and await asyncio.to_thread(limiter.pause, model, delay)
+            ):
+                await asleep(delay)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def openai_clients(api_key: str) -> Tuple[OpenAI, AsyncOpenAI]:
+    # 全ての生成器の OpenAI API の呼び出しを、ホストで共有する制限器の範囲内で行うクライアントを作成する
+    # 再試行も制限器を通すため、SDK 自体の再試行は無効にする
+    return (
+        OpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=DefaultHttpxClient(
+                transport=RateLimitedTransport(httpx.HTTPTransport())
+            ),
+        ),
+        AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                transport=AsyncRateLimitedTransport(httpx.AsyncHTTPTransport())
+            ),
+        ),
+    )
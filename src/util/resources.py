@@ -0,0 +1,294 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Set, TypedDict
+
+
+class ProcessSample(TypedDict):
+    rss_bytes: int
+    disk_read_bytes: Optional[int]
+    disk_write_bytes: Optional[int]
+
+
+class StageResourceUsage(TypedDict):
+    stage: str
+    wall_seconds: float
+    # ステージを実行したスレッドのCPU時間
+    user_cpu_seconds: float
+    system_cpu_seconds: float
+    # 終了した子プロセスのCPU時間。並行して実行中のステージの子プロセスも含む
+    children_user_cpu_seconds: float
+    children_system_cpu_seconds: float
+    # 自プロセスと子孫プロセスの RSS の合計の最大値
+    peak_rss_bytes: int
+    peak_children_rss_bytes: int
+    disk_read_bytes: Optional[int]
+    disk_write_bytes: Optional[int]
+    num_child_processes: int
+    child_processes: Dict[str, int]
+    concurrent_stages: List[str]
+
+
+class ResourceReport(TypedDict):
+    pid: int
+    platform: str
+    sample_interval: float
+    peak_rss_bytes: int
+    stages: List[StageResourceUsage]
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+HAS_PROCFS = os.path.exists("/proc/self/stat")
+SPAWN_EVENTS = {"subprocess.Popen", "os.system", "os.posix_spawn", "os.spawn"}
+
+
+def read_proc_io(pid: int) -> tuple[Optional[int], Optional[int]]:
+    try:
+        with open(f"/proc/{pid}/io", "r") as file:
+            values = dict(line.split(": ") for line in file.read().splitlines())
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def sample_process_tree(root_pid: int) -> Dict[int, ProcessSample]:
+    # root_pid と、その子孫プロセスの RSS とディスク I/O を取得する
+    parents: Dict[int, int] = {}
+    rss: Dict[int, int] = {}
+    if HAS_PROCFS:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", "r") as file:
+                    # コマンド名に空白や括弧を含む場合があるため、最後の ")" 以降を分割する
+                    fields = file.read().rsplit(")", 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            parents[int(entry)] = int(fields[1])
+            rss[int(entry)] = int(fields[21]) * PAGE_SIZE
+    else:
+        output = subprocess.run(
+            ["ps", "-A", "-o", "pid=,ppid=,rss="],
+            capture_output=True,
+            text=True,
+            check=False,
+        ).stdout
+        for line in output.splitlines():
+            pid, ppid, rss_kb = (int(value) for value in line.split())
+            parents[pid] = ppid
+            rss[pid] = rss_kb * 1024
+
+    tree = {root_pid}
+    # 親子関係を辿り、子孫プロセスをすべて集める
+    while True:
+        children = {
+            pid for pid, ppid in parents.items() if ppid in tree and pid not in tree
+        }
+        if not children:
+            break
+        tree |= children
+
+    samples: Dict[int, ProcessSample] = {}
+    for pid in tree:
+        if pid not in rss:
+            continue
+        read_bytes, write_bytes = read_proc_io(pid) if HAS_PROCFS else (None, None)
+        samples[pid] = {
+            "rss_bytes": rss[pid],
+            "disk_read_bytes": read_bytes,
+            "disk_write_bytes": write_bytes,
+        }
+    return samples
+
+
+def thread_cpu_times() -> tuple[float, float]:
+    # RUSAGE_THREAD が使えない環境ではプロセス全体の値で代用する
+    usage = resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+    return usage.ru_utime, usage.ru_stime
+
+
+class StageResourceTracker:
+    def __init__(self, stage_name: str, baseline: Dict[int, ProcessSample]) -> None:
+        self.stage_name = stage_name
+        self.baseline = baseline
+        self.started_at = time.perf_counter()
+        self.thread_cpu = thread_cpu_times()
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.peak_rss_bytes = 0
+        self.peak_children_rss_bytes = 0
+        # 計測中に観測したプロセスごとの最新のディスク I/O
+        self.last_samples: Dict[int, ProcessSample] = {}
+        self.child_pids: Set[int] = set()
+        self.child_processes: Dict[str, int] = {}
+        self.concurrent_stages: Set[str] = set()
+
+    def observe(self, samples: Dict[int, ProcessSample]) -> None:
+        own_pid = os.getpid()
+        children_rss = sum(
+            sample["rss_bytes"] for pid, sample in samples.items() if pid != own_pid
+        )
+        own_rss = samples[own_pid]["rss_bytes"] if own_pid in samples else 0
+        self.peak_rss_bytes = max(self.peak_rss_bytes, own_rss + children_rss)
+        self.peak_children_rss_bytes = max(self.peak_children_rss_bytes, children_rss)
+        self.last_samples.update(samples)
+        self.child_pids |= {pid for pid in samples if pid not in self.baseline}
+
+    def record_spawn(self, executable: str) -> None:
+        name = os.path.basename(executable)
+        self.child_processes[name] = self.child_processes.get(name, 0) + 1
+
+    def disk_bytes(self, key: str) -> Optional[int]:
+        total = 0
+        for pid, sample in self.last_samples.items():
+            value = sample[key]  # type: ignore
+            if value is None:
+                return None
+            base = self.baseline.get(pid)
+            base_value = base[key] if base is not None else 0  # type: ignore
+            total += value - (base_value or 0)
+        return total
+
+    def finish(self) -> StageResourceUsage:
+        user_cpu, system_cpu = thread_cpu_times()
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "stage": self.stage_name,
+            "wall_seconds": time.perf_counter() - self.started_at,
+            "user_cpu_seconds": user_cpu - self.thread_cpu[0],
+            "system_cpu_seconds": system_cpu - self.thread_cpu[1],
+            "children_user_cpu_seconds": children_usage.ru_utime
+            - self.children_usage.ru_utime,
+            "children_system_cpu_seconds": children_usage.ru_stime
+            - self.children_usage.ru_stime,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "peak_children_rss_bytes": self.peak_children_rss_bytes,
+            "disk_read_bytes": self.disk_bytes("disk_read_bytes"),
+            "disk_write_bytes": self.disk_bytes("disk_write_bytes"),
+            # 短時間で終了するプロセスはサンプリングで捕捉できないため、起動の監査イベントも数える
+            "num_child_processes": max(
+                len(self.child_pids), sum(self.child_processes.values())
+            ),
+            "child_processes": dict(self.child_processes),
+            "concurrent_stages": sorted(self.concurrent_stages),
+        }
+
+
+current_stage_tracker: ContextVar[Optional[StageResourceTracker]] = ContextVar(
+    "current_stage_tracker", default=None
+)
+
+
+def audit_subprocess_spawn(event: str, args: tuple) -> None:
+    if event not in SPAWN_EVENTS:
+        return
+    tracker = current_stage_tracker.get()
+    if tracker is None or not args:
+        return
+    # subprocess.Popen は (executable, args, cwd, env)、os.system は (command,) を受け取る
+    executable = args[0]
+    if executable is None and event == "subprocess.Popen":
+        executable = args[1]
+    if isinstance(executable, (list, tuple)):
+        executable = executable[0] if executable else None
+    elif isinstance(executable, str) and event == "os.system":
+        executable = executable.split(" ", 1)[0]
+    tracker.record_spawn(os.fsdecode(executable) if executable else "unknown")
+
+
+audit_hook_lock = threading.Lock()
+audit_hook_installed = False
+
+
+def install_audit_hook() -> None:
+    # 監査フックは解除できないため、プロセスにつき一度だけ登録する
+    global audit_hook_installed
+    with audit_hook_lock:
+        if not audit_hook_installed:
+            sys.addaudithook(audit_subprocess_spawn)
+            audit_hook_installed = True
+
+
+class ResourceMonitor:
+    def __init__(self, sample_interval: float = 0.1) -> None:
+        # procfs がない環境では ps を起動してサンプリングするため、間隔を広げる
+        self.sample_interval = (
+            sample_interval if HAS_PROCFS else max(sample_interval, 0.5)
+        )
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.active: List[StageResourceTracker] = []
+        self.usages: List[StageResourceUsage] = []
+        self.peak_rss_bytes = 0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def sample(self) -> Dict[int, ProcessSample]:
+        samples = sample_process_tree(self.pid)
+        with self.lock:
+            self.peak_rss_bytes = max(
+                self.peak_rss_bytes,
+                sum(sample["rss_bytes"] for sample in samples.values()),
+            )
+            for tracker in self.active:
+                tracker.observe(samples)
+        return samples
+
+    def __sample_loop(self) -> None:
+        while not self.stop_event.wait(self.sample_interval):
+            self.sample()
+
+    def start(self) -> None:
+        install_audit_hook()
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.__sample_loop, name="resource-monitor", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @contextmanager
+    def measure(self, stage_name: str) -> Iterator[StageResourceTracker]:
+        tracker = StageResourceTracker(stage_name, sample_process_tree(self.pid))
+        with self.lock:
+            for other in self.active:
+                other.concurrent_stages.add(stage_name)
+                tracker.concurrent_stages.add(other.stage_name)
+            self.active.append(tracker)
+        tracker.observe(tracker.baseline)
+        token = current_stage_tracker.set(tracker)
+        try:
+            yield tracker
+        finally:
+            current_stage_tracker.reset(token)
+            # 終了直前の状態も反映してから集計する
+            self.sample()
+            with self.lock:
+                self.active.remove(tracker)
+                self.usages.append(tracker.finish())
+
+    def report(self) -> ResourceReport:
+        with self.lock:
+            return {
+                "pid": self.pid,
+                "platform": sys.platform,
+                "sample_interval": self.sample_interval,
+                "peak_rss_bytes": self.peak_rss_bytes,
+                "stages": list(self.usages),
+            }
+
+    def export(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.report(), file, ensure_ascii=False, indent=2)
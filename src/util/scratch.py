@@ -0,0 +1,80 @@
+import atexit
+import errno
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Tuple
+
+current_scratch_dir: ContextVar[Optional[str]] = ContextVar(
+    "current_scratch_dir", default=None
+)
+# ジョブの外で生成器を直接呼び出した場合に利用する、スレッドごとの作業ディレクトリ
+# fork したワーカープロセスやサーバーのスレッドが同じディレクトリを使わないよう、
+# プロセスIDとスレッドIDの組ごとに持つ
+process_scratch_dirs: Dict[Tuple[int, int], str] = {}
+process_scratch_lock = threading.Lock()
+
+
+@contextmanager
+def scratch_directory(base_dir: Optional[str] = None) -> Iterator[str]:
+    # ジョブ専用の作業ディレクトリを作成し、終了時に中間ファイルごと削除する
+    # base_dir に /dev/shm などの tmpfs を指定すると中間ファイルをメモリ上に置ける
+    if base_dir is not None:
+        os.makedirs(base_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix="shoorter-", dir=base_dir)
+    token = current_scratch_dir.set(path)
+    try:
+        yield path
+    finally:
+        current_scratch_dir.reset(token)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_process_scratch_dir(pid: int, path: str) -> None:
+    # fork したプロセスに引き継がれた終了処理では、親の作業ディレクトリを削除しない
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def process_scratch_dir() -> str:
+    pid = os.getpid()
+    key = (pid, threading.get_ident())
+    with process_scratch_lock:
+        if key not in process_scratch_dirs:
+            process_scratch_dirs[key] = tempfile.mkdtemp(prefix="shoorter-")
+            atexit.register(remove_process_scratch_dir, pid, process_scratch_dirs[key])
+        return process_scratch_dirs[key]
+
+
+def scratch_path(*names: str) -> str:
+    # 現在のジョブの作業ディレクトリ内のパスを返す。親ディレクトリは作成済みとなる
+    base_dir = current_scratch_dir.get() or process_scratch_dir()
+    path = os.path.join(base_dir, *names)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def publish(source_path: str, output_path: str) -> None:
+    # 書き出しが完了したファイルを出力先に配置する。読み手が書きかけのファイルを参照することはない
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    try:
+        os.replace(source_path, output_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # tmpfs など別のファイルシステムからは、出力先と同じディレクトリに複製してから置き換える
+        fd, temp_path = tempfile.mkstemp(
+            prefix=f".{os.path.basename(output_path)}.",
+            dir=os.path.dirname(os.path.abspath(output_path)),
+        )
+        os.close(fd)
+        try:
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            os.remove(temp_path) if os.path.exists(temp_path) else None
+            raise
+        os.remove(source_path)
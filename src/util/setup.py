@@ -191,6 +191,16 @@ def get_onnxruntime_lib_path(
     raise FileNotFoundError("ONNX Runtimeのライブラリが見つかりませんでした。")
 
 
+def default_onnxruntime_lib_path(assets_dir: str = "assets") -> str:
+    # ONNX Runtimeのライブラリ名はOSごとに異なる
+    names = {
+        "macos": "libonnxruntime.dylib",
+        "linux": "libonnxruntime.so",
+        "windows": "onnxruntime.dll",
+    }
+    return os.path.join(assets_dir, names[detect_os()])
+
+
 def get_open_jtalk_dict_dir_path(
     output_dir: str,
 ) -> str:
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        category: str,
+        attributes: Dict[str, Any],
+        parent: Optional["Span"],
+    ) -> None:
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.parent = parent
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns: Optional[int] = None
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.start_ns = time.perf_counter_ns()
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        # Chrome trace / Perfetto で読み込める Trace Event Format に変換する
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events: List[Dict[str, Any]] = []
+        thread_names: Dict[int, str] = {}
+        for span in spans:
+            thread_names[span.thread_id] = span.thread_name
+            end_ns = span.end_ns if span.end_ns is not None else span.start_ns
+            args = {key: str(value) for key, value in span.attributes.items()}
+            if span.error is not None:
+                args["error"] = span.error
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start_ns - self.start_ns) / 1000,
+                    "dur": (end_ns - span.start_ns) / 1000,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": args,
+                }
+            )
+        for thread_id, thread_name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": thread_id,
+                    "args": {"name": thread_name},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_chrome_trace(), file, ensure_ascii=False)
+
+
+current_tracer: ContextVar[Optional[Tracer]] = ContextVar(
+    "current_tracer", default=None
+)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def tracing(tracer: Tracer) -> Iterator[Tracer]:
+    token = current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        current_tracer.reset(token)
+
+
+@contextmanager
+def span(
+    name: str, category: str = "app", **attributes: Any
+) -> Iterator[Optional[Span]]:
+    # トレース中でなければ何も記録しない
+    tracer = current_tracer.get()
+    if tracer is None:
+        yield None
+        return
+
+    current = Span(name, category, attributes, parent=current_span.get())
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.perf_counter_ns()
+        current_span.reset(token)
+        tracer.add(current)
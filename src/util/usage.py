@@ -0,0 +1,364 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .progress import JobCancelledError, current_stage
+from .tracing import span
+
+# 1M トークンあたりの料金 (USD)。(入力, 出力)
+TOKEN_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-2024-08-06": (2.50, 10.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+# 画像1枚あたりの料金 (USD)。(モデル, 品質, サイズ) ごと
+IMAGE_PRICES: Dict[Tuple[str, str, str], float] = {
+    ("dall-e-3", "standard", "1024x1024"): 0.040,
+    ("dall-e-3", "standard", "1024x1792"): 0.080,
+    ("dall-e-3", "standard", "1792x1024"): 0.080,
+    ("dall-e-3", "hd", "1024x1024"): 0.080,
+    ("dall-e-3", "hd", "1024x1792"): 0.120,
+    ("dall-e-3", "hd", "1792x1024"): 0.120,
+}
+# 応答時間のヒストグラムの区切り [s]
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0]
+
+
+class OpenAICall:
+    def __init__(
+        self,
+        endpoint: str,
+        model: str,
+        purpose: str,
+        size: Optional[str] = None,
+        quality: Optional[str] = None,
+    ) -> None:
+        self.endpoint = endpoint
+        self.model = model
+        self.purpose = purpose
+        self.size = size
+        self.quality = quality
+        self.stage = current_stage.get()
+        self.latency = 0.0
+        # ストリーミングの応答を受け取る途中で、呼び出し側が処理していた時間
+        self.paused = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.images = 0
+        # 429 や 5xx を受けて再試行した回数
+        self.retries = 0
+        self.error = False
+        # 記録から再生した応答は費用がかからない
+        self.replayed = False
+
+    def set_response(self, response: Any) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        if self.endpoint == "images.generate":
+            self.images = len(getattr(response, "data", None) or [])
+
+    @property
+    def cost(self) -> float:
+        # 料金表にないモデルは 0 とする
+        if self.replayed:
+            return 0.0
+        input_price, output_price = TOKEN_PRICES.get(self.model, (0.0, 0.0))
+        image_price = IMAGE_PRICES.get(
+            (self.model, self.quality or "standard", self.size or ""), 0.0
+        )
+        return (
+            self.prompt_tokens * input_price + self.completion_tokens * output_price
+        ) / 1e6 + self.images * image_price
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "purpose": self.purpose,
+            "stage": self.stage,
+            "latency": self.latency,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "images": self.images,
+            "retries": self.retries,
+            "error": self.error,
+            "replayed": self.replayed,
+            "cost": self.cost,
+        }
+
+
+def prometheus_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_labels(labels: Dict[str, Any]) -> str:
+    return (
+        "{"
+        + ",".join(
+            f'{key}="{prometheus_label_value(value)}"' for key, value in labels.items()
+        )
+        + "}"
+    )
+
+
+class UsageTotals:
+    def __init__(self) -> None:
+        # (エンドポイント, モデル, 用途) ごとの累計。呼び出しの記録を保持せずに集計を更新する
+        self.requests = {"ok": 0, "error": 0}
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.images = 0
+        self.cost = 0.0
+        self.latency = 0.0
+        # LATENCY_BUCKETS の区切りごとの、応答時間がそれ以下の呼び出し数
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    @property
+    def calls(self) -> int:
+        return self.requests["ok"] + self.requests["error"]
+
+    def add(self, call: OpenAICall) -> None:
+        self.requests["error" if call.error else "ok"] += 1
+        self.retries += call.retries
+        self.prompt_tokens += call.prompt_tokens
+        self.completion_tokens += call.completion_tokens
+        self.images += call.images
+        self.cost += call.cost
+        self.latency += call.latency
+        for idx, bucket in enumerate(LATENCY_BUCKETS):
+            if call.latency <= bucket:
+                self.latency_buckets[idx] += 1
+
+    def merge(self, other: "UsageTotals") -> None:
+        for status, count in other.requests.items():
+            self.requests[status] += count
+        self.retries += other.retries
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.images += other.images
+        self.cost += other.cost
+        self.latency += other.latency
+        for idx, count in enumerate(other.latency_buckets):
+            self.latency_buckets[idx] += count
+
+
+class UsageRecorder:
+    def __init__(self, keep_calls: bool = True) -> None:
+        # OpenAI API の呼び出しごとのトークン数・応答時間・再試行回数・推定費用を記録する
+        # 長時間動作するサーバーなどでは keep_calls=False とし、集計のみを保持する
+        self.keep_calls = keep_calls
+        self.calls: List[OpenAICall] = []
+        self.totals: Dict[Tuple[str, str, str], UsageTotals] = defaultdict(UsageTotals)
+        self.lock = threading.Lock()
+
+    def record(self, call: OpenAICall) -> None:
+        with self.lock:
+            if self.keep_calls:
+                self.calls.append(call)
+            self.totals[(call.endpoint, call.model, call.purpose)].add(call)
+
+    def merge(self, other: "UsageRecorder") -> None:
+        totals: Dict[Tuple[str, str, str], UsageTotals] = defaultdict(UsageTotals)
+        with other.lock:
+            calls = list(other.calls)
+            for key, value in other.totals.items():
+                totals[key].merge(value)
+        with self.lock:
+            if self.keep_calls:
+                self.calls.extend(calls)
+            for key, value in totals.items():
+                self.totals[key].merge(value)
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            totals = list(self.totals.items())
+        purposes: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {
+                "calls": 0,
+                "latency": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "images": 0,
+                "retries": 0,
+                "cost": 0.0,
+            }
+        )
+        for (_, _, purpose), value in totals:
+            total = purposes[purpose]
+            total["calls"] += value.calls
+            total["latency"] += value.latency
+            total["prompt_tokens"] += value.prompt_tokens
+            total["completion_tokens"] += value.completion_tokens
+            total["images"] += value.images
+            total["retries"] += value.retries
+            total["cost"] += value.cost
+        return {
+            "calls": sum(value.calls for _, value in totals),
+            "latency": sum(value.latency for _, value in totals),
+            "cost": sum(value.cost for _, value in totals),
+            "purposes": dict(purposes),
+        }
+
+    def to_prometheus(self, labels: Optional[Dict[str, str]] = None) -> str:
+        # Prometheus のテキスト形式。node_exporter の textfile collector や /metrics で公開できる
+        with self.lock:
+            totals = sorted(self.totals.items())
+        base = labels or {}
+
+        # (エンドポイント, モデル, 用途) ごとに出力する。呼び出し回数とトークン数は状態・種類の列を加える
+        def label(key: Tuple[str, str, str], *extra: Tuple[str, Any]) -> str:
+            return prometheus_labels(
+                {
+                    **base,
+                    "endpoint": key[0],
+                    "model": key[1],
+                    "purpose": key[2],
+                    **dict(extra),
+                }
+            )
+
+        lines = [
+            "# HELP shoorter_openai_requests_total OpenAI API の呼び出し回数",
+            "# TYPE shoorter_openai_requests_total counter",
+        ]
+        for key, value in totals:
+            for status, count in sorted(value.requests.items()):
+                if count:
+                    lines.append(
+                        f"shoorter_openai_requests_total{label(key, ('status', status))} {count}"
+                    )
+        lines += [
+            "# HELP shoorter_openai_retries_total OpenAI API の呼び出しを再試行した回数",
+            "# TYPE shoorter_openai_retries_total counter",
+        ]
+        for key, value in totals:
+            lines.append(f"shoorter_openai_retries_total{label(key)} {value.retries}")
+        lines += [
+            "# HELP shoorter_openai_tokens_total 消費したトークン数",
+            "# TYPE shoorter_openai_tokens_total counter",
+        ]
+        for key, value in totals:
+            for token_type, count in [
+                ("completion", value.completion_tokens),
+                ("prompt", value.prompt_tokens),
+            ]:
+                if count:
+                    lines.append(
+                        f"shoorter_openai_tokens_total{label(key, ('type', token_type))} {count}"
+                    )
+        lines += [
+            "# HELP shoorter_openai_images_total 生成した画像の枚数",
+            "# TYPE shoorter_openai_images_total counter",
+        ]
+        for key, value in totals:
+            if value.images:
+                lines.append(f"shoorter_openai_images_total{label(key)} {value.images}")
+        lines += [
+            "# HELP shoorter_openai_cost_usd_total 料金表から推定した費用 (USD)",
+            "# TYPE shoorter_openai_cost_usd_total counter",
+        ]
+        for key, value in totals:
+            lines.append(f"shoorter_openai_cost_usd_total{label(key)} {value.cost:.6f}")
+        lines += [
+            "# HELP shoorter_openai_request_duration_seconds OpenAI API の応答時間",
+            "# TYPE shoorter_openai_request_duration_seconds histogram",
+        ]
+        for key, value in totals:
+            for bucket, count in zip(LATENCY_BUCKETS, value.latency_buckets):
+                lines.append(
+                    f"shoorter_openai_request_duration_seconds_bucket{label(key, ('le', bucket))} {count}"
+                )
+            lines.append(
+                f"shoorter_openai_request_duration_seconds_bucket{label(key, ('le', '+Inf'))} {value.calls}"
+            )
+            lines.append(
+                f"shoorter_openai_request_duration_seconds_sum{label(key)} {value.latency:.6f}"
+            )
+            lines.append(
+                f"shoorter_openai_request_duration_seconds_count{label(key)} {value.calls}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        # Prometheus のテキスト形式と、呼び出しごとの記録を含む JSON を書き出す
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.to_prometheus())
+        with self.lock:
+            calls = [call.to_dict() for call in self.calls]
+        with open(f"{os.path.splitext(path)[0]}.json", "w", encoding="utf-8") as file:
+            json.dump(
+                {"summary": self.summary(), "calls": calls},
+                file,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+current_usage_recorder: ContextVar[Optional[UsageRecorder]] = ContextVar(
+    "current_usage_recorder", default=None
+)
+current_openai_call: ContextVar[Optional[OpenAICall]] = ContextVar(
+    "current_openai_call", default=None
+)
+
+
+@contextmanager
+def usage_recording(recorder: UsageRecorder) -> Iterator[UsageRecorder]:
+    token = current_usage_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_usage_recorder.reset(token)
+
+
+@contextmanager
+def openai_call(
+    endpoint: str,
+    model: str,
+    purpose: str,
+    size: Optional[str] = None,
+    quality: Optional[str] = None,
+) -> Iterator[OpenAICall]:
+    # トレースの span を兼ねる。応答を受け取ったら set_response でトークン数などを記録する
+    attributes: Dict[str, Any] = {"model": model, "purpose": purpose}
+    if size is not None:
+        attributes["size"] = size
+    call = OpenAICall(endpoint, model, purpose, size=size, quality=quality)
+    token = current_openai_call.set(call)
+    start = time.perf_counter()
+    try:
+        with span(f"openai.{endpoint}", category="openai", **attributes) as current:
+            try:
+                yield call
+            finally:
+                if current is not None:
+                    current.set_attribute("prompt_tokens", call.prompt_tokens)
+                    current.set_attribute("completion_tokens", call.completion_tokens)
+                    current.set_attribute("retries", call.retries)
+    except BaseException as e:
+        call.error = True
+        # SDK はトランスポート内で送出されたキャンセルを APIConnectionError に包むため、元に戻す
+        if isinstance(e.__cause__, JobCancelledError):
+            raise e.__cause__ from None
+        raise
+    finally:
+        call.latency = time.perf_counter() - start - call.paused
+        current_openai_call.reset(token)
+        recorder = current_usage_recorder.get()
+        if recorder is not None:
+            recorder.record(call)
+
+
+def mark_replayed() -> None:
+    call = current_openai_call.get()
+    if call is not None:
+        call.replayed = True
@@ -0,0 +1,4 @@
+from .job_queue import JobQueue as JobQueue
+from .job_queue import QueuedJob as QueuedJob
+from .queue_worker import QueueWorker as QueueWorker
+from .queue_worker import run_worker_pool as run_worker_pool
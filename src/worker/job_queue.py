@@ -0,0 +1,305 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Literal, Optional, TypedDict
+
+import ulid
+
+JobStatus = Literal["queued", "running", "succeeded", "failed"]
+StageStatus = Literal["running", "succeeded", "failed"]
+
+
+class QueuedJob(TypedDict):
+    id: str
+    tenant: str
+    priority: int
+    spec: Dict[str, Any]
+    output_dir: str
+    status: JobStatus
+    attempts: int
+    max_attempts: int
+    worker_id: Optional[str]
+    lease_expires_at: Optional[float]
+    available_at: float
+    created_at: float
+    updated_at: float
+    error: Optional[str]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    spec TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+CREATE TABLE IF NOT EXISTS job_stages (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+
+class JobQueue:
+    def __init__(
+        self,
+        db_path: str,
+        lease_seconds: float = 120.0,
+        retry_backoff_seconds: float = 30.0,
+    ) -> None:
+        # ワーカーは lease_seconds 以内にハートビートを送る必要があり、途絶えたジョブは再度キューに戻す
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.__connection().executescript(SCHEMA)
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに接続する
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_path, timeout=30.0, isolation_level=None
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.__connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def __to_job(row: sqlite3.Row) -> QueuedJob:
+        job = dict(row)
+        job["spec"] = json.loads(job["spec"])
+        return job  # type: ignore
+
+    def submit(
+        self,
+        spec: Dict[str, Any],
+        output_dir: str,
+        tenant: str = "default",
+        priority: int = 0,
+        max_attempts: int = 3,
+        job_id: Optional[str] = None,
+    ) -> str:
+        job_id = job_id or str(ulid.new())
+        now = time.time()
+        with self.__transaction() as connection:
+            connection.execute(
+                """
+                INSERT INTO jobs (
+                    id, tenant, priority, spec, output_dir, status, attempts,
+                    max_attempts, available_at, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+                """,
+                (
+                    job_id,
+                    tenant,
+                    priority,
+                    json.dumps(spec, ensure_ascii=False),
+                    output_dir,
+                    max_attempts,
+                    now,
+                    now,
+                    now,
+                ),
+            )
+        return job_id
+
+    def __requeue_expired(self, connection: sqlite3.Connection, now: float) -> None:
+        # リースが切れたジョブはワーカーが停止したとみなし、試行回数が残っていればキューに戻す
+        connection.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                error = 'ワーカーからの応答が途絶えました',
+                worker_id = NULL,
+                lease_expires_at = NULL,
+                updated_at = ?
+            WHERE status = 'running' AND lease_expires_at < ?
+            """,
+            (now, now),
+        )
+
+    def lease(self, worker_id: str) -> Optional[QueuedJob]:
+        now = time.time()
+        with self.__transaction() as connection:
+            self.__requeue_expired(connection, now)
+            # 実行中のジョブが少ないテナントを優先し、テナント内では優先度と投入順で選ぶ
+            row = connection.execute(
+                """
+                SELECT jobs.id FROM jobs
+                LEFT JOIN (
+                    SELECT tenant, COUNT(*) AS running FROM jobs
+                    WHERE status = 'running' GROUP BY tenant
+                ) AS running_jobs ON running_jobs.tenant = jobs.tenant
+                WHERE jobs.status = 'queued' AND jobs.available_at <= ?
+                ORDER BY COALESCE(running_jobs.running, 0) ASC,
+                         jobs.priority DESC,
+                         jobs.created_at ASC
+                LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                """
+                UPDATE jobs
+                SET status = 'running', attempts = attempts + 1, worker_id = ?,
+                    lease_expires_at = ?, updated_at = ?, error = NULL
+                WHERE id = ?
+                """,
+                (worker_id, now + self.lease_seconds, now, row["id"]),
+            )
+            job = connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (row["id"],)
+            ).fetchone()
+        return self.__to_job(job)
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        now = time.time()
+        with self.__transaction() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE jobs SET lease_expires_at = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'running'
+                """,
+                (now + self.lease_seconds, now, job_id, worker_id),
+            )
+        # False の場合はリースを失っているため、ワーカーは処理を中断すべきである
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str) -> None:
+        now = time.time()
+        with self.__transaction() as connection:
+            connection.execute(
+                """
+                UPDATE jobs
+                SET status = 'succeeded', worker_id = NULL, lease_expires_at = NULL,
+                    updated_at = ?
+                WHERE id = ? AND worker_id = ?
+                """,
+                (now, job_id, worker_id),
+            )
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> JobStatus:
+        now = time.time()
+        with self.__transaction() as connection:
+            row = connection.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker_id = ?",
+                (job_id, worker_id),
+            ).fetchone()
+            if row is None:
+                return "failed"
+            # 試行回数が残っている場合は指数的に待ち時間を延ばして再試行する
+            status: JobStatus = (
+                "queued" if row["attempts"] < row["max_attempts"] else "failed"
+            )
+            available_at = now + self.retry_backoff_seconds * 2 ** (row["attempts"] - 1)
+            connection.execute(
+                """
+                UPDATE jobs
+                SET status = ?, error = ?, worker_id = NULL, lease_expires_at = NULL,
+                    available_at = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (status, error, available_at, now, job_id),
+            )
+        return status
+
+    def update_stage(
+        self,
+        job_id: str,
+        stage: str,
+        status: StageStatus,
+        attempt: int,
+        error: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        with self.__transaction() as connection:
+            if status == "running":
+                connection.execute(
+                    """
+                    INSERT OR REPLACE INTO job_stages
+                        (job_id, stage, status, attempt, started_at, finished_at, error)
+                    VALUES (?, ?, ?, ?, ?, NULL, NULL)
+                    """,
+                    (job_id, stage, status, attempt, now),
+                )
+            else:
+                connection.execute(
+                    """
+                    UPDATE job_stages SET status = ?, finished_at = ?, error = ?
+                    WHERE job_id = ? AND stage = ?
+                    """,
+                    (status, now, error, job_id, stage),
+                )
+
+    def get(self, job_id: str) -> Optional[QueuedJob]:
+        row = (
+            self.__connection()
+            .execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        return self.__to_job(row) if row is not None else None
+
+    def stages(self, job_id: str) -> List[Dict[str, Any]]:
+        rows = (
+            self.__connection()
+            .execute(
+                "SELECT * FROM job_stages WHERE job_id = ? ORDER BY started_at",
+                (job_id,),
+            )
+            .fetchall()
+        )
+        return [dict(row) for row in rows]
+
+    def jobs(self, status: Optional[JobStatus] = None) -> List[QueuedJob]:
+        if status is None:
+            rows = (
+                self.__connection()
+                .execute("SELECT * FROM jobs ORDER BY created_at")
+                .fetchall()
+            )
+        else:
+            rows = (
+                self.__connection()
+                .execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at",
+                    (status,),
+                )
+                .fetchall()
+            )
+        return [self.__to_job(row) for row in rows]
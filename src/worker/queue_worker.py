@@ -0,0 +1,172 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+from typing import Optional
+
+import ulid
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(parent_dir)
+from command import JobSpec, run_job, warm_up_with_defaults  # noqa: E402
+from pipeline import Stage, StageExecutionError  # noqa: E402
+from util import ProgressReporter, ResourceBudget, ResourceGovernor  # noqa: E402
+
+from .job_queue import JobQueue, QueuedJob  # noqa: E402
+
+
+class QueueWorker:
+    def __init__(
+        self,
+        queue: JobQueue,
+        logger: logging.Logger,
+        poll_interval: float = 5.0,
+        worker_id: Optional[str] = None,
+        governor: Optional[ResourceGovernor] = None,
+    ) -> None:
+        self.queue = queue
+        self.governor = governor
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.worker_id = (
+            worker_id or f"{socket.gethostname()}-{os.getpid()}-{ulid.new()}"
+        )
+
+    def run_forever(self, stop_event: threading.Event) -> None:
+        self.logger.info(f"ワーカー {self.worker_id} を起動しました")
+        while not stop_event.is_set():
+            job = self.queue.lease(self.worker_id)
+            if job is None:
+                stop_event.wait(self.poll_interval)
+                continue
+            self.run_once(job)
+        self.logger.info(f"ワーカー {self.worker_id} を停止しました")
+
+    def run_once(self, job: QueuedJob) -> None:
+        self.logger.info(
+            f"ジョブ {job['id']} を開始します (テナント: {job['tenant']}, 試行: {job['attempts']}/{job['max_attempts']})"
+        )
+
+        # 処理中はリースを延長し続け、ワーカーが停止した場合にのみリースが切れるようにする
+        # リースを失ったジョブは他のワーカーに再度リースされ得るため、中断して結果を書き込まない
+        heartbeat_stop = threading.Event()
+        lease_lost = threading.Event()
+        progress = ProgressReporter()
+
+        def heartbeat() -> None:
+            while not heartbeat_stop.wait(self.queue.lease_seconds / 3):
+                if not self.queue.heartbeat(job["id"], self.worker_id):
+                    self.logger.warning(
+                        f"ジョブ {job['id']} のリースを失ったため中断します"
+                    )
+                    lease_lost.set()
+                    progress.cancel()
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+        def on_stage_start(stage: Stage) -> None:
+            if not lease_lost.is_set():
+                self.queue.update_stage(
+                    job["id"], stage.name, "running", job["attempts"]
+                )
+
+        def on_stage_end(stage: Stage) -> None:
+            if not lease_lost.is_set():
+                self.queue.update_stage(
+                    job["id"], stage.name, "succeeded", job["attempts"]
+                )
+
+        try:
+            # 出力先ディレクトリのキャッシュにより、再試行時は完了済みのステージを再利用する
+            run_job(
+                spec=JobSpec.parse_obj(job["spec"]),
+                output_dir=job["output_dir"],
+                logger=self.logger,
+                on_stage_start=on_stage_start,
+                on_stage_end=on_stage_end,
+                progress=progress,
+                governor=self.governor,
+                job_id=job["id"],
+            )
+            if lease_lost.is_set():
+                self.logger.warning(
+                    f"ジョブ {job['id']} はリースを失ったため、完了を記録しません"
+                )
+                return
+            self.queue.complete(job["id"], self.worker_id)
+            self.logger.info(f"ジョブ {job['id']} が完了しました")
+        except Exception as e:
+            if lease_lost.is_set():
+                self.logger.info(f"ジョブ {job['id']} を中断しました")
+                return
+            if isinstance(e, StageExecutionError):
+                self.queue.update_stage(
+                    job["id"], e.stage.name, "failed", job["attempts"], str(e.error)
+                )
+            status = self.queue.fail(job["id"], self.worker_id, str(e))
+            self.logger.error(
+                f"ジョブ {job['id']} が失敗しました ({'再試行します' if status == 'queued' else '再試行しません'}): {e}"
+            )
+        finally:
+            heartbeat_stop.set()
+            heartbeat_thread.join()
+
+
+def run_queue_worker(
+    db_path: str,
+    lease_seconds: float,
+    poll_interval: float,
+    budget: Optional[ResourceBudget] = None,
+) -> None:
+    # ワーカープロセスのエントリーポイントであり、SIGTERMを受けるまでジョブを処理し続ける
+    logger = logging.getLogger(f"worker.{os.getpid()}")
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    governor = ResourceGovernor(**budget, logger=logger) if budget is not None else None
+    # ジョブをリースする前に初期化しておき、各ジョブの開始時の待ち時間をなくす
+    warm_up_with_defaults(logger, governor)
+    QueueWorker(
+        queue=JobQueue(db_path, lease_seconds=lease_seconds),
+        logger=logger,
+        poll_interval=poll_interval,
+        governor=governor,
+    ).run_forever(stop_event)
+
+
+def run_worker_pool(
+    db_path: str,
+    num_workers: int,
+    logger: logging.Logger,
+    lease_seconds: float = 120.0,
+    poll_interval: float = 5.0,
+    budget: Optional[ResourceBudget] = None,
+) -> None:
+    # 未指定の予算をホストの性能から補い、ワーカープロセスごとに等分する。各プロセスの予算は固定となる
+    worker_budget = (
+        ResourceGovernor(**budget).split(num_workers) if budget is not None else None
+    )
+    processes = [
+        multiprocessing.Process(
+            target=run_queue_worker,
+            args=(db_path, lease_seconds, poll_interval, worker_budget),
+            name=f"queue-worker-{i}",
+        )
+        for i in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"{num_workers}個のワーカープロセスを起動しました")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("ワーカープロセスを停止します")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()